@@ -0,0 +1,84 @@
+"""Import time benchmark of the library modules.
+
+Each measurement imports the module in a fresh interpreter, timing only the
+import itself (not the interpreter startup). Also checks that importing the
+module doesn't drag in any of the heavy optional modules.
+
+    python benchmarks/bench_import.py [--repeat 10] [--max-ms 250] [module ...]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# ============================================================================
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must only be imported on demand
+HEAVY_MODULES = ['cv2', 'logic_data']
+
+PROBE = """
+import sys, time
+t = time.time()
+import %s
+t = time.time() - t
+print(repr((t, [m for m in %r if m in sys.modules])))
+"""
+
+# ============================================================================
+
+def measure_import(module, repeat):
+    timings = []
+    loaded = set()
+    for i in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', PROBE % (module, HEAVY_MODULES)]
+            , cwd=ROOT)
+        t, heavy = eval(output.strip())
+        timings.append(t * 1000.0)
+        loaded.update(heavy)
+    timings.sort()
+    return {
+        "module" : module
+        , "repeat" : repeat
+        , "min_ms" : timings[0]
+        , "median_ms" : timings[len(timings) // 2]
+        , "heavy_modules" : sorted(loaded)
+        }
+
+# ============================================================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the import time of the library modules.")
+    parser.add_argument("modules", nargs="*", default=["logic"])
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--max-ms", type=float
+        , help="fail if the fastest import of a module takes longer than this")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    results = [measure_import(module, args.repeat) for module in args.modules]
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    print text
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+
+    failed = False
+    for result in results:
+        if result["heavy_modules"]:
+            sys.stderr.write("%s imports %s\n" % (result["module"], ", ".join(result["heavy_modules"])))
+            failed = True
+        if (args.max_ms is not None) and (result["min_ms"] > args.max_ms):
+            sys.stderr.write("%s takes %.1f ms to import (limit %.1f ms)\n"
+                % (result["module"], result["min_ms"], args.max_ms))
+            failed = True
+    return 1 if failed else 0
+
+# ============================================================================
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,173 @@
+"""Scaling benchmark of the analysis, on generated charts.
+
+For each size (in line segments) a chart is generated with `logic_synth`,
+then traced, validated and turned into expressions, timing each stage. The
+results are written as JSON; given the results of an earlier run as the
+baseline, stages that got slower by more than the allowed factor are
+reported, and the exit status is non-zero.
+
+    python benchmarks/bench_scaling.py [--sizes 10,100,1000,10000,100000]
+        [--repeat 3] [--output results.json] [--baseline old.json]
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from logic import DataSet
+from logic_instrument import Instrumentation
+from logic_io import normalize_chart
+from logic_synth import generate_chart
+
+# ============================================================================
+
+DEFAULT_SIZES = [10, 100, 1000, 10000, 100000]
+STAGES = ["init", "analyze", "validate", "expressions"]
+
+# ============================================================================
+
+def run_stages(lines, labels, instrumentation=None, processes=1):
+    # Seconds taken by each stage of one analysis
+    timings = {}
+    t = time.time()
+    ds = DataSet(lines, labels, instrumentation=instrumentation)
+    timings["init"] = time.time() - t
+
+    t = time.time()
+    ds.analyze(processes)
+    timings["analyze"] = time.time() - t
+
+    t = time.time()
+    ds.validate()
+    timings["validate"] = time.time() - t
+
+    t = time.time()
+    ds.expressions
+    timings["expressions"] = time.time() - t
+    return timings
+
+# ----------------------------------------------------------------------------
+
+def measure_size(segments, args):
+    t = time.time()
+    record = generate_chart(segments, fan_in=args.fan_in, fan_out=args.fan_out, depth=args.depth
+        , jogs=args.jogs, bridges=args.bridges, seed=args.seed)
+    lines, labels = normalize_chart(record)
+    result = {
+        "segments" : segments
+        , "lines" : len(lines)
+        , "labels" : len(labels)
+        , "generate_ms" : (time.time() - t) * 1000.0
+        , "stages" : {}
+        , "counters" : None
+        , "error" : None
+        }
+
+    runs = []
+    try:
+        for i in range(args.repeat):
+            runs.append(run_stages(lines, labels, processes=args.processes))
+        if args.counters:
+            instrumentation = Instrumentation()
+            run_stages(lines, labels, instrumentation, args.processes)
+            result["counters"] = dict(instrumentation.counters)
+    except Exception as e:
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+        return result
+
+    for stage in STAGES:
+        timings = sorted(run[stage] * 1000.0 for run in runs)
+        result["stages"][stage] = {
+            "min_ms" : timings[0]
+            , "median_ms" : timings[len(timings) // 2]
+            }
+    return result
+
+# ============================================================================
+
+def compare(results, baseline, max_slowdown, min_ms):
+    # Messages about the stages slower than in the baseline
+    previous = dict((r["segments"], r) for r in baseline["results"])
+    regressions = []
+    for result in results:
+        old = previous.get(result["segments"])
+        if (old is None) or old["error"] or result["error"]:
+            continue
+        for stage in STAGES:
+            before = old["stages"][stage]["min_ms"]
+            after = result["stages"][stage]["min_ms"]
+            if max(before, after) < min_ms:
+                continue # Too fast to tell
+            if after > before * max_slowdown:
+                regressions.append("%d segments, %s: %.1f ms -> %.1f ms (%.2fx)"
+                    % (result["segments"], stage, before, after, after / max(before, 1e-9)))
+    return regressions
+
+# ============================================================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure how the analysis scales with chart size.")
+    parser.add_argument("--sizes", default=",".join(str(n) for n in DEFAULT_SIZES)
+        , help="comma separated chart sizes, in line segments (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fan-in", default="2,2", help="min,max inputs of binary gates")
+    parser.add_argument("--fan-out", type=int, default=4)
+    parser.add_argument("--depth", type=int, default=6)
+    parser.add_argument("--jogs", type=float, default=0.0)
+    parser.add_argument("--bridges", type=int, default=0)
+    parser.add_argument("--processes", type=int, default=1
+        , help="trace independent parts of big charts on this many processes (default: %(default)s)")
+    parser.add_argument("--counters", action="store_true"
+        , help="also record the instrumentation counters, from an extra run")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument("--max-slowdown", type=float, default=1.25
+        , help="fail if a stage is slower than the baseline by this factor (default: %(default)s)")
+    parser.add_argument("--min-ms", type=float, default=5.0
+        , help="ignore stages faster than this in both runs (default: %(default)s)")
+    args = parser.parse_args(argv)
+    args.fan_in = [int(n) for n in args.fan_in.split(",")]
+
+    results = []
+    for segments in [int(n) for n in args.sizes.split(",")]:
+        result = measure_size(segments, args)
+        results.append(result)
+        if result["error"]:
+            sys.stderr.write("%d segments: %s\n" % (segments, result["error"]))
+        else:
+            sys.stderr.write("%d segments: %s\n" % (segments, ", ".join("%s %.1f ms"
+                % (stage, result["stages"][stage]["min_ms"]) for stage in STAGES)))
+
+    report = {
+        "python" : platform.python_version()
+        , "platform" : platform.platform()
+        , "options" : dict((key, value) for key, value in vars(args).items()
+            if key not in ["output", "baseline", "max_slowdown", "min_ms"])
+        , "results" : results
+        }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    print text
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+
+    failed = any(result["error"] for result in results)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.max_slowdown, args.min_ms)
+        for message in regressions:
+            sys.stderr.write("Slower: %s\n" % message)
+        failed = failed or bool(regressions)
+    return 1 if failed else 0
+
+# ============================================================================
+
+if __name__ == '__main__':
+    sys.exit(main())
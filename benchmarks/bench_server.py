@@ -0,0 +1,216 @@
+"""Load generator for `logic_server.py`.
+
+Posts charts to a running server (or one it starts with `--start`) from
+a number of client threads, each sending its next request when the last
+one is answered. Reports the throughput, the latency percentiles and the
+requests refused by the server's backpressure, as JSON. With `--cold N`,
+also times N fresh Python processes analyzing the first chart, which is
+what each request costs without the server.
+
+    python benchmarks/bench_server.py --start -j 4 [--requests 500] [--concurrency 16]
+        [--chart logic_data] [--segments 1000] [--truth-table] [--cold 5] [--output results.json]
+"""
+
+import argparse
+import httplib
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from logic_io import iter_named_sources, read_chart_source
+
+# ============================================================================
+
+DEFAULT_URL = "http://127.0.0.1:8765"
+START_TIMEOUT = 60.0 # Seconds to wait for a started server to answer
+
+COLD_SCRIPT = """
+import json, sys
+sys.path.insert(0, %r)
+from logic_batch import BatchOptions, analyze_chart
+print json.dumps(analyze_chart((0, None, ("text", sys.stdin.read()), BatchOptions(truth_table=%r))))
+"""
+
+# ============================================================================
+
+def load_bodies(args):
+    # Request bodies, one per chart
+    records = []
+    for chart_id, source in iter_named_sources(args.chart):
+        record_id, lines, labels = read_chart_source(source)
+        records.append({"id" : chart_id, "lines" : lines, "labels" : labels})
+    if args.segments:
+        from logic_synth import generate_chart
+        record = generate_chart(args.segments, seed=args.seed)
+        records.append({"id" : "synthetic_%d" % args.segments, "lines" : record["lines"]
+            , "labels" : record["labels"]})
+    for record in records:
+        record["truth_table"] = args.truth_table
+    return [json.dumps(record) for record in records]
+
+# ----------------------------------------------------------------------------
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+# ----------------------------------------------------------------------------
+
+def run_load(host, port, bodies, requests, concurrency):
+    # Closed loop load: (latencies of the answered requests, count per status, seconds)
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    counter = iter(xrange(requests))
+
+    def client():
+        connection = httplib.HTTPConnection(host, port, timeout=120)
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                break
+            t = time.time()
+            try:
+                connection.request("POST", "/analyze", bodies[i % len(bodies)]
+                    , {"Content-Type" : "application/json"})
+                response = connection.getresponse()
+                result = json.loads(response.read())
+                status = response.status
+                if status == 200 and result["error"] is not None:
+                    status = "chart error"
+            except (httplib.HTTPException, IOError) as e:
+                status = type(e).__name__
+                connection.close()
+                connection = httplib.HTTPConnection(host, port, timeout=120)
+            elapsed = time.time() - t
+            with lock:
+                statuses[status] = statuses.get(status, 0) + 1
+                if status == 200:
+                    latencies.append(elapsed)
+        connection.close()
+
+    start = time.time()
+    threads = [threading.Thread(target=client) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, statuses, time.time() - start
+
+# ----------------------------------------------------------------------------
+
+def server_status(host, port):
+    connection = httplib.HTTPConnection(host, port, timeout=10)
+    try:
+        connection.request("GET", "/status")
+        return json.loads(connection.getresponse().read())
+    finally:
+        connection.close()
+
+# ----------------------------------------------------------------------------
+
+def start_server(port, args):
+    command = [sys.executable, os.path.join(ROOT, "logic_server.py"), "--port", str(port)]
+    if args.processes:
+        command += ["-j", str(args.processes)]
+    server = subprocess.Popen(command)
+    deadline = time.time() + START_TIMEOUT
+    while True:
+        try:
+            server_status("127.0.0.1", port)
+            return server
+        except IOError:
+            if (server.poll() is not None) or (time.time() > deadline):
+                server.kill()
+                raise RuntimeError("The server didn't start")
+            time.sleep(0.2)
+
+# ----------------------------------------------------------------------------
+
+def time_cold(body, count, truth_table):
+    # Seconds taken by each of `count` fresh processes analyzing one chart
+    script = COLD_SCRIPT % (ROOT, truth_table)
+    timings = []
+    for i in range(count):
+        t = time.time()
+        process = subprocess.Popen([sys.executable, "-c", script], stdin=subprocess.PIPE
+            , stdout=subprocess.PIPE)
+        process.communicate(body)
+        timings.append(time.time() - t)
+    return timings
+
+# ============================================================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the latency and throughput of logic_server.py.")
+    parser.add_argument("--url", default=DEFAULT_URL, help="server to load (default: %(default)s)")
+    parser.add_argument("--start", action="store_true"
+        , help="start a server on the port of --url for the run, and stop it after")
+    parser.add_argument("-j", "--processes", type=int, help="worker processes of a started server")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16, help="client threads (default: %(default)s)")
+    parser.add_argument("--chart", action="append"
+        , help="charts to send in turn: logic_data, dataset_N, a chart JSON file or a batch (default: logic_data)")
+    parser.add_argument("--segments", type=int
+        , help="also send a generated chart of this many line segments")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--truth-table", action="store_true", help="ask for the truth tables too")
+    parser.add_argument("--cold", type=int, default=0, metavar="N"
+        , help="also time N fresh processes analyzing the first chart")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args(argv)
+    args.chart = args.chart or ["logic_data"]
+
+    url = urlparse.urlparse(args.url)
+    host, port = url.hostname, url.port or 80
+    bodies = load_bodies(args)
+
+    server = start_server(port, args) if args.start else None
+    try:
+        latencies, statuses, elapsed = run_load(host, port, bodies, args.requests, args.concurrency)
+        status = server_status(host, port)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report = {
+        "python" : platform.python_version()
+        , "platform" : platform.platform()
+        , "options" : dict((key, value) for key, value in vars(args).items() if key != "output")
+        , "seconds" : elapsed
+        , "throughput" : len(latencies) / elapsed
+        , "statuses" : dict((str(key), value) for key, value in statuses.items())
+        , "latency_ms" : dict((name, percentile(latencies, fraction) * 1000.0 if latencies else None)
+            for name, fraction in [("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0)])
+        , "server" : status
+        }
+    if args.cold:
+        timings = time_cold(bodies[0], args.cold, args.truth_table)
+        report["cold_ms"] = {"min" : min(timings) * 1000.0, "median" : percentile(timings, 0.5) * 1000.0}
+
+    sys.stderr.write("%d requests in %.2f s: %.1f per second, p50 %.1f ms, p99 %.1f ms, statuses %s\n"
+        % (args.requests, elapsed, report["throughput"], report["latency_ms"]["p50"] or 0
+            , report["latency_ms"]["p99"] or 0, report["statuses"]))
+    text = json.dumps(report, indent=2, sort_keys=True)
+    print text
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    return 0 if set(statuses) <= set([200]) else 1
+
+# ============================================================================
+
+if __name__ == '__main__':
+    sys.exit(main())
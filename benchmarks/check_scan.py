@@ -0,0 +1,65 @@
+"""Check that the scan tools chain: labels detected on a sample scan, then
+the wires extracted with those labels, and the chart written.
+
+    python benchmarks/check_scan.py [--image logic_chart_0.jpg]
+
+Exits non-zero if a step fails or its output is not the chart expected.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# ============================================================================
+
+def run(script, *args):
+    return subprocess.call([sys.executable, os.path.join(ROOT, script)] + list(args))
+
+# ----------------------------------------------------------------------------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run label detection, then wire extraction, on a scan.")
+    parser.add_argument("--image", default=os.path.join(ROOT, "logic_chart_0.jpg")
+        , help="scan to run on (default: the first sample scan)")
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp()
+    try:
+        labels_path = os.path.join(directory, "labels.json")
+        chart_path = os.path.join(directory, "chart.json")
+        if run("logic_detect.py", args.image, "-o", labels_path) != 0:
+            sys.stderr.write("logic_detect.py failed\n")
+            return 1
+        if run("logic_extract.py", args.image, "--labels", labels_path, "-o", chart_path) != 0:
+            sys.stderr.write("logic_extract.py failed\n")
+            return 1
+        with open(labels_path) as f:
+            labels = json.load(f)["labels"]
+        with open(chart_path) as f:
+            chart = json.load(f)
+    finally:
+        shutil.rmtree(directory)
+
+    problems = []
+    if not labels:
+        problems.append("no labels detected")
+    if not chart.get("lines"):
+        problems.append("no lines extracted")
+    if chart.get("labels") != labels:
+        problems.append("the chart doesn't have the detected labels")
+    for problem in problems:
+        sys.stderr.write("%s\n" % problem)
+    if not problems:
+        sys.stderr.write("%d labels, %d lines\n" % (len(labels), len(chart["lines"])))
+    return 1 if problems else 0
+
+# ============================================================================
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,16 +1,49 @@
+import time
+from contextlib import contextmanager
+
 import numpy as np
-import cv2
 
-from logic_data import *
 from logic_utils import *
 from logic_classes import *
+from logic_graph import VertexGraph
+from logic_index import BoxIndex, box_point_pairs, nearest_in_direction
+from logic_topology import WireTopology
+from logic_partition import find_components, trace_components
+from logic_archive import LabelArray
+from logic_normalize import normalize_lines
+from logic_expr import ExpressionDag
+from logic_eval import CompiledChart
+from logic_instrument import Instrumentation, null_phase, print_event
+
+# ============================================================================
+
+SLOPE_THRESHOLD = 5
+LINE_CONN_TOLERANCE = 30
+PARALLEL_MIN_LINES = 20000 # Smaller charts are traced in-process
+LABEL_MARGIN = 10 # Label boxes are inflated by this to catch line ends
+
+BINARY_GATES = ['AND', 'NAND', 'OR', 'NOR', 'XOR', 'XNOR']
+UNTYPED_GATE = 'GATE?' # Name prefix of gates found without their type, to be named before tracing
 
 # ============================================================================
 
 class Line(object):
-    def __init__(self, endpoints):
-        self.endpoints = endpoints
-        self.used = False
+    # Lightweight view of one line stored in a `LineSet`
+    def __init__(self, line_set, index):
+        self.line_set = line_set
+        self.index = index
+        
+    @property
+    def endpoints(self):
+        return self.line_set.get_endpoints(self.index)
+        
+    @property
+    def used(self):
+        return bool(self.line_set.used[self.index])
+        
+    @used.setter
+    def used(self, value):
+        self.line_set.used[self.index] = value
         
     def __str__(self):
         return "{%s -> %s}" % tuple(self.endpoints)
@@ -28,16 +61,59 @@ class Line(object):
     def point_distance(self, point):
         return point_to_line_dist(np.asarray(point), np.asarray(self.endpoints))
        
+# ----------------------------------------------------------------------------
+
+class LineSet(object):
+    # Line endpoints stored as a contiguous (N, 2, 2) array, with a used mask
+    def __init__(self, endpoints):
+        self.endpoints = np.asarray(endpoints).reshape(-1, 2, 2)
+        self.used = np.zeros(len(self.endpoints), dtype=bool)
+        
+    def __len__(self):
+        return len(self.endpoints)
+        
+    def __getitem__(self, index):
+        return Line(self, index)
+        
+    def __iter__(self):
+        for i in range(len(self)):
+            yield Line(self, i)
+            
+    def get_endpoints(self, index):
+        p1, p2 = self.endpoints[index].tolist()
+        return (tuple(p1), tuple(p2))
        
 # ============================================================================
 
 def connect_vertices(input, output):
-    input.add_output(output)
-    output.add_input(input)
+    input.graph.connect(input.index, output.index)
+    
+# ----------------------------------------------------------------------------
+
+def label_distance(point, vertex):
+    # Distance to a label as drawn, without the margin of its box
+    return point_bbox_distance(point, inflate_bbox(vertex.bounding_box, -LABEL_MARGIN))
+    
+# ----------------------------------------------------------------------------
+
+def output_pin(vertex):
+    # Middle of the right edge of a label as drawn, where its output leaves
+    (x0, y0), (x1, y1) = vertex.bounding_box
+    return (x1 - LABEL_MARGIN, (y0 + y1) / 2.0)
+    
+# ----------------------------------------------------------------------------
+
+def on_output_side(point, vertex):
+    # In the right half of a label, nearer its output pin than its inputs
+    return point[0] >= bbox_center(vertex)[0]
     
 # ----------------------------------------------------------------------------
 
-def find_connected_in_elements(elements, endpoint):
+def find_connected_in_elements(elements, endpoint, index=None):
+    if index is not None:
+        # The index already did the containment test
+        return [elements[i] for i in index.query_point(endpoint)]
+
     connected_elements = []
     for element in elements:
         if element.contains_point(endpoint):
@@ -46,108 +122,226 @@ def find_connected_in_elements(elements, endpoint):
     
 # ============================================================================
 
+def pair_bridge_nodes(centers, ends, slope_threshold, instrumentation=None):
+    """Pair up the nodes of the bridges.
+    
+    A bridge is a pair of nodes, one on each side of the wire it crosses. A
+    vertical line ends in the upper node and continues from the lower one,
+    the nearest node steeply below it (and vice versa). `ends` lists the
+    vertical line ends in each node, as 2 * line id + end (1 for the bottom).
+    
+    Returns the links per direction (down is True), node id -> (partner id,
+    line id leaving the partner), and the list of problems found.
+    """
+    links = {True : {}, False : {}}
+    problems = []
+    location = lambda i: "(%.0f, %.0f)" % tuple(centers[i])
+    upper = [] # Pairs of (node id, line id)
+    lower = []
+    for i, node_ends in enumerate(ends):
+        if len(node_ends) != 1:
+            problems.append("%d lines end in node at %s" % (len(node_ends), location(i)))
+        elif node_ends[0] % 2: # Bottom end
+            upper.append((i, node_ends[0] // 2))
+        else:
+            lower.append((i, node_ends[0] // 2))
+    
+    select = lambda pairs: [centers[i] for i, j in pairs]
+    below = nearest_in_direction(select(upper), select(lower), slope_threshold, True)[0]
+    above = nearest_in_direction(select(lower), select(upper), slope_threshold, False)[0]
+    if instrumentation is not None:
+        instrumentation.count("distance_evaluations", 2 * len(upper) * len(lower))
+    
+    paired = set()
+    for a, (i, line) in enumerate(upper):
+        b = below[a]
+        if b < 0:
+            continue
+        if above[b] != a:
+            problems.append("ambiguous pairing of node at %s" % location(i))
+            continue
+        j, other_line = lower[b]
+        links[True][i] = (j, other_line)
+        links[False][j] = (i, line)
+        paired.update([i, j])
+        
+    for i, line in upper + lower:
+        if i not in paired:
+            problems.append("unpaired node at %s" % location(i))
+    return links, problems
+
+# ============================================================================
+
 class DataSet(object):
-    def __init__(self, lines, labels):
-        self._initialize_lines(lines)
-        self._initialize_labels(labels)
+    def __init__(self, lines, labels, tolerance=LINE_CONN_TOLERANCE
+            , slope_threshold=SLOPE_THRESHOLD, instrumentation=None, topology=None):
+        self.tolerance = tolerance
+        self.slope_threshold = slope_threshold
+        self.instrumentation = instrumentation # Optional `Instrumentation`
+        
+        with self._phase("lines"):
+            self._initialize_lines(lines)
+        with self._phase("topology"):
+            self._initialize_topology(topology)
+        with self._phase("labels"):
+            self._initialize_labels(labels)
         
-        self.junctions = [] # Will be populated later
-        self.connections = [] # Ditto
+        self.tasks = [] # Pending steps of the trace, see `_run_tasks`
+        
+        self._expression_dag = None # Built on demand, after analysis
         
     def _initialize_lines(self, lines):
         # Split lines into horizontal and vertical
         # Note: Assuming line endpoints are sorted per line.
         # -- for horizontal x1 < x2, for vertical y1 < y2
         
-        self.lines_h = [] 
-        self.lines_v = []
+        lines = np.asarray(lines).reshape(-1, 2, 2)
+        horizontal = are_lines_horizontal(lines)
+        
+        self.lines_h = LineSet(lines[horizontal])
+        self.lines_v = LineSet(lines[~horizontal])
+        
+    def _initialize_topology(self, topology):
+        # All the contacts between the lines, found once up front so that
+        # tracing only looks them up. A table built earlier for the same
+        # lines can be passed in.
+        if topology is None:
+            topology = WireTopology.build(self.lines_h.endpoints, self.lines_v.endpoints, self.tolerance)
+        elif ((topology.count_h, topology.count_v) != (len(self.lines_h), len(self.lines_v))
+                or (topology.tolerance != self.tolerance)):
+            raise ValueError("Topology does not match the lines")
+        self.topology = topology
+        if self.instrumentation is not None:
+            self.instrumentation.count("topology.contacts", len(topology))
+            
+    def mark_h_line_used(self, index):
+        self.lines_h.used[index] = True
         
-        for line in lines:
-            l = Line(line)
-            if l.is_horizontal:
-                self.lines_h.append(l)
-            else:
-                self.lines_v.append(l)
+    def mark_v_line_used(self, index):
+        self.lines_v.used[index] = True
     
     def _initialize_labels(self, labels):
+        # All the vertices live in the graph, labels first. Labels are kept
+        # as given, for tracing parts of the chart apart
+        if isinstance(labels, LabelArray):
+            self.labels = labels
+            margin = np.array([[-LABEL_MARGIN], [LABEL_MARGIN]])
+            label_items = zip(labels.names, (labels.boxes + margin).tolist())
+        else:
+            self.labels = list(labels)
+            label_items = [(label[0], inflate_bbox(label[1:4], LABEL_MARGIN)) for label in self.labels]
+            
+        self.graph = VertexGraph()
+        add_vertex = self.graph.add_vertex
+        
         # Split up labels into distinct types
         self.nodes = []
         self.gates = []
         self.inputs = []
         self.outputs = []
 
-        for label in labels:
-            label_name, label_bbox = label[0], inflate_bbox(label[1:4], 10)
+        for label_name, label_bbox in label_items:
             if label_name == 'NODE':
-                self.nodes.append(Node(label_bbox))
+                self.nodes.append(add_vertex(Node, None, label_bbox))
             elif label_name == 'OUTPUT':
-                self.outputs.append(OutputTerm(label_name, label_bbox))
+                self.outputs.append(add_vertex(OutputTerm, label_name, label_bbox))
             elif label_name == 'NOT':
-                self.gates.append(UnaryGate(label_name, label_bbox))
-            elif label_name in ['AND', 'NAND', 'OR', 'NOR', 'XOR', 'XNOR']:
-                self.gates.append(BinaryGate(label_name, label_bbox))
+                self.gates.append(add_vertex(UnaryGate, label_name, label_bbox))
+            elif label_name in BINARY_GATES:
+                self.gates.append(add_vertex(BinaryGate, label_name, label_bbox))
+            elif label_name.startswith(UNTYPED_GATE):
+                raise RuntimeError("Gate '%s' has no type, name it one of NOT, %s"
+                    % (label_name, ", ".join(BINARY_GATES)))
             else:
-                self.inputs.append(InputTerm(label_name, label_bbox))
+                self.inputs.append(add_vertex(InputTerm, label_name, label_bbox))
+                
+        if self.instrumentation is not None:
+            for collection in [self.nodes, self.gates, self.inputs, self.outputs]:
+                for element in collection:
+                    self._count_vertex(element)
+                
+        self._initialize_label_index()
+        self._initialize_node_links()
+        
+    def _initialize_label_index(self):
+        # Box index per collection, for "which label contains this endpoint"
+        make_index = lambda elements: BoxIndex([e.bounding_box for e in elements])
+        self.node_index = make_index(self.nodes)
+        self.gate_index = make_index(self.gates)
+        self.input_index = make_index(self.inputs)
+        self.output_index = make_index(self.outputs)
+            
+        # The reverse query -- which lines start in this gate/input -- is
+        # answered by stabbing the same indices once per line startpoint
+        self.h_line_starts = {True : {}, False : {}}
+        for forward in [True, False]:
+            line_starts = self.h_line_starts[forward]
+            startpoints = self.lines_h.endpoints[:, 0 if forward else 1].tolist()
+            for elements, index in [(self.gates, self.gate_index), (self.inputs, self.input_index)]:
+                for i, startpoint in enumerate(startpoints):
+                    for j in index.query_point(startpoint):
+                        line_starts.setdefault(elements[j], []).append(i)
+                
+    def _initialize_node_links(self):
+        # Pair all the bridges up front, for `process_node` to look up
+        self.node_links = {True : {}, False : {}} # Node -> (partner id, line id)
+        self.node_problems = []
+        if not self.nodes:
+            return
+            
+        ends = [[] for node in self.nodes] # Vertical line ends in each node
+        box_ids, point_ids = box_point_pairs([node.bounding_box for node in self.nodes]
+            , self.lines_v.endpoints.reshape(-1, 2))
+        for i, point in zip(box_ids.tolist(), point_ids.tolist()):
+            ends[i].append(point)
+            
+        links, self.node_problems = pair_bridge_nodes([bbox_center(node) for node in self.nodes]
+            , ends, self.slope_threshold, self.instrumentation)
+        for down in [True, False]:
+            for i, link in links[down].items():
+                self.node_links[down][self.nodes[i]] = link
                 
     def validate(self):
-        all_lines_used = True
-        for line in self.lines_h + self.lines_v:
-            all_lines_used = all_lines_used and line.used
+        with self._phase("validation"):
+            self._validate()
+            
+    def _validate(self):
+        all_lines_used = self.lines_h.used.all() and self.lines_v.used.all()
 
         if not all_lines_used:
             raise RuntimeError("Some lines remain unused.")
             
-        collections = [
-            self.nodes
-            , self.gates
-            , self.inputs
-            , self.outputs
-            , self.junctions
-            , self.connections
-            ]
-
-        for collection in collections:
-            for element in collection:
-                element.validate()
+        self.graph.validate()
+        
+    @property
+    def junctions(self):
+        return self.graph.vertices(Junction)
+        
+    @property
+    def connections(self):
+        return self.graph.vertices(Connection)
 
 # ----------------------------------------------------------------------------
 
     def process_node(self, source, down):
-        # Find other nodes below/above this one
-        matches = []
-        for i, node in enumerate(self.nodes):
-            if node != source:
-                dist, slope = bbox_distance_slope(source, node)
-                print dist, slope
-                if (slope < -SLOPE_THRESHOLD) or (slope > SLOPE_THRESHOLD):
-                    matches.append((dist, slope, i))
-
-        if len(matches) == 0:
+        # The bridge partner and the line leaving it were found up front
+        link = self.node_links[down].get(source)
+        if link is None:
             raise RuntimeError("No matching node")
-                    
-        matches = sorted(matches, key=lambda l: l[0], reverse=True)
+        target_index, line_index = link
         
-        print "NODE: %s (node_id=%d)" % (("Down" if down else "Up"), matches[0][2])
-        target = self.nodes[matches[0][2]]
+        if self.instrumentation is not None:
+            self.instrumentation.event("node", down=down, node=target_index)
+        target = self.nodes[target_index]
         connect_vertices(source, target)
         
-        connected_lines = []
-        for i, vline in enumerate(self.lines_v):
-            if vline.used:
-                continue
-            startpoint_v = vline.get_startpoint(down)
-            if target.contains_point(startpoint_v):
-                connected_lines.append(i)
-        
-        if len(connected_lines) != 1:
+        if self.lines_v.used[line_index]:
             raise RuntimeError("Invalid number of node connections")
             
-        cline = self.lines_v[connected_lines[0]]
-        self.lines_v[connected_lines[0]].used = True
+        cline = self.lines_v[line_index]
+        self.mark_v_line_used(line_index)
         
-        self.process_v_line(target, cline, down)
-        
-        print "NODE: Done"
+        self._schedule(self.process_v_line, target, cline, down)
    
 # ----------------------------------------------------------------------------
 
@@ -155,18 +349,20 @@ class DataSet(object):
         candidate_lines_r = []
         candidate_lines_l = []
         
-        endpoint_v = line.get_endpoint(down)
+        self._check_tolerance(tolerance)
+        contacts = self.topology.v_end_contacts(line.index, down)
+        instr = self.instrumentation
+        if instr is not None:
+            instr.count("queries.h_lines")
+            instr.count("candidates.h_lines", len(contacts))
         
-        for i, h_line in enumerate(self.lines_h):
-            if h_line.used:
+        used = self.lines_h.used
+        for i, near_left, near_right in contacts:
+            if used[i]:
                 continue
-        
-            d_left = point_distance(h_line.get_startpoint(True), endpoint_v)
-            d_right = point_distance(h_line.get_startpoint(False), endpoint_v)
-        
-            if d_left < tolerance:
+            if near_left:
                 candidate_lines_r.append(i)
-            if d_right < tolerance:
+            if near_right:
                 candidate_lines_l.append(i)
 
         return candidate_lines_l, candidate_lines_r
@@ -175,150 +371,176 @@ class DataSet(object):
 
     def process_v_line(self, source, line, down):
         endpoint_v = line.get_endpoint(down)
-        print "VLINE: %s (endpoint=%s)" % (("Down" if down else "Up"), endpoint_v)
+        instr = self.instrumentation
+        if instr is not None:
+            instr.event("v_line", down=down, endpoint=endpoint_v)
         
-        connected_nodes = find_connected_in_elements(self.nodes, endpoint_v)
+        connected_nodes = self._find_in_elements("nodes", self.nodes, endpoint_v, self.node_index)
            
         if len(connected_nodes) > 1:
-            raise RuntimeError("Too many connected nodes.")
-        elif len(connected_nodes) > 0:
+            connected_nodes = [self._choose(connected_nodes, "Too many connected nodes."
+                , lambda node: point_distance(endpoint_v, bbox_center(node)))]
+        if len(connected_nodes) > 0:
             node = connected_nodes[0]
             
             connect_vertices(source, node)
-            self.process_node(node, down)
+            self._schedule(self.process_node, node, down)
             return
         
-        candidate_lines_l, candidate_lines_r = self.find_connected_h_lines(line, LINE_CONN_TOLERANCE, down)
+        candidate_lines_l, candidate_lines_r = self.find_connected_h_lines(line, self.tolerance, down)
         
-        if len(candidate_lines_r) + len(candidate_lines_l) != 1:
+        # (line id, going right) per candidate
+        candidates = [(i, True) for i in candidate_lines_r] + [(i, False) for i in candidate_lines_l]
+        if len(candidates) > 1:
+            candidates = [self._choose(candidates, "Invalid number of connections"
+                , lambda c: point_distance(endpoint_v, self.lines_h[c[0]].get_startpoint(c[1])))]
+        if len(candidates) != 1:
             raise RuntimeError("Invalid number of connections")
 
-        going_right = len(candidate_lines_r) > len(candidate_lines_l)
-        index = candidate_lines_r[0] if going_right else candidate_lines_l[0]
+        index, going_right = candidates[0]
         line = self.lines_h[index]
-        self.lines_h[index].used = True # Mark used
+        self.mark_h_line_used(index)
         
-        print "VLINE: Connection (index=%d, line=%s, right=%s)" % (index, line, going_right)
+        if instr is not None:
+            instr.event("v_line_connection", index=index, line=line.endpoints, right=going_right)
         
-        vertex = Connection(None)
-        self.connections.append(vertex)
+        vertex = self.graph.add_vertex(Connection)
+        self._count_vertex(vertex)
         connect_vertices(source, vertex)
         
-        self.process_h_line(vertex, line, going_right)
-        
-        print "VLINE: Done"
+        self._schedule(self.process_h_line, vertex, line, going_right)
 
 # ----------------------------------------------------------------------------
 
     def find_connected_v_lines(self, line, tolerance, forward):
         connected_lines = []
-        for i, vline in enumerate(self.lines_v):
-            if vline.used:
-                continue # Line already used
-            
-            d_top = line.point_distance(vline.get_startpoint(True))
-            d_bottom = line.point_distance(vline.get_startpoint(False))
-            
-            intersect_top = (d_top <= tolerance)
-            intersect_bottom = (d_bottom <= tolerance)
+        self._check_tolerance(tolerance)
+        used = self.lines_v.used
+        contacts = [c for c in self.topology.h_line_contacts(line.index) if not used[c[0]]]
+        instr = self.instrumentation
+        if instr is not None:
+            instr.count("queries.v_lines")
+            instr.count("candidates.v_lines", len(contacts))
             
+        endpoint_h = line.get_endpoint(forward)
+        for i, intersect_top, intersect_bottom in contacts:
             if intersect_top and intersect_bottom:
-                raise RuntimeError("Both ends of vline intersect hline")
+                v_line = self.lines_v[i]
+                intersect_top = self._choose([True, False], "Both ends of vline intersect hline"
+                    , lambda top: line.point_distance(v_line.get_startpoint(top)))
                 
-            if intersect_top or intersect_bottom:
-                endpoint_h = line.get_endpoint(forward)
-                endpoint_v = vline.get_endpoint(intersect_top)
-                endpoint_dist = point_distance(endpoint_h, endpoint_v)
-                connected_lines.append((intersect_top, endpoint_dist, i))
+            endpoint_v = self.lines_v[i].get_endpoint(intersect_top)
+            endpoint_dist = point_distance(endpoint_h, endpoint_v)
+            connected_lines.append((intersect_top, endpoint_dist, i))
                 
         return connected_lines
 
 # ----------------------------------------------------------------------------
 
-    def process_connected_v_lines(self, source, connected_lines, tolerance):
-        has_end_connection = False
-        current_source = source
+    def process_connected_v_lines(self, line, forward, source, connected_lines, tolerance):
+        # One scheduled step per line, each passing its vertex on to the
+        # next as the source, and the last one on to the line end
         
         # Start from the furthest connection from the end
         connected_lines = sorted(connected_lines, key=lambda l: l[1], reverse=True)
+        
+        # Only the last one may be the end connection
+        end_lines = [l for l in connected_lines if l[1] <= tolerance]
+        if len(end_lines) > 1:
+            end_line = self._choose(end_lines, "Only one end connection allowed.", lambda l: l[1])
+            connected_lines.remove(end_line)
+            connected_lines.append(end_line)
+            
+        if len(connected_lines) > 0:
+            self._schedule(self._process_connected_v_line, line, forward, source, connected_lines, 0
+                , tolerance)
+        else:
+            self._schedule(self._process_h_line_end, line, forward, connected_lines, False, source)
+        
+    def _process_connected_v_line(self, line, forward, source, connected_lines, i, tolerance):
+        cline = connected_lines[i]
+        down, dist, index = cline
+        v_line = self.lines_v[index]
 
-        for i, cline in enumerate(connected_lines):
-            down, dist, index = cline
-            v_line = self.lines_v[index]
-
-            print "* Processing connected line #%d (%s, %s)" % (i, cline, v_line)
+        if self.instrumentation is not None:
+            self.instrumentation.event("connected_v_line", number=i, index=index, down=down, dist=dist)
 
-            self.lines_v[index].used = True # Mark line as used
-            
-            if dist > tolerance: # Junction in the line
-                vertex = Junction(None)
-                self.junctions.append(vertex)            
-            else: # End connection
-                if i != len(connected_lines) - 1:
-                    raise RuntimeError("Only one end connection allowed.")
-                has_end_connection = True
-                vertex = Connection(None)
-                self.connections.append(vertex)
-                
-            connect_vertices(current_source, vertex)
-            self.process_v_line(vertex, v_line, down)
-            current_source = vertex
+        self.mark_v_line_used(index)
+        
+        last = i == len(connected_lines) - 1
+        if last and (dist <= tolerance): # End connection
+            vertex = self.graph.add_vertex(Connection)
+        else: # Junction in the line
+            vertex = self.graph.add_vertex(Junction)
+        self._count_vertex(vertex)
             
-        return has_end_connection, current_source
+        connect_vertices(source, vertex)
+        
+        if last:
+            self._schedule(self._process_h_line_end, line, forward, connected_lines, dist <= tolerance
+                , vertex)
+        else:
+            self._schedule(self._process_connected_v_line, line, forward, vertex, connected_lines, i + 1
+                , tolerance)
+        self._schedule(self.process_v_line, vertex, v_line, down)
     
 # ----------------------------------------------------------------------------
     
     def process_h_line(self, source, line, forward):
-        print "* Processing horizontal line %s (forward=%s)" % (line, forward)
+        if self.instrumentation is not None:
+            self.instrumentation.event("h_line", line=line.endpoints, forward=forward)
       
         # Find any vertical lines that connect to this
-        connected_lines = self.find_connected_v_lines(line, LINE_CONN_TOLERANCE, forward)
+        connected_lines = self.find_connected_v_lines(line, self.tolerance, forward)
       
-        # Process all the vertical connecting lines    
-        has_end_connection, current_source = self.process_connected_v_lines(source, connected_lines, LINE_CONN_TOLERANCE)
-
+        # Process all the vertical connecting lines, then the line end
+        self.process_connected_v_lines(line, forward, source, connected_lines, self.tolerance)
+        
+    def _process_h_line_end(self, line, forward, connected_lines, has_end_connection, current_source):
         endpoint_h = line.get_endpoint(forward)
            
         connected_gates = []
         if not has_end_connection:
             # Find connected gates
-            connected_gates = find_connected_in_elements(self.gates, endpoint_h)
+            connected_gates = self._find_in_elements("gates", self.gates, endpoint_h, self.gate_index)
                
             if len(connected_gates) > 1:
-                raise RuntimeError("Too many connected gates.")
-            elif len(connected_gates) > 0:
+                connected_gates = [self._choose(connected_gates, "Too many connected gates."
+                    , lambda gate: label_distance(endpoint_h, gate))]
+            if len(connected_gates) > 0:
                 gate = connected_gates[0]
-                print "End in gate %s -- %s" % (gate.name, endpoint_h)
+                if self.instrumentation is not None:
+                    self.instrumentation.event("end_in_gate", gate=gate.name, endpoint=endpoint_h)
                 connect_vertices(current_source, gate)
-                self.process_gate(gate)
+                self._schedule(self.process_gate, gate)
+                return
 
         connected_outputs = []        
         if (not has_end_connection) and (len(connected_gates) == 0):
             # Find connected outputs
-            connected_outputs = find_connected_in_elements(self.outputs, endpoint_h)
+            connected_outputs = self._find_in_elements("outputs", self.outputs, endpoint_h, self.output_index)
                     
             if len(connected_outputs) > 1:
-                raise RuntimeError("Too many connected outputs.")                
-            elif len(connected_outputs) > 0:
+                connected_outputs = [self._choose(connected_outputs, "Too many connected outputs."
+                    , lambda output: label_distance(endpoint_h, output))]
+            if len(connected_outputs) > 0:
                 output = connected_outputs[0]
-                print "End in output %s" % output.name   
+                if self.instrumentation is not None:
+                    self.instrumentation.event("end_in_output", output=output.name, endpoint=endpoint_h)
                 connect_vertices(current_source, output)
                 # Nothing else to do with an output
             
         if (len(connected_lines) + len(connected_gates) + len(connected_outputs)) == 0:
             raise RuntimeError("Nothing connected")
-            
-        print "HLINE: Done"
 
 # ----------------------------------------------------------------------------
 
     def find_output_h_lines(self, source, forward):
         connected_line_ids = []
-        for i, hline in enumerate(self.lines_h):
-            if hline.used: # Already used
+        for i in self.h_line_starts[forward].get(source, []):
+            if self.lines_h[i].used: # Already used
                 continue
-            if source.contains_point(hline.get_startpoint(forward)):
-                connected_line_ids.append(i)
+            connected_line_ids.append(i)
         return connected_line_ids
 
 # ----------------------------------------------------------------------------
@@ -326,20 +548,29 @@ class DataSet(object):
     def process_output_h_line(self, source, id, forward):
         current_line = self.lines_h[id]
         # Mark line as used
-        self.lines_h[id].used = True
+        self.mark_h_line_used(id)
         
-        self.process_h_line(source, current_line, forward)
+        self._schedule(self.process_h_line, source, current_line, forward)
 
 # ----------------------------------------------------------------------------
 
     def process_out_element(self, source, element_type):
-        print "Processing %s '%s'..." % (element_type, source.name)
-        
+        if self.instrumentation is not None:
+            self.instrumentation.event("out_element", type=element_type, name=source.name)
         connected_line_ids = self.find_output_h_lines(source, True)
 
+        if (len(connected_line_ids) > 1) and isinstance(source, Gate):
+            # A line fed back into a gate starts in it too, but away from
+            # its output side
+            output_ids = [i for i in connected_line_ids
+                if on_output_side(self.lines_h[i].get_startpoint(True), source)]
+            connected_line_ids = output_ids or connected_line_ids
         if len(connected_line_ids) > 1:
-            raise RuntimeError("More than one line from %s '%s'." % (element_type, source.name))
-        elif len(connected_line_ids) > 0:
+            pin = output_pin(source)
+            connected_line_ids = [self._choose(connected_line_ids
+                , "More than one line from %s '%s'." % (element_type, source.name)
+                , lambda i: point_distance(pin, self.lines_h[i].get_startpoint(True)))]
+        if len(connected_line_ids) > 0:
             self.process_output_h_line(source, connected_line_ids[0], True)
         else:
             # Nothing to do... we may have already processed connection line
@@ -350,35 +581,281 @@ class DataSet(object):
 
     def process_gate(self, source):
         self.process_out_element(source, "gate")
-        print "GATE: '%s' done." % source.name
 
 # ----------------------------------------------------------------------------
     
     def process_input(self, input):
         self.process_out_element(input, "input")
-        print "INPUT: '%s' done." % input.name
         
 # ----------------------------------------------------------------------------
 
-    def analyze(self):
-        for input in self.inputs:
-            self.process_input(input)
+    # The trace is driven by an explicit stack of pending steps, rather than
+    # by the process_* methods calling each other recursively. Each step
+    # schedules whatever has to happen after it first, and the next step to
+    # take last, so the steps run in the same (depth first) order as a
+    # recursive walk would, but in bounded stack space.
+
+    def _schedule(self, task, *args):
+        self.tasks.append((task, args))
+        
+    def _run_tasks(self):
+        tasks = self.tasks
+        try:
+            while tasks:
+                task, args = tasks.pop()
+                task(*args)
+        finally:
+            # Don't leave stale steps behind if the trace failed
+            del tasks[:]
+            
+    def analyze(self, processes=1):
+        # With `processes` other than 1 (None for the CPU count), the
+        # independent parts of a big chart are traced on a process pool
+        if self.node_problems:
+            raise RuntimeError("Invalid node bridges: %s" % "; ".join(self.node_problems))
+            
+        self._expression_dag = None
+        with self._phase("tracing"):
+            if (processes != 1) and (len(self.lines_h) + len(self.lines_v) >= PARALLEL_MIN_LINES):
+                components = [c for c in find_components(self) if c.input_positions]
+                if len(components) > 1:
+                    trace_components(self, components, processes)
+                    return
+            for input in self.inputs:
+                self._schedule(self.process_input, input)
+                self._run_tasks()
+            
+# ----------------------------------------------------------------------------
+
+    # Instrumentation helpers, no-ops unless an `Instrumentation` is attached
+    
+    def _phase(self, name):
+        if self.instrumentation is None:
+            return null_phase()
+        return self.instrumentation.phase(name)
+        
+    def _check_tolerance(self, tolerance):
+        if tolerance != self.topology.tolerance:
+            raise ValueError("The topology was built for tolerance %s" % self.topology.tolerance)
+            
+    def _count_vertex(self, vertex):
+        if self.instrumentation is not None:
+            self.instrumentation.count("vertices." + type(vertex).__name__)
+            
+    def _choose(self, candidates, error, distance):
+        # Several candidates for one connection: a plain trace gives up. See
+        # `logic_resolve` for one that searches, scoring them by `distance`
+        raise RuntimeError(error)
+        
+    def _find_in_elements(self, kind, elements, endpoint, index):
+        if self.instrumentation is not None:
+            self.instrumentation.count("queries." + kind)
+            self.instrumentation.count("candidates." + kind, len(index.candidates(endpoint)))
+        return find_connected_in_elements(elements, endpoint, index)
             
 # ----------------------------------------------------------------------------
     
+    @property
+    def expression_dag(self):
+        if self._expression_dag is None:
+            with self._phase("expressions"):
+                self._expression_dag = graph_expression_dag(self.graph)
+        return self._expression_dag
+    
     @property
     def expressions(self):
-        result = []
+        return self.expression_dag.render()
+        
+    @property
+    def shared_expressions(self):
+        # Shared subterms bound once to temporaries, then the outputs
+        return self.expression_dag.render_shared()
+        
+    @property
+    def feedback_loops(self):
+        # Gates feeding back into each other, as `FeedbackLoop`s
+        return self.expression_dag.loops
+        
+    @property
+    def feedback_expressions(self):
+        # Next value of each state term the loops were cut into
+        return self.expression_dag.render_states()
         
-        for output in self.outputs:
-            result.append(output.expression)
+    def compile(self):
+        # Evaluator of the traced graph, with inputs in label order
+        return CompiledChart(self.expression_dag, [input.name for input in self.inputs])
         
-        return result
+    def truth_table(self):
+        return self.compile().truth_table()
+
+# ============================================================================
+
+def graph_expression_dag(graph):
+    # Only the gates matter, skip the wiring. Feedback loops are found in
+    # one pass, and cut into state terms so the rest renders as usual.
+    graph = graph.collapse()
+    return ExpressionDag.from_outputs(graph.vertices(OutputTerm), graph.feedback_loops())
+
+# ----------------------------------------------------------------------------
+
+class AnalysisResult(object):
+    # Outcome of `analyze`, the traced `DataSet` and its products. A result
+    # from a `ResultCache` only has the traced graph (and the expressions,
+    # if they were stored), `dataset` is None.
+    def __init__(self, dataset, graph=None, expressions=None):
+        self.dataset = dataset
+        self.graph = graph if dataset is None else dataset.graph
+        self._expressions = expressions
+        self._expression_dag = None
+        self.normalization = None # Summary of `normalize_lines`, if it was run
+        self.resolution = None # How ambiguous connections were resolved, see `logic_resolve`
+        
+    @property
+    def instrumentation(self):
+        return self.dataset.instrumentation if self.dataset is not None else None
+        
+    @property
+    def input_names(self):
+        return [input.name for input in self.graph.vertices(InputTerm)]
+        
+    @property
+    def expression_dag(self):
+        if self.dataset is not None:
+            return self.dataset.expression_dag
+        if self._expression_dag is None:
+            self._expression_dag = graph_expression_dag(self.graph)
+        return self._expression_dag
+        
+    @property
+    def expressions(self):
+        if self._expressions is not None:
+            return list(self._expressions)
+        return self.expression_dag.render()
+        
+    @property
+    def shared_expressions(self):
+        return self.expression_dag.render_shared()
+        
+    @property
+    def feedback_loops(self):
+        return self.expression_dag.loops
+        
+    @property
+    def feedback_expressions(self):
+        return self.expression_dag.render_states()
+        
+    def compile(self):
+        return CompiledChart(self.expression_dag, self.input_names)
+        
+    def truth_table(self):
+        return self.compile().truth_table()
+
+# ----------------------------------------------------------------------------
+
+class AnalysisProgress(object):
+    # How far `analyze` got: the stage running (or the last one), the time
+    # spent per stage and the summaries made so far. Lets a caller tell
+    # where a failure happened, and add stages of its own.
+    def __init__(self):
+        self.stage = None
+        self.timing = {} # Stage name -> seconds
+        self.normalization = None
+        self.resolution = None
+        self.cached = False
+        
+    @contextmanager
+    def step(self, stage):
+        self.stage = stage
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timing[stage] = self.timing.get(stage, 0.0) + time.time() - start
+
+# ----------------------------------------------------------------------------
+
+def analyze(lines, labels, tolerance=LINE_CONN_TOLERANCE
+        , slope_threshold=SLOPE_THRESHOLD, validate=True, instrumentation=None, processes=1
+        , cache=None, normalize=False, resolve=False, progress=None):
+    """Trace the chart given by the lines and labels, without printing.
+
+    Pass an `Instrumentation` to collect counters, phase timings and trace
+    events, available as `instrumentation` of the result. Big charts made of
+    independent parts can be traced on several `processes` (None for the
+    CPU count). With a `ResultCache`, a chart analyzed before is not traced
+    again. With `normalize`, the fragments of broken wires are merged and
+    duplicate lines dropped first (see `normalize_lines`), and the result's
+    `normalization` tells how many lines were removed. With `resolve`,
+    ambiguous connections are searched over rather than failing (see
+    `logic_resolve`), in-process and uncached, and the result's
+    `resolution` tells how sure the trace is. An `AnalysisProgress` passed
+    as `progress` is kept up to date, failures included.
+
+    Raises RuntimeError if the chart can't be traced, or (if `validate` is
+    set) the resulting graph is not valid.
+    """
+    if progress is None:
+        progress = AnalysisProgress()
+    if normalize:
+        with progress.step("normalize"):
+            with (instrumentation.phase("normalize") if instrumentation is not None else null_phase()):
+                lines, progress.normalization = normalize_lines(lines)
+        if instrumentation is not None:
+            removed = progress.normalization["lines_in"] - progress.normalization["lines_out"]
+            instrumentation.count("normalize.removed", removed)
+            
+    key = expressions = None
+    if (cache is not None) and not resolve:
+        from logic_cache import CacheEntry, chart_key
+        with progress.step("cache"):
+            key = chart_key(lines, labels, tolerance, slope_threshold)
+            entry = cache.get(key)
+        if entry is not None:
+            progress.cached = True
+            with progress.step(entry.stage or "cache"):
+                result = entry.result(validate)
+            result.normalization = progress.normalization
+            return result
+            
+    with progress.step("analyze"):
+        if resolve:
+            from logic_resolve import ResolvingDataSet
+            ds = ResolvingDataSet(lines, labels, tolerance, slope_threshold, instrumentation)
+            ds.analyze()
+            progress.resolution = ds.resolution
+        else:
+            try:
+                ds = DataSet(lines, labels, tolerance, slope_threshold, instrumentation)
+                ds.analyze(processes)
+            except RuntimeError as e:
+                if key is not None:
+                    cache.put(key, CacheEntry(error=str(e), stage="analyze"))
+                raise
+                
+    if validate or (key is not None):
+        with progress.step("validate"):
+            try:
+                ds.validate()
+            except RuntimeError as e:
+                if key is not None:
+                    cache.put(key, CacheEntry(ds.graph, error=str(e), stage="validate"))
+                if validate:
+                    raise
+            else:
+                if key is not None:
+                    expressions = ds.expressions
+                    cache.put(key, CacheEntry(ds.graph, expressions))
+                    
+    result = AnalysisResult(ds, expressions=expressions)
+    result.normalization = progress.normalization
+    result.resolution = progress.resolution
+    return result
 
 # ============================================================================
 
 def process_raw_data(lines, labels):
-    ds = DataSet(lines, labels)
+    instrumentation = Instrumentation(sink=print_event)
+    ds = DataSet(lines, labels, instrumentation=instrumentation)
 
     ds.analyze()
 
@@ -392,13 +869,26 @@ def process_raw_data(lines, labels):
 
     for expression in ds.expressions:
         print expression
+        
+    for loop in ds.feedback_loops:
+        print "%s:" % loop
+    for expression in ds.feedback_expressions:
+        print "    %s" % expression
+        
+    print "=" * 80
+    
+    summary = instrumentation.summary()
+    for name in sorted(summary["phases"]):
+        print "%s: %.3f ms" % (name, summary["phases"][name] * 1000.0)
+    for name in sorted(summary["counters"]):
+        print "%s: %d" % (name, summary["counters"][name])
 
 # ============================================================================
 
-SLOPE_THRESHOLD = 5
-LINE_CONN_TOLERANCE = 30
-
-for raw_dataset in raw_datasets:
-    labels = raw_dataset["labels"]
-    lines = raw_dataset["lines"]
-    process_raw_data(lines, labels)
+if __name__ == '__main__':
+    from logic_data import raw_datasets
+    
+    for raw_dataset in raw_datasets:
+        labels = raw_dataset["labels"]
+        lines = raw_dataset["lines"]
+        process_raw_data(lines, labels)
@@ -0,0 +1,243 @@
+"""Compact binary format for many charts, loaded without parsing.
+
+An archive is one little-endian file: a header, then 8-byte aligned
+sections of fixed type:
+
+    chart index   (charts + 1, 2) int64    first line, first label of each chart
+    chart ids     (charts,) int32          string id of each chart's id, or -1
+    lines         (lines, 2, 2) int32      line endpoints
+    boxes         (labels, 2, 2) float64   label boxes
+    name ids      (labels,) int32          string id of each label's name
+    string index  (strings + 1,) int64     offsets into the string data
+    string data   bytes                    UTF-8, each distinct string once
+
+`ChartArchive` maps the file with `np.memmap`; a chart's lines and labels
+are views into the mapping, and `DataSet` takes them as they are.
+
+    python logic_archive.py pack -o charts.lca logic_data batch.jsonl charts/
+    python logic_archive.py unpack charts.lca -o charts.jsonl
+"""
+
+import argparse
+import json
+import struct
+import sys
+
+import numpy as np
+
+# ============================================================================
+
+MAGIC = "LOGICARC"
+VERSION = 1
+
+# Magic, version, chart count, line count, label count, string count and
+# string data size, then the offsets of the seven sections
+HEADER = struct.Struct("<8sIIqqqq7q")
+
+# ============================================================================
+
+class LabelArray(object):
+    """Labels of a chart as arrays: names by id into a string table, and boxes.
+
+    Indexing gives the usual [name, (x0, y0), (x1, y1)] label record.
+    """
+
+    def __init__(self, name_ids, strings, boxes):
+        self.name_ids = name_ids
+        self.strings = strings
+        self.boxes = boxes
+
+    @staticmethod
+    def from_labels(labels):
+        interned = {}
+        name_ids = [interned.setdefault(label[0], len(interned)) for label in labels]
+        strings = sorted(interned, key=interned.get)
+        boxes = np.array([label[1:3] for label in labels], dtype=np.float64).reshape(-1, 2, 2)
+        return LabelArray(np.array(name_ids, dtype=np.int32), strings, boxes)
+
+    @property
+    def names(self):
+        strings = self.strings
+        return [strings[i] for i in self.name_ids.tolist()]
+
+    def __len__(self):
+        return len(self.name_ids)
+
+    def __getitem__(self, index):
+        (x0, y0), (x1, y1) = self.boxes[index].tolist()
+        return [self.strings[self.name_ids[index]], (x0, y0), (x1, y1)]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+# ============================================================================
+
+def as_int32_lines(lines):
+    # Line endpoints as an (N, 2, 2) int32 array, refusing to round
+    lines = np.asarray(lines).reshape(-1, 2, 2)
+    result = lines.astype(np.int32)
+    if not np.array_equal(result, lines):
+        raise ValueError("Line endpoints must be integers in the int32 range")
+    return result
+
+# ----------------------------------------------------------------------------
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+# ----------------------------------------------------------------------------
+
+def write_archive(path, charts):
+    """Write charts, given as (chart id or None, lines, labels), to an archive."""
+    interned = {}
+    intern = lambda text: interned.setdefault(text, len(interned))
+
+    index = [(0, 0)]
+    chart_ids = []
+    lines = []
+    boxes = []
+    name_ids = []
+    for chart_id, chart_lines, chart_labels in charts:
+        chart_ids.append(-1 if chart_id is None else intern(unicode(chart_id)))
+        lines.append(as_int32_lines(chart_lines))
+        if not isinstance(chart_labels, LabelArray):
+            chart_labels = LabelArray.from_labels(chart_labels)
+        boxes.append(np.asarray(chart_labels.boxes, dtype=np.float64).reshape(-1, 2, 2))
+        name_ids.extend(intern(name) for name in chart_labels.names)
+        index.append((index[-1][0] + len(lines[-1]), index[-1][1] + len(boxes[-1])))
+
+    strings = [text.encode('utf-8') if isinstance(text, unicode) else text
+        for text in sorted(interned, key=interned.get)]
+    string_index = np.cumsum([0] + [len(text) for text in strings]).astype(np.int64)
+    sections = [
+        np.array(index, dtype=np.int64)
+        , np.array(chart_ids, dtype=np.int32)
+        , np.concatenate(lines) if lines else np.zeros((0, 2, 2), dtype=np.int32)
+        , np.concatenate(boxes) if boxes else np.zeros((0, 2, 2), dtype=np.float64)
+        , np.array(name_ids, dtype=np.int32)
+        , string_index
+        , np.frombuffer("".join(strings), dtype=np.uint8)
+        ]
+
+    offsets = []
+    offset = _align(HEADER.size)
+    for section in sections:
+        offsets.append(offset)
+        offset = _align(offset + section.nbytes)
+    header = HEADER.pack(MAGIC, VERSION, len(index) - 1, index[-1][0], index[-1][1], len(strings)
+        , int(string_index[-1]), *offsets)
+
+    with open(path, 'wb') as f:
+        f.write(header)
+        for offset, section in zip(offsets, sections):
+            f.write("\0" * (offset - f.tell()))
+            f.write(section.astype(section.dtype.newbyteorder('<'), copy=False).tostring())
+
+# ============================================================================
+
+class ChartArchive(object):
+    """Read-only, memory-mapped view of an archive.
+
+    `archive[i]` gives the lines ((N, 2, 2) int32) and labels (`LabelArray`)
+    of chart i, both backed by the mapping. Only the string table is decoded
+    when opening.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        if len(self.data) < HEADER.size:
+            raise ValueError("%s is not a chart archive" % path)
+        fields = HEADER.unpack(self.data[:HEADER.size].tostring())
+        magic, version, charts, lines, labels, strings, string_bytes = fields[:7]
+        offsets = fields[7:]
+        if magic != MAGIC:
+            raise ValueError("%s is not a chart archive" % path)
+        if version != VERSION:
+            raise ValueError("%s has unsupported archive version %d" % (path, version))
+
+        section = lambda i, dtype, shape: np.ndarray(shape, dtype, buffer=self.data, offset=offsets[i])
+        self.index = section(0, '<i8', (charts + 1, 2))
+        self.chart_ids = section(1, '<i4', (charts,))
+        self.lines = section(2, '<i4', (lines, 2, 2))
+        self.boxes = section(3, '<f8', (labels, 2, 2))
+        self.name_ids = section(4, '<i4', (labels,))
+        string_index = section(5, '<i8', (strings + 1,)).tolist()
+        string_data = section(6, np.uint8, (string_bytes,)).tostring()
+        self.strings = [string_data[string_index[i]:string_index[i + 1]] for i in range(strings)]
+
+    def __len__(self):
+        return len(self.index) - 1
+
+    def __getitem__(self, i):
+        (line_start, label_start), (line_end, label_end) = self.index[i:i + 2].tolist()
+        labels = LabelArray(self.name_ids[label_start:label_end], self.strings
+            , self.boxes[label_start:label_end])
+        return self.lines[line_start:line_end], labels
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def chart_id(self, i):
+        string_id = self.chart_ids[i]
+        return self.strings[string_id] if string_id >= 0 else None
+
+# ============================================================================
+
+def iter_literal_charts(sources):
+    """(chart id, lines, labels) of each chart in the sources.
+
+    A source is "logic_data" (all the sample datasets), the name of one of
+    them ("dataset_0"), a chart JSON file, a directory of them, or a JSONL
+    file.
+    """
+    from logic_io import iter_named_sources, read_chart_source
+
+    for chart_id, source in iter_named_sources(sources):
+        record_id, lines, labels = read_chart_source(source)
+        yield (record_id if record_id is not None else chart_id), lines, labels
+
+# ----------------------------------------------------------------------------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert charts to and from the binary archive format.")
+    commands = parser.add_subparsers(dest="command")
+    pack = commands.add_parser("pack", help="write charts to an archive")
+    pack.add_argument("sources", nargs="+"
+        , help="logic_data, dataset_N, chart JSON files, directories of them, or JSONL files")
+    pack.add_argument("-o", "--output", required=True)
+    unpack = commands.add_parser("unpack", help="write the charts of an archive as JSONL")
+    unpack.add_argument("archive")
+    unpack.add_argument("-o", "--output", help="output JSONL file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    if args.command == "pack":
+        write_archive(args.output, iter_literal_charts(args.sources))
+        archive = ChartArchive(args.output)
+        sys.stderr.write("%d charts, %d lines, %d labels\n"
+            % (len(archive), len(archive.lines), len(archive.boxes)))
+        return 0
+
+    archive = ChartArchive(args.archive)
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for i, (lines, labels) in enumerate(archive):
+            record = {
+                "lines" : lines.tolist()
+                , "labels" : [[name] + box for name, box in zip(labels.names, labels.boxes.tolist())]
+                }
+            chart_id = archive.chart_id(i)
+            if chart_id is not None:
+                record["id"] = chart_id
+            out.write(json.dumps(record) + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+# ============================================================================
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,225 @@
+import argparse
+import collections
+import itertools
+import json
+import multiprocessing
+import Queue
+import sys
+import time
+
+from logic_io import iter_chart_sources, read_chart_source
+
+# ============================================================================
+
+MAX_TRUTH_TABLE_INPUTS = 16 # Truth tables of more inputs are refused, at 2^n rows
+PENDING_CHUNKS = 2 # Chunks of charts handed out per worker ahead of the results taken
+
+# What to do with each chart of a batch, see `analyze_chart`
+BatchOptions = collections.namedtuple("BatchOptions"
+    , ["stats", "cache_dir", "cache_bytes", "normalize", "truth_table", "resolve"])
+BatchOptions.__new__.__defaults__ = (False, None, None, False, False, False)
+
+# ============================================================================
+
+def truth_table_record(table):
+    # JSON form of a `TruthTable`, each output column as a string of 0s and 1s
+    import numpy as np
+
+    columns = {}
+    for i, name in enumerate(table.output_names):
+        columns[name] = (table.column(i).astype(np.uint8) + ord("0")).tostring()
+    return {"inputs" : table.input_names, "outputs" : table.output_names, "columns" : columns}
+
+# ----------------------------------------------------------------------------
+
+_caches = {} # (directory, max bytes) -> `ResultCache`, one per process
+
+def result_cache(directory, max_bytes):
+    # A cache keeps the size of its directory, so a worker reuses it for all
+    # its charts rather than listing the directory again for each
+    from logic_cache import ResultCache
+
+    key = (directory, max_bytes)
+    if key not in _caches:
+        _caches[key] = ResultCache(directory, max_bytes)
+    return _caches[key]
+
+# ----------------------------------------------------------------------------
+
+def analyze_chart(task):
+    """Analyze one chart of a batch, never raising.
+
+    The task is (index, chart id, source, `BatchOptions`). Returns the
+    result record: the expressions on success, otherwise the error and the
+    stage it occurred in, plus the time spent per stage and (if requested)
+    the instrumentation counters. With a cache directory, charts analyzed
+    before are answered from the cache ("cached" is set), and new results
+    are stored. With `normalize`, the lines are cleaned up by
+    `normalize_lines` first, and "normalization" tells how. With
+    `truth_table`, the result has the truth table of the chart too (see
+    `truth_table_record`), for up to MAX_TRUTH_TABLE_INPUTS inputs. A
+    chart with feedback loops has them listed under "feedback", with the
+    next value of each state term, and no truth table. With `resolve`,
+    ambiguous connections are searched over rather than failing (see
+    `logic_resolve`), and "resolution" tells how sure the trace is; such
+    results aren't cached.
+    """
+    from logic import AnalysisProgress, analyze
+    from logic_instrument import Instrumentation
+
+    index, chart_id, source, options = task
+    result = {
+        "id" : chart_id
+        , "index" : index
+        , "expressions" : None
+        , "error" : None
+        , "stage" : None
+        , "cached" : False
+        }
+    instrumentation = Instrumentation() if options.stats else None
+    cache = result_cache(options.cache_dir, options.cache_bytes) if options.cache_dir else None
+    progress = AnalysisProgress()
+    start = time.time()
+
+    try:
+        with progress.step("load"):
+            record_id, lines, labels = read_chart_source(source)
+        if record_id is not None:
+            result["id"] = record_id
+
+        analysis = analyze(lines, labels, instrumentation=instrumentation, cache=cache
+            , normalize=options.normalize, resolve=options.resolve, progress=progress)
+        with progress.step("expressions"):
+            result["expressions"] = analysis.expressions
+
+        if analysis.feedback_loops:
+            result["feedback"] = {"loops" : [str(loop) for loop in analysis.feedback_loops]
+                , "states" : analysis.feedback_expressions}
+
+        if options.truth_table and not analysis.feedback_loops:
+            with progress.step("truth_table"):
+                if len(analysis.input_names) > MAX_TRUTH_TABLE_INPUTS:
+                    raise ValueError("Truth table of %d inputs is too big (at most %d)"
+                        % (len(analysis.input_names), MAX_TRUTH_TABLE_INPUTS))
+                result["truth_table"] = truth_table_record(analysis.truth_table())
+    except Exception as e:
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+        result["stage"] = progress.stage
+
+    result["cached"] = progress.cached
+    if progress.normalization is not None:
+        result["normalization"] = progress.normalization
+    if progress.resolution is not None:
+        result["resolution"] = progress.resolution.summary()
+    if instrumentation is not None:
+        result["stats"] = instrumentation.summary()
+    result["timing"] = dict(progress.timing, total=time.time() - start)
+    return result
+
+# ============================================================================
+
+def analyze_charts(tasks):
+    # Runs in a worker: the results of a chunk of charts, one for each even
+    # if `analyze_chart` fails outside its own error handling
+    results = []
+    for task in tasks:
+        try:
+            results.append(analyze_chart(task))
+        except Exception as e:
+            results.append({"id" : task[1], "index" : task[0], "expressions" : None
+                , "error" : "%s: %s" % (type(e).__name__, e), "stage" : None})
+    return results
+
+# ----------------------------------------------------------------------------
+
+def run_batch(path, processes=None, chunksize=1, ordered=True, options=BatchOptions()):
+    """Analyze all the charts of a batch on a process pool.
+
+    Yields one result record per chart (see `analyze_chart`), in input order
+    or, if `ordered` is false, as soon as each one completes. Results are
+    looked up in and added to the `ResultCache` in `options.cache_dir`, if
+    given, shared by all the workers. Charts are read as the workers get
+    to them, at most PENDING_CHUNKS chunks of `chunksize` a process ahead
+    of the results taken, so memory doesn't grow with the batch.
+    """
+    tasks = ((i, chart_id, source, options) for i, (chart_id, source) in enumerate(iter_chart_sources(path)))
+
+    # Not `Pool.imap`, which reads all its tasks in as fast as it can
+    pool = multiprocessing.Pool(processes)
+    max_pending = PENDING_CHUNKS * (processes or multiprocessing.cpu_count())
+    pending = collections.deque()
+    finished = Queue.Queue()
+    try:
+        while True:
+            while len(pending) < max_pending:
+                chunk = list(itertools.islice(tasks, chunksize))
+                if not chunk:
+                    break
+                pending.append(pool.apply_async(analyze_charts, (chunk,)
+                    , callback=None if ordered else finished.put))
+            if not pending:
+                break
+            if ordered:
+                results = pending.popleft().get()
+            else:
+                results = finished.get()
+                pending.pop()
+            for result in results:
+                yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+# ============================================================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Analyze a batch of logic charts, writing one JSON result per line.")
+    parser.add_argument("input", help="directory of chart JSON files, or a JSONL file")
+    parser.add_argument("-o", "--output", help="output JSONL file (default: stdout)")
+    parser.add_argument("-j", "--processes", type=int
+        , help="number of worker processes (default: CPU count)")
+    parser.add_argument("--chunksize", type=int, default=1
+        , help="charts sent to a worker at a time (default: %(default)s)")
+    parser.add_argument("--unordered", action="store_true"
+        , help="write results as they complete, rather than in input order")
+    parser.add_argument("--stats", action="store_true"
+        , help="include the analysis counters and phase timings in the results")
+    parser.add_argument("--cache", metavar="DIR"
+        , help="reuse the results of charts analyzed before, kept in this directory")
+    parser.add_argument("--cache-size", type=int, default=256, metavar="MB"
+        , help="size cap of the cache, least recently used results are dropped (default: %(default)s)")
+    parser.add_argument("--normalize", action="store_true"
+        , help="merge broken wire fragments and drop duplicate lines before tracing")
+    parser.add_argument("--truth-table", action="store_true"
+        , help="include the truth table of each chart (up to %d inputs)" % MAX_TRUTH_TABLE_INPUTS)
+    parser.add_argument("--resolve", action="store_true"
+        , help="search over ambiguous connections rather than failing, scoring each trace (not cached)")
+    args = parser.parse_args(argv)
+
+    options = BatchOptions(args.stats, args.cache, args.cache_size << 20, args.normalize, args.truth_table
+        , args.resolve)
+    out = open(args.output, 'w') if args.output else sys.stdout
+    succeeded = failed = 0
+    try:
+        for result in run_batch(args.input, args.processes, args.chunksize, not args.unordered, options):
+            out.write(json.dumps(result, sort_keys=True) + "\n")
+            out.flush()
+            if result["error"] is None:
+                succeeded += 1
+            else:
+                failed += 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    sys.stderr.write("%d charts analyzed, %d failed.\n" % (succeeded + failed, failed))
+    return 0
+
+# ============================================================================
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,255 @@
+import errno
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import time
+
+import numpy as np
+
+from logic import AnalysisResult, analyze
+from logic_graph import VertexGraph
+
+# ============================================================================
+
+FORMAT_VERSION = 1
+DEFAULT_MAX_BYTES = 256 << 20
+
+# Modules whose source makes up the code version: a change to any of them
+# invalidates all the cached results
+ANALYSIS_MODULES = ["logic", "logic_classes", "logic_graph", "logic_index", "logic_partition"
+    , "logic_topology", "logic_utils", "logic_expr"]
+
+STALE_TEMP_SECONDS = 3600 # Temporary files older than this were left by a crashed writer
+SLACK_FRACTION = 16 # Eviction leaves max_bytes / this free, and the directory is listed again once
+                    # this process stored as much
+
+_code_version = None
+
+# ============================================================================
+
+def code_version():
+    # Hash of the source of the analysis modules, computed once
+    global _code_version
+    if _code_version is None:
+        digest = hashlib.sha256("format %d" % FORMAT_VERSION)
+        for name in ANALYSIS_MODULES:
+            path = __import__(name).__file__
+            if path.endswith((".pyc", ".pyo")):
+                path = path[:-1]
+            with open(path, 'rb') as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+        _code_version = digest.hexdigest()
+    return _code_version
+
+# ----------------------------------------------------------------------------
+
+def chart_key(lines, labels, tolerance, slope_threshold):
+    """Hex digest identifying a chart and the analysis settings.
+
+    Coordinates are hashed as float64, so the same chart given with ints or
+    floats, lists or tuples or arrays gets the same key.
+    """
+    digest = hashlib.sha256(code_version())
+    digest.update(struct.pack("<dd", tolerance, slope_threshold))
+    lines = np.ascontiguousarray(np.asarray(lines, dtype='<f8').reshape(-1, 2, 2))
+    digest.update(struct.pack("<q", len(lines)))
+    digest.update(lines.tostring())
+    digest.update(struct.pack("<q", len(labels)))
+    for label in labels:
+        name = label[0].encode('utf-8') if isinstance(label[0], unicode) else label[0]
+        digest.update(struct.pack("<q", len(name)))
+        digest.update(name)
+        digest.update(np.asarray(label[1:3], dtype='<f8').tostring())
+    return digest.hexdigest()
+
+# ============================================================================
+
+class CacheEntry(object):
+    """What is kept of the analysis of one chart.
+
+    The traced graph, unless tracing failed, and the expressions if the
+    graph is valid. Otherwise the error message, and the stage it occurred
+    in: "analyze" or "validate".
+    """
+
+    def __init__(self, graph=None, expressions=None, error=None, stage=None):
+        self.graph = graph
+        self.expressions = expressions
+        self.error = error
+        self.stage = stage
+
+    def result(self, validate=True):
+        # As `analyze` would return or raise
+        if (self.stage == "analyze") or (validate and (self.error is not None)):
+            raise RuntimeError(self.error)
+        return AnalysisResult(None, self.graph, self.expressions)
+
+    # ------------------------------------------------------------------------
+
+    def save(self, f):
+        meta = {
+            "format" : FORMAT_VERSION
+            , "expressions" : self.expressions
+            , "error" : self.error
+            , "stage" : self.stage
+            , "names" : None
+            }
+        arrays = {}
+        if self.graph is not None:
+            arrays = self.graph.arrays()
+            meta["names"] = arrays.pop("names")
+        arrays["meta"] = np.frombuffer(json.dumps(meta), dtype=np.uint8)
+        np.savez_compressed(f, **arrays)
+
+    @staticmethod
+    def load(f):
+        with np.load(f) as data:
+            meta = json.loads(data["meta"].tostring())
+            if meta["format"] != FORMAT_VERSION:
+                return None
+            graph = None
+            if meta["names"] is not None:
+                arrays = dict((name, data[name]) for name in ["kinds", "boxes", "edge_sources", "edge_targets"])
+                arrays["names"] = [_text(name) for name in meta["names"]]
+                graph = VertexGraph.from_arrays(arrays)
+        expressions = meta["expressions"] and [_text(e) for e in meta["expressions"]]
+        return CacheEntry(graph, expressions, meta["error"] and _text(meta["error"]), meta["stage"])
+
+# ============================================================================
+
+class ResultCache(object):
+    """Analysis results in a local directory, keyed by `chart_key`.
+
+    Each entry is a compressed `.npz` file under a two character prefix
+    directory. Entries are written to a temporary file and renamed into
+    place, so concurrent readers and writers (say, the workers of a batch)
+    only ever see complete files; if two processes store the same chart,
+    the last rename wins, with the same content. A hit refreshes the file's
+    modification time, and when the total size grows past `max_bytes` the
+    least recently used entries are removed, leaving some slack under it.
+
+    The total size is listed on the first store and then kept up to date
+    with the stores of this instance. The writes of other processes are
+    only seen when the directory is listed again, on eviction or after
+    writing a fraction of `max_bytes`, so the cap may be overshot by that
+    much per process.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = None # Total size as of the last listing, plus the stores since
+        self._unlisted = 0 # Bytes stored since the last listing
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:] + ".npz")
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = CacheEntry.load(f)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError, KeyError):
+            entry = None # Missing, evicted meanwhile, or unreadable
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, temp_path = tempfile.mkstemp(prefix="tmp", suffix=".npz", dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                entry.save(f)
+                written = f.tell()
+            os.rename(temp_path, path)
+        except:
+            _remove(temp_path)
+            raise
+        if self._size is None:
+            self.evict()
+        self._size += written
+        self._unlisted += written
+        if (self._size > self.max_bytes) or (self._unlisted * SLACK_FRACTION > self.max_bytes):
+            self.evict()
+
+    def analyze(self, lines, labels, tolerance, slope_threshold, validate=True, instrumentation=None
+            , processes=1):
+        # `logic.analyze` through the cache
+        return analyze(lines, labels, tolerance, slope_threshold, validate, instrumentation, processes
+            , cache=self)
+
+    # ------------------------------------------------------------------------
+
+    def entries(self):
+        # (modification time, size, path) of all the entries
+        result = []
+        if not os.path.isdir(self.directory):
+            return result
+        now = time.time()
+        for prefix in os.listdir(self.directory):
+            directory = os.path.join(self.directory, prefix)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if name.startswith("tmp"):
+                    if now - stat.st_mtime > STALE_TEMP_SECONDS:
+                        _remove(path)
+                    continue
+                result.append((stat.st_mtime, stat.st_size, path))
+        return result
+
+    def size(self):
+        return sum(size for mtime, size, path in self.entries())
+
+    def evict(self):
+        # Remove the least recently used entries until under the size cap,
+        # with some slack, so that a full cache isn't listed on every store.
+        # Several processes may do this at once, at worst removing a few
+        # more entries than needed.
+        entries = self.entries()
+        total = sum(size for mtime, size, path in entries)
+        if total > self.max_bytes:
+            target = self.max_bytes - self.max_bytes // SLACK_FRACTION
+            for mtime, size, path in sorted(entries):
+                _remove(path)
+                total -= size
+                if total <= target:
+                    break
+        self._size = total
+        self._unlisted = 0
+
+# ----------------------------------------------------------------------------
+
+def _text(value):
+    # JSON gives back unicode, the analysis uses byte strings
+    return value.encode('utf-8')
+
+# ----------------------------------------------------------------------------
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+# ============================================================================
@@ -3,128 +3,195 @@ from abc import ABCMeta, abstractmethod, abstractproperty
 # ============================================================================
 
 class Vertex(object):
+    """View of one vertex of a `VertexGraph`.
+
+    The graph holds all the data, the views are created on demand and
+    compare equal when they refer to the same vertex. The limits on the
+    number of connections are class attributes.
+    """
     __metaclass__ = ABCMeta
+    __slots__ = ('graph', 'index')
+
+    default_name = None
+    min_inputs = 0
+    max_inputs = 0
+    max_outputs = 0
+    passthrough = False # Only wiring, carries its input along unchanged
+
+    def __init__(self, graph, index):
+        self.graph = graph
+        self.index = index
+
+    @property
+    def name(self):
+        return self.graph.names[self.index]
+
+    @property
+    def bounding_box(self):
+        return self.graph.bounding_box(self.index)
+
+    @property
+    def inputs(self):
+        return [self.graph.vertex(i) for i in self.graph.input_ids(self.index)]
+
+    @property
+    def outputs(self):
+        return [self.graph.vertex(i) for i in self.graph.output_ids(self.index)]
 
-    def __init__(self, name, min_inputs, max_inputs, max_outputs, bounding_box):
-        self.name = name
-        self.inputs = []
-        self.min_inputs = min_inputs
-        self.max_inputs = max_inputs
-        self.outputs = []
-        self.max_outputs = max_outputs
-        self.bounding_box = bounding_box
-
-    def add_input(self, input):
-        if len(self.inputs) >= self.max_inputs:
-            raise RuntimeError("Too many inputs")
-        self.inputs.append(input)
-        
-    def add_output(self, output):
-        if len(self.outputs) >= self.max_outputs:
-            raise RuntimeError("Too many outputs")
-        self.outputs.append(output)
-        
     def contains_point(self, point):
         p1, p2 = self.bounding_box
         x0, y0 = p1
         x1, y1 = p2
         x, y = point
         return ((x0 <= x) and (x <= x1)) and ((y0 <= y) and (y <= y1))
-        
+
     def validate(self):
-        if len(self.inputs) > self.max_inputs:
-            raise RuntimeError("Too many inputs in %s" % self.name)
-        if len(self.inputs) < self.min_inputs:
-            raise RuntimeError("Too few inputs in %s" % self.name)
-        if len(self.outputs) > self.max_outputs:
-            raise RuntimeError("Too few outputs in %s" % self.name)
-            
+        self.graph.validate_vertex(self.index)
+
+    def __eq__(self, other):
+        return isinstance(other, Vertex) and (self.graph is other.graph) and (self.index == other.index)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.graph), self.index))
+
     def __str__(self):
         return self.name
-        
+
     @abstractproperty
     def expression(self):
         pass
 
+    @abstractmethod
+    def add_to_dag(self, dag, input_ids):
+        # Add own term to an `ExpressionDag`, given the ids of the inputs
+        pass
+
 # ----------------------------------------------------------------------------
 
 class InputTerm(Vertex):
-    def __init__(self, name, bounding_box):
-        super(InputTerm, self).__init__(name, 0, 0, 1, bounding_box)
-        
+    __slots__ = ()
+    max_outputs = 1
+
     @property
     def expression(self):
         return self.name
 
+    def add_to_dag(self, dag, input_ids):
+        return dag.make_term(self.name)
+
 # ----------------------------------------------------------------------------
 
 class OutputTerm(Vertex):
-    def __init__(self, name, bounding_box):
-        super(OutputTerm, self).__init__(name, 1, 1, 0, bounding_box)
-        
+    __slots__ = ()
+    min_inputs = 1
+    max_inputs = 1
+
     @property
     def expression(self):
         return "%s = %s" % (self.name, self.inputs[0].expression)
 
+    def add_to_dag(self, dag, input_ids):
+        dag.add_output(self.name, input_ids[0])
+        return input_ids[0]
+
 # ----------------------------------------------------------------------------
 
 class Gate(Vertex):
-    def __init__(self, name, min_inputs, max_inputs, max_outputs, bounding_box):
-        super(Gate, self).__init__(name, min_inputs, max_inputs, max_outputs, bounding_box)
+    __slots__ = ()
 
 # ----------------------------------------------------------------------------
 
 class UnaryGate(Gate):
-    def __init__(self, name, bounding_box):
-        super(UnaryGate, self).__init__(name, 1, 1, 1, bounding_box)
-        
+    __slots__ = ()
+    min_inputs = 1
+    max_inputs = 1
+    max_outputs = 1
+
     @property
     def expression(self):
         return "(%s %s)" % (self.name, self.inputs[0].expression)
 
+    def add_to_dag(self, dag, input_ids):
+        return dag.make_unary(self.name, input_ids[0])
+
 # ----------------------------------------------------------------------------
 
 class BinaryGate(Gate):
-    def __init__(self, name, bounding_box):
-        super(BinaryGate, self).__init__(name, 2, 8, 1, bounding_box)
-        
+    __slots__ = ()
+    min_inputs = 2
+    max_inputs = 8
+    max_outputs = 1
+
     @property
     def expression(self):
         result = ""
-        for i in range(len(self.inputs)):
+        inputs = self.inputs
+        for i in range(len(inputs)):
             if i:
                 result += " %s " % self.name
-            result += "%s" % self.inputs[i].expression
+            result += "%s" % inputs[i].expression
         return "(%s)" % result
-        
+
+    def add_to_dag(self, dag, input_ids):
+        return dag.make_nary(self.name, input_ids)
+
 # ----------------------------------------------------------------------------
 
 class Node(Vertex):
-    def __init__(self, bounding_box):
-        super(Node, self).__init__("NODE", 1, 1, 1, bounding_box)
-        
+    __slots__ = ()
+    default_name = "NODE"
+    min_inputs = 1
+    max_inputs = 1
+    max_outputs = 1
+    passthrough = True
+
     @property
     def expression(self):
         return self.inputs[0].expression
-        
+
+    def add_to_dag(self, dag, input_ids):
+        return input_ids[0]
+
 # ----------------------------------------------------------------------------
 
 class Connection(Vertex):
-    def __init__(self, bounding_box):
-        super(Connection, self).__init__("CONN", 1, 1, 1, bounding_box)
-        
+    __slots__ = ()
+    default_name = "CONN"
+    min_inputs = 1
+    max_inputs = 1
+    max_outputs = 1
+    passthrough = True
+
     @property
     def expression(self):
         return self.inputs[0].expression
 
+    def add_to_dag(self, dag, input_ids):
+        return input_ids[0]
+
 # ----------------------------------------------------------------------------
 
 class Junction(Vertex):
-    def __init__(self, bounding_box):
-        super(Junction, self).__init__("JUNC", 1, 1, 2, bounding_box)
-        
+    __slots__ = ()
+    default_name = "JUNC"
+    min_inputs = 1
+    max_inputs = 1
+    max_outputs = 2
+    passthrough = True
+
     @property
     def expression(self):
         return self.inputs[0].expression
 
+    def add_to_dag(self, dag, input_ids):
+        return input_ids[0]
+
+# ============================================================================
+
+# Vertex types by type code, as stored in a `VertexGraph`
+VERTEX_TYPES = [InputTerm, OutputTerm, UnaryGate, BinaryGate, Node, Connection, Junction]
+
 # ============================================================================
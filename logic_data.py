@@ -106,8 +106,31 @@ dataset_2 = {
     ]
 }
 
+dataset_3 = {
+"labels" : [
+    ['S', (96.41260314226151, 203.27708101272583), (352.8826580047607, 412.0496428012848)]
+    , ['R', (104.9358081817627, 1093.6130924224854), (347.2516119480133, 1306.7450976371765)]
+    , ['NOR', (998.2841253280640, 196.50881457328796), (1403.7128601074219, 803.5517835617065)]
+    , ['NOR', (1004.7765669822693, 897.1326646804810), (1398.0524101257324, 1502.8873085975647)]
+    , ['OUTPUT', (2497.3189430236816, 251.83267688751221), (2806.1477699279785, 548.0349793434143)]
+    , ['OUTPUT', (2503.6554336547852, 1047.6041007041931), (2801.9940748214722, 1353.2710237503052)]
+    ]
+    
+, "lines" : [
+    [(300, 300), (1010, 305)]
+    , [(300, 1200), (1010, 1195)]
+    , [(1390, 400), (2510, 405)]
+    , [(1390, 1200), (2510, 1198)]
+    , [(1050, 1000), (1700, 1003)]
+    , [(1050, 700), (1800, 698)]
+    , [(1700, 402), (1702, 1003)]
+    , [(1800, 698), (1803, 1199)]
+    ]
+}
+
 raw_datasets = [
     dataset_0
     , dataset_1
     , dataset_2
+    , dataset_3
     ]
\ No newline at end of file
@@ -0,0 +1,374 @@
+"""Find the labels of a scanned chart by matching template images.
+
+The templates are cut from the example crops in `img/`. Their overlays
+(the label box, its text and the traced lines) are masked out of the
+comparison. Each template is searched at several scales, each scale on
+the level of an image pyramid where the template is small, with a
+normalized cross-correlation computed by FFT. Big levels are split into
+overlapping tiles, which can be matched on a process pool. The best
+matches that don't overlap give the labels.
+
+    python logic_detect.py logic_chart_0.jpg -o labels.json
+
+There is no reading of text: an input's label is named by its position,
+IN0, IN1, ... from the top, and a gate only after the crop it matched,
+GATE?binary or GATE?ternary, which `DataSet` refuses until the gate is
+given its type. `--name` names all the gates matching a crop at once.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+import cv2
+
+from logic import UNTYPED_GATE
+
+# ============================================================================
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "img")
+
+# Crop, label name (None for an input), box of the label in the crop. The
+# connection and junction crops are wiring, traced from the lines instead.
+# Gates of any type and number of inputs match either gate crop, so the
+# matches are only named after the crop.
+TEMPLATES = [
+    ("example_binary_gate.jpg", UNTYPED_GATE + "binary", (18, 10, 182, 181))
+    , ("example_ternary_gate.jpg", UNTYPED_GATE + "ternary", (30, 35, 251, 307))
+    , ("example_unary_gate.jpg", "NOT", (19, 24, 181, 117))
+    , ("example_node_pair.jpg", "NODE", (31, 20, 132, 101))
+    , ("example_output.jpg", "OUTPUT", (18, 30, 177, 230))
+    , ("example_input.jpg", None, (28, 17, 177, 144))
+    ]
+
+SCALES = [2 ** (k / 4.0) for k in range(9)] # Sizes of the labels relative to the crops
+MATCH_SIZE = 32 # Templates are matched on the smallest pyramid level keeping them this big
+BLUR = 1.5 # Sigma of the blur at that level, for some slack in the hand drawn shapes
+THRESHOLD = 0.7 # Least correlation of a match
+MAX_OVERLAP = 0.3 # Matches covering this much of a better one, or it of them, are dropped
+TILE_SIZE = 512 # Pyramid levels bigger than this are matched in tiles
+
+OVERLAY_SATURATION = 50 # Colored pixels of a crop are overlays, and ignored
+
+# ============================================================================
+
+class Template(object):
+    """Gray image of a label, and the weights (0 or 1) of its pixels."""
+
+    def __init__(self, name, image, weights):
+        self.name = name
+        self.image = image
+        self.weights = weights
+
+    @staticmethod
+    def from_crop(path, name, box):
+        crop = cv2.imread(path)
+        if crop is None:
+            raise RuntimeError("Can't read template '%s'" % path)
+        x0, y0, x1, y1 = box
+        crop = crop[y0:y1 + 1, x0:x1 + 1]
+        overlay = cv2.cvtColor(crop, cv2.COLOR_BGR2HSV)[:, :, 1] > OVERLAY_SATURATION
+        overlay = cv2.dilate(overlay.astype(np.uint8), np.ones((3, 3), np.uint8)) > 0
+        # The box outline is an overlay all along the border
+        overlay[:2] = overlay[-2:] = True
+        overlay[:, :2] = overlay[:, -2:] = True
+        image = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY).astype(np.float32)
+        return Template(name, image, (~overlay).astype(np.float32))
+
+    @property
+    def size(self):
+        height, width = self.image.shape
+        return width, height
+
+    def resized(self, factor):
+        # Image and weights scaled by the factor
+        width, height = self.size
+        size = (max(3, int(round(width * factor))), max(3, int(round(height * factor))))
+        image = cv2.GaussianBlur(cv2.resize(self.image, size, interpolation=cv2.INTER_AREA), (0, 0), BLUR)
+        weights = cv2.resize(self.weights, size, interpolation=cv2.INTER_AREA) > 0.99
+        return image, weights.astype(np.float32)
+
+# ----------------------------------------------------------------------------
+
+def load_templates(directory=TEMPLATE_DIR, names=None):
+    # `names` maps crop file names to the label names to give their matches
+    names = names or {}
+    return [Template.from_crop(os.path.join(directory, path), names.get(path, name), box)
+        for path, name, box in TEMPLATES]
+
+# ============================================================================
+
+class Spectra(object):
+    """DFTs of an image and its square, to correlate templates with.
+
+    The correlations are circular, over the image padded to a size with
+    small prime factors. That is exact where a template fits in the image,
+    the only positions kept.
+    """
+
+    def __init__(self, image):
+        self.image_shape = image.shape
+        self.shape = tuple(cv2.getOptimalDFTSize(n) for n in image.shape)
+        image = self.pad(image)
+        self.image = cv2.dft(image)
+        self.square = cv2.dft(image * image)
+
+    def pad(self, array):
+        padded = np.zeros(self.shape, np.float64)
+        padded[:array.shape[0], :array.shape[1]] = array
+        return padded
+
+    def correlate(self, spectrum, kernel):
+        # Sum of the kernel times the image below, at each position where it fits
+        product = cv2.mulSpectrums(spectrum, cv2.dft(self.pad(kernel)), 0, conjB=True)
+        result = cv2.idft(product, flags=cv2.DFT_REAL_OUTPUT | cv2.DFT_SCALE)
+        return result[:self.image_shape[0] - kernel.shape[0] + 1, :self.image_shape[1] - kernel.shape[1] + 1]
+
+# ----------------------------------------------------------------------------
+
+def masked_correlation(image, template, weights, spectra=None):
+    """Normalized cross-correlation of a weighted template at every position in the image.
+
+    Score [y, x] compares the template placed with its top left corner at
+    (x, y) with the image below, over the pixels of weight 1: the Pearson
+    correlation, from -1 to 1. Computed with DFTs as sums of image and
+    squared image under the weights, and the image under the zero-mean
+    template. Only positions where the template fits are returned. The
+    `Spectra` of the image can be shared by several templates.
+    """
+    count = weights.sum()
+    template = (template - (template * weights).sum() / count) * weights
+    template_norm = np.sqrt((template * template).sum())
+    if spectra is None:
+        spectra = Spectra(image)
+
+    numerator = spectra.correlate(spectra.image, template)
+    sums = spectra.correlate(spectra.image, weights)
+    squares = spectra.correlate(spectra.square, weights)
+    variance = np.maximum(squares - sums * sums / count, 0)
+    denominator = np.sqrt(variance) * template_norm
+    flat = denominator < 1e-6 * count * template_norm # Blank paper
+    denominator[flat] = 1
+    scores = numerator / denominator
+    scores[flat] = 0
+    return scores
+
+# ----------------------------------------------------------------------------
+
+def find_peaks(scores, size, threshold):
+    # (x, y) of the local maxima over windows about half the template size
+    width, height = size
+    kernel = np.ones((max(3, height // 2) | 1, max(3, width // 2) | 1), np.uint8)
+    scores = scores.astype(np.float32)
+    peaks = (scores >= threshold) & (scores >= cv2.dilate(scores, kernel))
+    y, x = np.nonzero(peaks)
+    return x, y, scores[y, x]
+
+# ============================================================================
+
+_levels = None # (pyramid levels, templates per level, threshold) for `match_tile`
+
+def _share_levels(levels, per_level, threshold):
+    # Pool initializer: the pyramid and the scaled templates are inherited
+    # once per worker, and the tasks only say which tile to match
+    global _levels
+    _levels = (levels, per_level, threshold)
+
+# ----------------------------------------------------------------------------
+
+def match_tile(task):
+    """Match the templates on one tile of a pyramid level.
+
+    The task is the level and the box of the tile in it, from the levels
+    given to `_share_levels`. Returns the matches as arrays of template
+    index, scale, x and y in the level, and score.
+    """
+    level, x_offset, y_offset, size = task
+    levels, per_level, threshold = _levels
+    tile = levels[level][y_offset:y_offset + size, x_offset:x_offset + size]
+    templates = per_level[level]
+    spectra = Spectra(cv2.GaussianBlur(tile, (0, 0), BLUR))
+    results = []
+    for index, scale, image, weights in templates:
+        if (image.shape[0] > tile.shape[0]) or (image.shape[1] > tile.shape[1]):
+            continue
+        scores = masked_correlation(tile, image, weights, spectra)
+        x, y, score = find_peaks(scores, image.shape[::-1], threshold)
+        results.append(np.stack([np.full(len(x), index), np.full(len(x), scale), x + x_offset
+            , y + y_offset, score], axis=1))
+    if not results:
+        return np.zeros((0, 5))
+    return np.concatenate(results)
+
+# ----------------------------------------------------------------------------
+
+def _tiles(shape, margin, tile_size):
+    # (x, y) of the tiles covering a level, overlapping by the margin
+    height, width = shape
+    step = max(tile_size - margin, 1)
+    for y in range(0, max(height - margin, 1), step):
+        for x in range(0, max(width - margin, 1), step):
+            yield x, y
+
+# ----------------------------------------------------------------------------
+
+def match_templates(image, templates=None, scales=SCALES, threshold=THRESHOLD, tile_size=TILE_SIZE
+        , processes=1):
+    """All the matches of the templates in a gray image, before suppression.
+
+    Returns (boxes, template indices, scores): (N, 2, 2) boxes in image
+    coordinates, and for each the template and the correlation.
+    """
+    if templates is None:
+        templates = load_templates()
+    image = np.asarray(image, dtype=np.float32)
+
+    # Each template scale goes to the smallest level keeping it MATCH_SIZE big
+    levels = [image]
+    per_level = {}
+    for index, template in enumerate(templates):
+        for scale in scales:
+            smallest = min(template.size) * scale
+            level = 0
+            while smallest / 2 ** (level + 1) >= MATCH_SIZE:
+                level += 1
+            while len(levels) <= level:
+                levels.append(cv2.pyrDown(levels[-1]))
+            image_, weights = template.resized(scale / 2 ** level)
+            per_level.setdefault(level, []).append((index, scale, image_, weights))
+
+    tasks = []
+    for level, level_templates in sorted(per_level.items()):
+        margin = max(max(t[2].shape) for t in level_templates)
+        size = max(tile_size, 2 * margin)
+        for x, y in _tiles(levels[level].shape, margin, size):
+            tasks.append((level, x, y, size))
+
+    if processes == 1:
+        _share_levels(levels, per_level, threshold)
+        try:
+            results = [match_tile(task) for task in tasks]
+        finally:
+            _share_levels(None, None, None)
+    else:
+        pool = multiprocessing.Pool(processes, _share_levels, (levels, per_level, threshold))
+        try:
+            results = pool.map(match_tile, tasks)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    boxes, indices, scores = [], [], []
+    for (level, x, y, size), matches in zip(tasks, results):
+        if len(matches) == 0:
+            continue
+        index = matches[:, 0].astype(int)
+        factor = 2 ** level
+        sizes = np.array([templates[i].size for i in index]) * matches[:, 1:2]
+        x0 = matches[:, 2:4] * factor
+        boxes.append(np.stack([x0, x0 + sizes], axis=1))
+        indices.append(index)
+        scores.append(matches[:, 4])
+    if not boxes:
+        return np.zeros((0, 2, 2)), np.zeros(0, dtype=int), np.zeros(0)
+    return np.concatenate(boxes), np.concatenate(indices), np.concatenate(scores)
+
+# ----------------------------------------------------------------------------
+
+def suppress(boxes, scores, max_overlap=MAX_OVERLAP):
+    """Indices of the boxes kept by greedy non-maximum suppression, best first.
+
+    Each box is kept unless its intersection with a better kept box is more
+    than `max_overlap` of the smaller of the two. Labels don't nest, so a
+    match inside a better one is dropped too.
+    """
+    order = np.argsort(-scores, kind='mergesort')
+    boxes = boxes[order]
+    areas = np.prod(boxes[:, 1] - boxes[:, 0], axis=1)
+    alive = np.ones(len(boxes), dtype=bool)
+    kept = []
+    for i in range(len(boxes)):
+        if not alive[i]:
+            continue
+        kept.append(order[i])
+        low = np.maximum(boxes[i, 0], boxes[i + 1:, 0])
+        high = np.minimum(boxes[i, 1], boxes[i + 1:, 1])
+        overlap = np.prod(np.maximum(high - low, 0), axis=1)
+        smaller = np.minimum(areas[i], areas[i + 1:])
+        alive[i + 1:] &= overlap <= max_overlap * smaller
+    return np.array(kept, dtype=int)
+
+# ----------------------------------------------------------------------------
+
+def detect_labels(image, templates=None, scales=SCALES, threshold=THRESHOLD, max_overlap=MAX_OVERLAP
+        , tile_size=TILE_SIZE, processes=1):
+    """Labels of a chart image (BGR or gray), as [name, (x0, y0), (x1, y1)].
+
+    The labels are in the form `DataSet` takes, ordered from the top.
+    """
+    if templates is None:
+        templates = load_templates()
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    boxes, indices, scores = match_templates(image, templates, scales, threshold, tile_size, processes)
+    kept = suppress(boxes, scores, max_overlap)
+    kept = kept[np.lexsort((boxes[kept, 0, 0], boxes[kept, 0, 1]))]
+
+    labels = []
+    for (x0, y0), (x1, y1) in boxes[kept].tolist():
+        labels.append([None, (x0, y0), (x1, y1)])
+    inputs = 0
+    for label, i in zip(labels, indices[kept].tolist()):
+        label[0] = templates[i].name
+        if label[0] is None:
+            label[0] = "IN%d" % inputs
+            inputs += 1
+    return labels
+
+# ============================================================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find the labels of a scanned chart by template matching.")
+    parser.add_argument("image", help="scan of the chart")
+    parser.add_argument("-o", "--output", help="write the labels as chart JSON to this file (default: stdout)")
+    parser.add_argument("-j", "--processes", type=int, default=1
+        , help="worker processes for the tiles (default: %(default)s, 0 for the CPU count)")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD
+        , help="least correlation of a match (default: %(default)s)")
+    parser.add_argument("--templates", default=TEMPLATE_DIR
+        , help="directory of the template crops (default: the img directory)")
+    parser.add_argument("--name", action="append", default=[], metavar="CROP=NAME"
+        , help="name the labels matching a crop, e.g. example_binary_gate.jpg=XOR (repeatable)")
+    args = parser.parse_args(argv)
+
+    crops = [path for path, name, box in TEMPLATES]
+    names = dict(option.split("=", 1) for option in args.name if "=" in option)
+    unknown = [option for option in args.name if option.split("=", 1)[0] not in crops]
+    if unknown:
+        parser.error("--name takes CROP=NAME, with CROP one of %s" % ", ".join(crops))
+
+    image = cv2.imread(args.image, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        sys.stderr.write("Can't read image '%s'\n" % args.image)
+        return 1
+    labels = detect_labels(image, load_templates(args.templates, names), threshold=args.threshold
+        , processes=args.processes or None)
+    text = json.dumps({"labels" : labels})
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print text
+    sys.stderr.write("%d labels\n" % len(labels))
+    return 0
+
+# ============================================================================
+
+if __name__ == '__main__':
+    sys.exit(main())
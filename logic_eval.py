@@ -0,0 +1,198 @@
+from functools import reduce
+
+import numpy as np
+
+from logic_expr import TERM, UNARY, NARY
+
+# ============================================================================
+
+# N-input gates are evaluated as a reduction over the inputs, optionally
+# followed by an inversion (so XNOR is the complement of the parity)
+NARY_FUNCTIONS = {
+    'AND' : (np.bitwise_and, False)
+    , 'NAND' : (np.bitwise_and, True)
+    , 'OR' : (np.bitwise_or, False)
+    , 'NOR' : (np.bitwise_or, True)
+    , 'XOR' : (np.bitwise_xor, False)
+    , 'XNOR' : (np.bitwise_xor, True)
+    }
+
+UNARY_FUNCTIONS = {
+    'NOT' : np.invert
+    }
+
+# Bit patterns of the 6 lowest row index bits within a 64-bit word
+# (row r of the truth table is bit (r % 64) of word (r // 64))
+WORD_BITS = 64
+LOW_BIT_PATTERNS = [
+    0xAAAAAAAAAAAAAAAA
+    , 0xCCCCCCCCCCCCCCCC
+    , 0xF0F0F0F0F0F0F0F0
+    , 0xFF00FF00FF00FF00
+    , 0xFFFF0000FFFF0000
+    , 0xFFFFFFFF00000000
+    ]
+
+# ============================================================================
+
+class CompiledChart(object):
+    """Levelized evaluator compiled from an `ExpressionDag`.
+
+    The evaluation works on arrays of any type supporting the numpy bitwise
+    operations -- packed uint64 words for truth tables, or bool arrays
+    with one element per input vector.
+    """
+
+    def __init__(self, dag, input_names=None):
+        if dag.states:
+            raise RuntimeError("No truth table with feedback loops (%s)" % "; ".join(str(l) for l in dag.loops))
+        terms = [node[1] for node in dag.nodes if node[0] == TERM]
+        if input_names is None:
+            input_names = terms
+        self.input_names = []
+        for name in input_names:
+            if name not in self.input_names:
+                self.input_names.append(name)
+        for name in terms:
+            if name not in self.input_names:
+                raise RuntimeError("Unknown input '%s'" % name)
+
+        self.output_names = [name for name, arg in dag.outputs]
+        self.output_ids = [arg for name, arg in dag.outputs]
+
+        # Group the gates by level (distance from the inputs)
+        levels = [0] * len(dag.nodes)
+        self.levels = []
+        self.term_ids = {}
+        for i, (kind, name, args) in enumerate(dag.nodes):
+            if kind == TERM:
+                self.term_ids[i] = name
+                continue
+            if (kind == UNARY) and (name not in UNARY_FUNCTIONS):
+                raise RuntimeError("Unsupported gate '%s'" % name)
+            if (kind == NARY) and (name not in NARY_FUNCTIONS):
+                raise RuntimeError("Unsupported gate '%s'" % name)
+            levels[i] = 1 + max(levels[a] for a in args)
+            while len(self.levels) < levels[i]:
+                self.levels.append([])
+            self.levels[levels[i] - 1].append((i, kind, name, args))
+
+        # Last level at which each value is needed, so it can be dropped
+        self.last_use = {}
+        for level, gates in enumerate(self.levels):
+            for i, kind, name, args in gates:
+                for a in args:
+                    self.last_use[a] = level
+        for i in self.output_ids:
+            self.last_use[i] = len(self.levels)
+
+    @property
+    def gate_count(self):
+        return sum(len(gates) for gates in self.levels)
+
+    def evaluate(self, inputs):
+        """Evaluate all the outputs, given a mapping of input name to array.
+
+        Returns the list of output arrays, in the order of `output_names`.
+        """
+        values = {}
+        for i, name in self.term_ids.items():
+            values[i] = inputs[name]
+
+        for level, gates in enumerate(self.levels):
+            for i, kind, name, args in gates:
+                if kind == UNARY:
+                    values[i] = UNARY_FUNCTIONS[name](values[args[0]])
+                else:
+                    function, invert = NARY_FUNCTIONS[name]
+                    result = reduce(function, [values[a] for a in args])
+                    values[i] = np.invert(result) if invert else result
+            # Release values no longer needed by the following levels
+            for i in [a for a in values if self.last_use.get(a, -1) <= level]:
+                del values[i]
+
+        return [values[i] for i in self.output_ids]
+
+    def truth_table(self, chunk_words=1 << 16):
+        return TruthTable.evaluate(self, chunk_words)
+
+# ============================================================================
+
+def input_patterns(input_count, word_start, word_stop):
+    # Packed values of each input over the given range of words. The first
+    # input is the most significant bit of the row index.
+    word_index = np.arange(word_start, word_stop, dtype=np.uint64)
+    patterns = []
+    for k in range(input_count):
+        bit = input_count - 1 - k
+        if bit < 6:
+            pattern = np.full(len(word_index), LOW_BIT_PATTERNS[bit], dtype=np.uint64)
+        else:
+            high = (word_index >> np.uint64(bit - 6)) & np.uint64(1)
+            pattern = np.uint64(0) - high # 0 or all ones
+        patterns.append(pattern)
+    return patterns
+
+# ----------------------------------------------------------------------------
+
+class TruthTable(object):
+    """Truth table of all outputs, for all assignments of the inputs.
+
+    Output columns are stored packed, 64 rows per uint64 word. Row `r` has
+    input `k` set to bit (n - 1 - k) of `r`, so the first input is the most
+    significant one.
+    """
+
+    def __init__(self, input_names, output_names, packed):
+        self.input_names = input_names
+        self.output_names = output_names
+        self.packed = packed # (outputs, words) array of uint64
+
+    @staticmethod
+    def evaluate(compiled, chunk_words=1 << 16):
+        input_count = len(compiled.input_names)
+        row_count = 1 << input_count
+        word_count = max(1, row_count // WORD_BITS)
+
+        packed = np.zeros((len(compiled.output_ids), word_count), dtype=np.uint64)
+        for start in range(0, word_count, chunk_words):
+            stop = min(start + chunk_words, word_count)
+            patterns = input_patterns(input_count, start, stop)
+            results = compiled.evaluate(dict(zip(compiled.input_names, patterns)))
+            for i, result in enumerate(results):
+                packed[i, start:stop] = result
+
+        if row_count < WORD_BITS:
+            packed &= np.uint64((1 << row_count) - 1)
+
+        return TruthTable(compiled.input_names, compiled.output_names, packed)
+
+    @property
+    def row_count(self):
+        return 1 << len(self.input_names)
+
+    def column(self, output_index):
+        # Unpacked values of one output, as a bool array with one item per row
+        words = self.packed[output_index]
+        shifts = np.arange(WORD_BITS, dtype=np.uint64)
+        bits = (words[:, np.newaxis] >> shifts) & np.uint64(1)
+        return bits.reshape(-1)[:self.row_count].astype(bool)
+
+    def row(self, r):
+        inputs = tuple((r >> (len(self.input_names) - 1 - k)) & 1
+            for k in range(len(self.input_names)))
+        word, bit = divmod(r, WORD_BITS)
+        outputs = tuple(int((int(self.packed[i, word]) >> bit) & 1)
+            for i in range(len(self.output_names)))
+        return inputs, outputs
+
+    def __str__(self):
+        header = " ".join(self.input_names) + " | " + " ".join(self.output_names)
+        lines = [header]
+        for r in range(self.row_count):
+            inputs, outputs = self.row(r)
+            lines.append("%s | %s" % (" ".join(str(v) for v in inputs)
+                , " ".join(str(v) for v in outputs)))
+        return "\n".join(lines)
+
+# ============================================================================
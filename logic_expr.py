@@ -0,0 +1,157 @@
+# ============================================================================
+
+TERM = 'TERM'
+UNARY = 'UNARY'
+NARY = 'NARY'
+
+# ============================================================================
+
+class ExpressionDag(object):
+    """Hash-consed expression graph of a traced diagram.
+
+    Every distinct subterm is stored exactly once, as a tuple of
+    (kind, name, argument ids), so shared cones of the diagram (fan-out
+    through junctions) are only built and rendered once. Node ids are
+    assigned in creation order, which is also a topological order.
+    """
+
+    def __init__(self):
+        self.nodes = []
+        self.lookup = {}
+        self.outputs = [] # List of (name, node id)
+        self.states = [] # List of (state term name, node id of its next value)
+        self.loops = [] # `FeedbackLoop`s cut into the state terms
+
+    def _intern(self, key):
+        node_id = self.lookup.get(key)
+        if node_id is None:
+            node_id = len(self.nodes)
+            self.nodes.append(key)
+            self.lookup[key] = node_id
+        return node_id
+
+    def make_term(self, name):
+        return self._intern((TERM, name, ()))
+
+    def make_unary(self, name, arg):
+        return self._intern((UNARY, name, (arg,)))
+
+    def make_nary(self, name, args):
+        return self._intern((NARY, name, tuple(args)))
+
+    def add_output(self, name, arg):
+        self.outputs.append((name, arg))
+
+    def add_state(self, name, arg):
+        self.states.append((name, arg))
+
+    # ------------------------------------------------------------------------
+
+    @staticmethod
+    def from_outputs(outputs, loops=()):
+        """Build the graph of everything feeding the given `OutputTerm`s.
+
+        The vertex graph is walked iteratively (post-order), and each vertex
+        is visited once, no matter how many consumers it has. The vertices
+        of the `FeedbackLoop`s given are cut out as state terms, each with
+        the expression of its next value among the `states`, so the rest
+        stays acyclic.
+        """
+        dag = ExpressionDag()
+        dag.loops = list(loops)
+        ids = {} # Vertex -> node id
+        on_path = set() # Vertices whose inputs are still being expanded
+
+        def expand(root):
+            stack = [(root, False)]
+            while stack:
+                vertex, expanded = stack.pop()
+                if expanded:
+                    on_path.discard(vertex)
+                    input_ids = [ids[v] for v in vertex.inputs]
+                    ids[vertex] = vertex.add_to_dag(dag, input_ids)
+                    continue
+                if vertex in ids:
+                    continue
+                if vertex in on_path:
+                    raise RuntimeError("Feedback loop through %s" % vertex.name)
+
+                on_path.add(vertex)
+                stack.append((vertex, True))
+                for v in reversed(vertex.inputs):
+                    if v not in ids:
+                        stack.append((v, False))
+
+        states = []
+        for loop in dag.loops:
+            for i, name in zip(loop.ids, loop.states):
+                vertex = loop.graph.vertex(i)
+                ids[vertex] = dag.make_term(name)
+                states.append((vertex, name))
+
+        for output in outputs:
+            expand(output)
+        for vertex, name in states:
+            for v in vertex.inputs:
+                expand(v)
+            dag.add_state(name, vertex.add_to_dag(dag, [ids[v] for v in vertex.inputs]))
+        return dag
+
+    # ------------------------------------------------------------------------
+
+    def _render_node(self, node, rendered):
+        kind, name, args = node
+        if kind == TERM:
+            return name
+        if kind == UNARY:
+            return "(%s %s)" % (name, rendered[args[0]])
+        return "(%s)" % (" %s " % name).join(rendered[a] for a in args)
+
+    def render(self):
+        # Fully expanded expressions, in the same format as `Vertex.expression`
+        rendered = []
+        for node in self.nodes:
+            rendered.append(self._render_node(node, rendered))
+        return ["%s = %s" % (name, rendered[arg]) for name, arg in self.outputs]
+
+    def render_states(self):
+        # Next value of each state term, in the same format
+        rendered = []
+        for node in self.nodes:
+            rendered.append(self._render_node(node, rendered))
+        return ["%s = %s" % (name, rendered[arg]) for name, arg in self.states]
+
+    def reference_counts(self):
+        counts = [0] * len(self.nodes)
+        for kind, name, args in self.nodes:
+            for a in args:
+                counts[a] += 1
+        for name, arg in self.outputs + self.states:
+            counts[arg] += 1
+        return counts
+
+    def render_shared(self, prefix='t'):
+        """Expressions with shared subterms emitted once, as temporaries.
+
+        Returns a list of "<temp> = <expression>" bindings (in dependency
+        order), followed by the output expressions and then the next value
+        of each state term, referring to them. Output size is linear in the
+        size of the graph.
+        """
+        term_names = set(name for kind, name, args in self.nodes if kind == TERM)
+        while any(n.startswith(prefix) for n in term_names):
+            prefix += '_'
+
+        counts = self.reference_counts()
+        rendered = []
+        bindings = []
+        for i, node in enumerate(self.nodes):
+            text = self._render_node(node, rendered)
+            if (counts[i] > 1) and (node[0] != TERM):
+                temp = "%s%d" % (prefix, len(bindings))
+                bindings.append("%s = %s" % (temp, text))
+                text = temp
+            rendered.append(text)
+        return bindings + ["%s = %s" % (name, rendered[arg]) for name, arg in self.outputs + self.states]
+
+# ============================================================================
@@ -0,0 +1,266 @@
+"""Extract the wires of a scanned chart as line segments.
+
+The scan is binarized, and opened with long thin kernels to keep the
+horizontal and vertical strokes apart from the rest of the drawing. Each
+stroke left becomes one segment, fitted to its pixels. Big scans are cut
+into overlapping tiles that run on a thread pool (OpenCV releases the
+GIL); every tile keeps the segments of its own part, and the pieces of a
+wire that crosses a seam are joined up again.
+
+    python logic_extract.py logic_chart_0.jpg --labels labels.json -o chart.json
+
+The lines come out with their endpoints ordered as `DataSet` expects.
+"""
+
+import argparse
+import json
+import sys
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import cv2
+
+# ============================================================================
+
+BLOCK_SIZE = 51 # Neighbourhood of the adaptive threshold, in pixels
+INK_CONTRAST = 20 # Pixels this much darker than their neighbourhood are ink
+MIN_LENGTH = 48 # Shortest stroke taken for a wire, also the length of the kernels
+STITCH_DISTANCE = 8 # Pieces meeting at a seam this close across are one wire
+TILE_SIZE = 1024 # Scans are processed in tiles this big ...
+TILE_OVERLAP = 64 # ... plus this much around, which bounds the skew of a wire to about 7 degrees
+
+# ============================================================================
+
+def binarize(gray, block_size=BLOCK_SIZE, contrast=INK_CONTRAST):
+    """Ink mask (0 or 255) of a gray image, adaptive to uneven lighting."""
+    return cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV
+        , block_size, contrast)
+
+# ----------------------------------------------------------------------------
+
+def stroke_masks(ink, min_length=MIN_LENGTH):
+    """Horizontal and vertical strokes of an ink mask, at least `min_length` long."""
+    kernel_h = cv2.getStructuringElement(cv2.MORPH_RECT, (min_length, 1))
+    kernel_v = cv2.getStructuringElement(cv2.MORPH_RECT, (1, min_length))
+    return cv2.morphologyEx(ink, cv2.MORPH_OPEN, kernel_h), cv2.morphologyEx(ink, cv2.MORPH_OPEN, kernel_v)
+
+# ----------------------------------------------------------------------------
+
+def fit_segments(mask, axis, min_length=MIN_LENGTH):
+    """One segment per connected stroke of a mask, (N, 2, 2) as ((x0, y0), (x1, y1)).
+
+    The segment runs along `axis` (0 for x, 1 for y) over the extent of
+    the stroke, on the least squares line through its pixels, with its
+    ends in increasing order along the axis.
+    """
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    ys, xs = np.nonzero(mask)
+    ids = labels[ys, xs] - 1 # The background is component 0, and has no pixels here
+    count -= 1
+    if count == 0:
+        return np.zeros((0, 2, 2))
+    along, across = (xs, ys) if axis == 0 else (ys, xs)
+    along = along.astype(np.float64)
+    across = across.astype(np.float64)
+
+    n = np.bincount(ids, minlength=count).astype(np.float64)
+    mean_along = np.bincount(ids, along, count) / n
+    mean_across = np.bincount(ids, across, count) / n
+    var = np.bincount(ids, along * along, count) / n - mean_along ** 2
+    cov = np.bincount(ids, along * across, count) / n - mean_along * mean_across
+    slope = cov / np.maximum(var, 1e-9)
+
+    start = stats[1:, cv2.CC_STAT_LEFT if axis == 0 else cv2.CC_STAT_TOP].astype(np.float64)
+    length = stats[1:, cv2.CC_STAT_WIDTH if axis == 0 else cv2.CC_STAT_HEIGHT]
+    end = start + length - 1
+    keep = length >= min_length
+
+    segments = np.empty((keep.sum(), 2, 2))
+    for k, position in enumerate([start[keep], end[keep]]):
+        segments[:, k, axis] = position
+        segments[:, k, 1 - axis] = mean_across[keep] + slope[keep] * (position - mean_along[keep])
+    return segments
+
+# ----------------------------------------------------------------------------
+
+def _clip(segments, axis, low, high):
+    # Segments cut to [low, high] along the axis, and whether either end was cut
+    p0, p1 = segments[:, 0], segments[:, 1]
+    span = np.maximum(p1[:, axis] - p0[:, axis], 1e-9)
+    cut = np.stack([p0[:, axis] < low, p1[:, axis] > high], axis=1)
+    clipped = segments.copy()
+    for k, bound in [(0, low), (1, high)]:
+        across = p0[:, 1 - axis] + (bound - p0[:, axis]) / span * (p1[:, 1 - axis] - p0[:, 1 - axis])
+        clipped[cut[:, k], k, axis] = bound
+        clipped[cut[:, k], k, 1 - axis] = across[cut[:, k]]
+    keep = clipped[:, 1, axis] > clipped[:, 0, axis]
+    return clipped[keep], cut[keep]
+
+# ----------------------------------------------------------------------------
+
+def extract_tile(task):
+    """Segments of the core of one tile, see `extract_lines`.
+
+    The task is (tile, x, y, core, parameters): the tile with its overlap,
+    its offset in the image, the (x0, y0, x1, y1) part of the image it is
+    responsible for, and (block size, contrast, min length). Returns, for
+    the horizontal and the vertical strokes, the segments in image
+    coordinates and which of their ends were cut at the core.
+    """
+    tile, x, y, core, (block_size, contrast, min_length) = task
+    masks = stroke_masks(binarize(tile, block_size, contrast), min_length)
+    results = []
+    for axis, mask in enumerate(masks):
+        segments = fit_segments(mask, axis, min_length) + (x, y)
+        # Cut along to the core; a seam's neighbour has the rest. Across,
+        # the tile whose core holds the middle of the segment keeps it.
+        segments, cut = _clip(segments, axis, core[axis], core[axis + 2])
+        middle = segments[:, :, 1 - axis].mean(axis=1)
+        mine = (middle >= core[1 - axis]) & (middle < core[3 - axis])
+        results.append((segments[mine], cut[mine]))
+    return results
+
+# ----------------------------------------------------------------------------
+
+def _tiles(gray, tile_size, overlap):
+    # (tile, x, y, core) covering the image, the cores side by side
+    height, width = gray.shape
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            x1 = min(x0 + tile_size, width)
+            y1 = min(y0 + tile_size, height)
+            x = max(x0 - overlap, 0)
+            y = max(y0 - overlap, 0)
+            yield gray[y:y1 + overlap, x:x1 + overlap], x, y, (x0, y0, x1, y1)
+
+# ----------------------------------------------------------------------------
+
+def stitch(segments, cut, axis, distance=STITCH_DISTANCE):
+    """Join the pieces of the wires cut at the tile seams.
+
+    A piece whose end was cut continues with the piece whose start was
+    cut at the same place along the axis, if they are within `distance`
+    across. A chain of pieces becomes the one segment between its ends.
+    """
+    count = len(segments)
+    following = np.full(count, -1, dtype=np.int64)
+    ends = np.flatnonzero(cut[:, 1])
+    starts = np.flatnonzero(cut[:, 0])
+    # Pair up by seam, then by position across
+    ends = ends[np.lexsort((segments[ends, 1, 1 - axis], segments[ends, 1, axis]))]
+    starts = starts[np.lexsort((segments[starts, 0, 1 - axis], segments[starts, 0, axis]))]
+    taken = set()
+    for i in ends:
+        seam, across = segments[i, 1, axis], segments[i, 1, 1 - axis]
+        low = np.searchsorted(segments[starts, 0, axis], seam, 'left')
+        high = np.searchsorted(segments[starts, 0, axis], seam, 'right')
+        candidates = [j for j in starts[low:high] if j not in taken]
+        if not candidates:
+            continue
+        gaps = np.abs(segments[candidates, 0, 1 - axis] - across)
+        best = int(np.argmin(gaps))
+        if gaps[best] <= distance:
+            following[i] = candidates[best]
+            taken.add(candidates[best])
+
+    has_previous = np.zeros(count, dtype=bool)
+    has_previous[following[following >= 0]] = True
+    result = []
+    for head in np.flatnonzero(~has_previous):
+        tail = head
+        while following[tail] >= 0:
+            tail = following[tail]
+        result.append([segments[head, 0], segments[tail, 1]])
+    return np.array(result).reshape(-1, 2, 2)
+
+# ----------------------------------------------------------------------------
+
+def _in_labels(lines, labels):
+    # Lines with both ends in the same label box
+    inside = np.zeros(len(lines), dtype=bool)
+    for name, (x0, y0), (x1, y1) in labels:
+        low = np.array([min(x0, x1), min(y0, y1)])
+        high = np.array([max(x0, x1), max(y0, y1)])
+        inside |= ((lines >= low) & (lines <= high)).all(axis=(1, 2))
+    return inside
+
+# ----------------------------------------------------------------------------
+
+def extract_lines(gray, labels=None, tile_size=TILE_SIZE, overlap=TILE_OVERLAP, threads=None
+        , block_size=BLOCK_SIZE, contrast=INK_CONTRAST, min_length=MIN_LENGTH):
+    """Wire segments of a gray chart scan, as an (N, 2, 2) integer array.
+
+    Horizontal lines come first, ordered from the top, then vertical ones
+    from the left; the ends of a horizontal line are ordered by x, those
+    of a vertical one by y. Lines lying within a label box are strokes of
+    the label (a gate outline, a letter), and dropped.
+
+    `threads` is the size of the pool for the tiles, None for the CPU count.
+    """
+    gray = np.asarray(gray)
+    if gray.ndim == 3:
+        gray = cv2.cvtColor(gray, cv2.COLOR_BGR2GRAY)
+    parameters = (block_size, contrast, min_length)
+    tasks = [task + (parameters,) for task in _tiles(gray, tile_size, overlap)]
+    if threads == 1 or len(tasks) == 1:
+        results = [extract_tile(task) for task in tasks]
+    else:
+        pool = ThreadPool(threads)
+        try:
+            results = pool.map(extract_tile, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    lines = []
+    for axis in [0, 1]:
+        segments = np.concatenate([np.zeros((0, 2, 2))] + [result[axis][0] for result in results])
+        cut = np.concatenate([np.zeros((0, 2), dtype=bool)] + [result[axis][1] for result in results])
+        segments = np.round(stitch(segments, cut, axis)).astype(np.int64)
+        segments = segments[segments[:, 1, axis] - segments[:, 0, axis] >= min_length - 1]
+        order = np.lexsort((segments[:, 0, axis], segments[:, :, 1 - axis].min(axis=1)))
+        lines.append(segments[order])
+    lines = np.concatenate(lines)
+    if labels:
+        lines = lines[~_in_labels(lines, labels)]
+    return lines
+
+# ============================================================================
+
+def main(argv=None):
+    from logic_io import load_labels
+
+    parser = argparse.ArgumentParser(description="Extract the wires of a scanned chart as line segments.")
+    parser.add_argument("image", help="scan of the chart")
+    parser.add_argument("-o", "--output", help="write the chart JSON to this file (default: stdout)")
+    parser.add_argument("--labels"
+        , help="JSON with the labels that go with the lines, e.g. from logic_detect.py (a chart, or labels"
+        " only); strokes within them are dropped")
+    parser.add_argument("-j", "--threads", type=int, default=0
+        , help="threads for the tiles (default: 0, the CPU count)")
+    parser.add_argument("--tile", type=int, default=TILE_SIZE
+        , help="size of the tiles in pixels (default: %(default)s)")
+    parser.add_argument("--min-length", type=int, default=MIN_LENGTH
+        , help="shortest wire in pixels (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    image = cv2.imread(args.image, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        sys.stderr.write("Can't read image '%s'\n" % args.image)
+        return 1
+    labels = load_labels(args.labels) if args.labels else []
+    lines = extract_lines(image, labels, tile_size=args.tile, threads=args.threads or None
+        , min_length=args.min_length)
+    text = json.dumps({"lines" : lines.tolist(), "labels" : labels})
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print text
+    sys.stderr.write("%d lines\n" % len(lines))
+    return 0
+
+# ============================================================================
+
+if __name__ == '__main__':
+    sys.exit(main())
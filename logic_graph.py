@@ -0,0 +1,334 @@
+from array import array
+
+import numpy as np
+
+from logic_classes import VERTEX_TYPES
+
+# ============================================================================
+
+# Per type code, for checks over all the vertices at once
+MIN_INPUTS = np.array([t.min_inputs for t in VERTEX_TYPES])
+MAX_INPUTS = np.array([t.max_inputs for t in VERTEX_TYPES])
+MAX_OUTPUTS = np.array([t.max_outputs for t in VERTEX_TYPES])
+PASSTHROUGH = np.array([t.passthrough for t in VERTEX_TYPES])
+
+# ============================================================================
+
+def as_numpy(values, dtype):
+    # Zero-copy view of an `array.array`
+    if len(values) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.frombuffer(values, dtype=dtype)
+
+# ----------------------------------------------------------------------------
+
+def strongly_connected_components(offsets, targets):
+    """Component of each vertex of a graph given as CSR arrays (see `VertexGraph`).
+
+    Tarjan's algorithm with an explicit stack, so O(V + E) time and no
+    recursion. Components are numbered in the order they are completed.
+    """
+    offsets = offsets.tolist()
+    targets = targets.tolist()
+    count = len(offsets) - 1
+    order = [-1] * count # Visiting order, -1 if not visited yet
+    low = [0] * count
+    on_stack = [False] * count
+    component = [-1] * count
+    stack = []
+    visited = 0
+    components = 0
+
+    for root in range(count):
+        if order[root] >= 0:
+            continue
+        order[root] = low[root] = visited
+        visited += 1
+        stack.append(root)
+        on_stack[root] = True
+        work = [[root, offsets[root]]] # Vertex and its next edge
+        while work:
+            top = work[-1]
+            v, edge = top
+            if edge < offsets[v + 1]:
+                top[1] += 1
+                w = targets[edge]
+                if order[w] < 0:
+                    order[w] = low[w] = visited
+                    visited += 1
+                    stack.append(w)
+                    on_stack[w] = True
+                    work.append([w, offsets[w]])
+                elif on_stack[w] and (order[w] < low[v]):
+                    low[v] = order[w]
+                continue
+
+            work.pop()
+            if work and (low[v] < low[work[-1][0]]):
+                low[work[-1][0]] = low[v]
+            if low[v] == order[v]:
+                while True:
+                    w = stack.pop()
+                    on_stack[w] = False
+                    component[w] = components
+                    if w == v:
+                        break
+                components += 1
+    return np.array(component, dtype=np.int64)
+
+# ============================================================================
+
+class FeedbackLoop(object):
+    """Vertices of a graph feeding back into each other.
+
+    `ids` are the vertices of a strongly connected component, in order.
+    `states` names the terms standing for their outputs in expressions,
+    "<name>#<vertex id>" (on a collapsed graph, the id of a label is its
+    position among the labels). `kind` is "SR latch" for a cross-coupled
+    pair of NAND or NOR gates, otherwise "feedback loop".
+    """
+
+    def __init__(self, graph, ids):
+        self.graph = graph
+        self.ids = ids
+        self.names = [graph.names[i] for i in ids]
+        self.states = ["%s#%d" % (name, i) for name, i in zip(self.names, ids)]
+        latch = (len(ids) == 2) and (self.names[0] == self.names[1]) and (self.names[0] in ["NAND", "NOR"])
+        self.kind = "SR latch" if latch else "feedback loop"
+
+    def __str__(self):
+        return "%s through %s" % (self.kind, ", ".join(self.states))
+
+# ============================================================================
+
+class VertexGraph(object):
+    """Compact store of the vertices of a chart and their connections.
+
+    A vertex is an index into flat arrays of type codes (positions in
+    `VERTEX_TYPES`), names and bounding boxes. The connections are appended
+    to a pair of edge arrays as they are made, and grouped per vertex into
+    CSR style offset/index arrays, in connection order, when first needed.
+    `Vertex` objects are only views, see `vertex`.
+    """
+
+    def __init__(self):
+        self.kinds = array('B')
+        self.names = []
+        self.boxes = array('d') # x0, y0, x1, y1 per vertex, NaN if none
+        self.input_counts = array('i')
+        self.output_counts = array('i')
+        self.edge_sources = array('i')
+        self.edge_targets = array('i')
+        self._inputs = None # CSR (offsets, ids), built on demand
+        self._outputs = None
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def add_vertex(self, vertex_type, name=None, bounding_box=None):
+        index = len(self.kinds)
+        self.kinds.append(VERTEX_TYPES.index(vertex_type))
+        self.names.append(name if name is not None else vertex_type.default_name)
+        if bounding_box is None:
+            self.boxes.extend([np.nan] * 4)
+        else:
+            (x0, y0), (x1, y1) = bounding_box
+            self.boxes.extend([x0, y0, x1, y1])
+        self.input_counts.append(0)
+        self.output_counts.append(0)
+        return vertex_type(self, index)
+
+    def vertex(self, index):
+        return VERTEX_TYPES[self.kinds[index]](self, index)
+
+    def vertices(self, vertex_type=None):
+        # Views of all the vertices, or just those of the given type
+        if vertex_type is None:
+            return [self.vertex(i) for i in range(len(self))]
+        kind = VERTEX_TYPES.index(vertex_type)
+        return [vertex_type(self, i) for i, k in enumerate(self.kinds) if k == kind]
+
+    def bounding_box(self, index):
+        x0, y0, x1, y1 = self.boxes[4 * index:4 * index + 4]
+        if x0 != x0: # NaN
+            return None
+        return ((x0, y0), (x1, y1))
+
+    def arrays(self):
+        # Plain arrays of the graph, for storing it
+        return {
+            "kinds" : as_numpy(self.kinds, dtype=np.uint8).copy()
+            , "names" : list(self.names)
+            , "boxes" : as_numpy(self.boxes, dtype=np.float64).copy()
+            , "edge_sources" : as_numpy(self.edge_sources, dtype=np.int32).copy()
+            , "edge_targets" : as_numpy(self.edge_targets, dtype=np.int32).copy()
+            }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        graph = cls()
+        graph.kinds.fromstring(np.asarray(arrays["kinds"], dtype=np.uint8).tostring())
+        graph.names = list(arrays["names"])
+        graph.boxes.fromstring(np.asarray(arrays["boxes"], dtype=np.float64).tostring())
+        graph.edge_sources.fromstring(np.asarray(arrays["edge_sources"], dtype=np.int32).tostring())
+        graph.edge_targets.fromstring(np.asarray(arrays["edge_targets"], dtype=np.int32).tostring())
+        for counts, ids in [(graph.input_counts, graph.edge_targets), (graph.output_counts, graph.edge_sources)]:
+            counts.fromstring(np.bincount(as_numpy(ids, dtype=np.int32), minlength=len(graph))
+                .astype(np.int32).tostring())
+        return graph
+
+    # ------------------------------------------------------------------------
+
+    def connect(self, source, target):
+        if self.output_counts[source] >= VERTEX_TYPES[self.kinds[source]].max_outputs:
+            raise RuntimeError("Too many outputs")
+        if self.input_counts[target] >= VERTEX_TYPES[self.kinds[target]].max_inputs:
+            raise RuntimeError("Too many inputs")
+        self._add_edge(source, target)
+
+    def _add_edge(self, source, target):
+        self.edge_sources.append(source)
+        self.edge_targets.append(target)
+        self.output_counts[source] += 1
+        self.input_counts[target] += 1
+        self._inputs = self._outputs = None
+
+    def _group_edges(self, keys, values):
+        keys = as_numpy(keys, dtype=np.int32)
+        values = as_numpy(values, dtype=np.int32)
+        order = np.argsort(keys, kind='mergesort') # Stable, keeps connection order
+        offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys, minlength=len(self)), out=offsets[1:])
+        return offsets, values[order]
+
+    def input_ids(self, index):
+        if self._inputs is None:
+            self._inputs = self._group_edges(self.edge_targets, self.edge_sources)
+        offsets, ids = self._inputs
+        return ids[offsets[index]:offsets[index + 1]].tolist()
+
+    def output_ids(self, index):
+        if self._outputs is None:
+            self._outputs = self._group_edges(self.edge_sources, self.edge_targets)
+        offsets, ids = self._outputs
+        return ids[offsets[index]:offsets[index + 1]].tolist()
+
+    def feedback_loops(self):
+        """The `FeedbackLoop`s of the graph, in order of their first vertex.
+
+        A loop is a strongly connected component of more than one vertex,
+        or a vertex feeding itself. All are found in one pass over the
+        edges.
+        """
+        if self._outputs is None:
+            self._outputs = self._group_edges(self.edge_sources, self.edge_targets)
+        component = strongly_connected_components(*self._outputs)
+        cyclic = np.bincount(component, minlength=len(self))[component] > 1
+        sources = as_numpy(self.edge_sources, dtype=np.int32)
+        cyclic[sources[sources == as_numpy(self.edge_targets, dtype=np.int32)]] = True
+
+        ids = np.flatnonzero(cyclic)
+        ids = ids[np.argsort(component[ids], kind='mergesort')] # Ids stay in order per component
+        groups = np.split(ids, np.flatnonzero(np.diff(component[ids])) + 1) if len(ids) else []
+        return [FeedbackLoop(self, group.tolist()) for group in sorted(groups, key=lambda g: g[0])]
+
+    def absorb(self, other, ids):
+        """Add the vertices and edges of another graph.
+
+        The first vertices of `other` stand for the vertices `ids` of this
+        graph, the rest are appended in order. Edges keep their order, the
+        limits were checked when `other` was built.
+        """
+        mapping = list(ids) + range(len(self), len(self) + len(other) - len(ids))
+        for i in range(len(ids), len(other)):
+            self.kinds.append(other.kinds[i])
+            self.names.append(other.names[i])
+            self.boxes.extend(other.boxes[4 * i:4 * i + 4])
+            self.input_counts.append(0)
+            self.output_counts.append(0)
+        for source, target in zip(other.edge_sources, other.edge_targets):
+            self._add_edge(mapping[source], mapping[target])
+
+    def rollback(self, size, edge_count):
+        # Drop the vertices and edges added since there were `size` and `edge_count`
+        for source, target in zip(self.edge_sources[edge_count:], self.edge_targets[edge_count:]):
+            self.output_counts[source] -= 1
+            self.input_counts[target] -= 1
+        del self.edge_sources[edge_count:]
+        del self.edge_targets[edge_count:]
+        del self.kinds[size:]
+        del self.names[size:]
+        del self.boxes[4 * size:]
+        del self.input_counts[size:]
+        del self.output_counts[size:]
+        self._inputs = self._outputs = None
+
+    # ------------------------------------------------------------------------
+
+    def validate_vertex(self, index):
+        vertex_type = VERTEX_TYPES[self.kinds[index]]
+        name = self.names[index]
+        if self.input_counts[index] > vertex_type.max_inputs:
+            raise RuntimeError("Too many inputs in %s" % name)
+        if self.input_counts[index] < vertex_type.min_inputs:
+            raise RuntimeError("Too few inputs in %s" % name)
+        if self.output_counts[index] > vertex_type.max_outputs:
+            raise RuntimeError("Too few outputs in %s" % name)
+
+    def validate(self):
+        # Check all the vertices at once, then report the first bad one
+        kinds = as_numpy(self.kinds, dtype=np.uint8)
+        input_counts = as_numpy(self.input_counts, dtype=np.int32)
+        output_counts = as_numpy(self.output_counts, dtype=np.int32)
+        bad = ((input_counts > MAX_INPUTS[kinds]) | (input_counts < MIN_INPUTS[kinds])
+            | (output_counts > MAX_OUTPUTS[kinds]))
+        if bad.any():
+            self.validate_vertex(int(np.argmax(bad)))
+
+    # ------------------------------------------------------------------------
+
+    def collapse(self):
+        """Graph without the wiring, just the labels with a logic function.
+
+        Each chain of pass-through vertices (connections, junctions and
+        nodes) is replaced by direct edges from the vertex driving it, so
+        the inputs and gates end up with one output per consumer. Vertices
+        keep their relative order.
+        """
+        n = len(self)
+        kinds = as_numpy(self.kinds, dtype=np.uint8)
+        sources = as_numpy(self.edge_sources, dtype=np.int32)
+        targets = as_numpy(self.edge_targets, dtype=np.int32)
+        passthrough = PASSTHROUGH[kinds]
+
+        # Point every pass-through vertex at its input, then follow the
+        # pointers by doubling until they all reach a real driver
+        driver = np.arange(n)
+        wiring = passthrough[targets]
+        driver[targets[wiring]] = sources[wiring]
+        for i in range(max(1, n).bit_length() + 1):
+            next_driver = driver[driver]
+            if (next_driver == driver).all():
+                break
+            driver = next_driver
+
+        keep = ~passthrough
+        new_index = np.cumsum(keep) - 1
+
+        graph = VertexGraph()
+        for i in np.flatnonzero(keep).tolist():
+            graph.kinds.append(self.kinds[i])
+            graph.names.append(self.names[i])
+            graph.boxes.extend(self.boxes[4 * i:4 * i + 4])
+            graph.input_counts.append(0)
+            graph.output_counts.append(0)
+
+        # Edges into the kept vertices, from whatever drives their wiring
+        # (an undriven chain of wiring is dropped, validation reports it)
+        edge_drivers = driver[sources]
+        use = keep[targets] & keep[edge_drivers]
+        for source, target in zip(new_index[edge_drivers[use]].tolist(), new_index[targets[use]].tolist()):
+            graph._add_edge(source, target)
+        return graph
+
+# ============================================================================
@@ -0,0 +1,143 @@
+import bisect
+import math
+
+import numpy as np
+
+# ============================================================================
+
+class BoxIndex(object):
+    """Uniform grid over axis aligned boxes, for point-in-box queries.
+
+    Each box is registered in every cell it overlaps. With the cell size
+    close to the typical box size, a box only lands in a handful of cells,
+    and a point query only has to check the boxes registered in one cell.
+    """
+
+    def __init__(self, boxes, cell_size=None):
+        self.boxes = list(boxes)
+        if cell_size is None:
+            cell_size = self._typical_size(self.boxes)
+        self.cell_size = float(cell_size)
+        self.cells = {}
+        
+        for i, box in enumerate(self.boxes):
+            (x0, y0), (x1, y1) = box
+            cx0, cy0 = self._cell((x0, y0))
+            cx1, cy1 = self._cell((x1, y1))
+            for cx in range(cx0, cx1 + 1):
+                for cy in range(cy0, cy1 + 1):
+                    self.cells.setdefault((cx, cy), []).append(i)
+
+    @staticmethod
+    def _typical_size(boxes):
+        if not boxes:
+            return 1.0
+        total = 0.0
+        for (x0, y0), (x1, y1) in boxes:
+            total += max(x1 - x0, y1 - y0)
+        return max(total / len(boxes), 1.0)
+
+    def _cell(self, point):
+        return (int(math.floor(point[0] / self.cell_size))
+            , int(math.floor(point[1] / self.cell_size)))
+
+    def candidates(self, point):
+        # Boxes sharing the cell of the point, before the containment test
+        return self.cells.get(self._cell(point), [])
+
+    def query_point(self, point):
+        x, y = point
+        result = []
+        for i in self.candidates(point):
+            (x0, y0), (x1, y1) = self.boxes[i]
+            if (x0 <= x) and (x <= x1) and (y0 <= y) and (y <= y1):
+                result.append(i)
+        return result
+
+# ============================================================================
+
+def nearest_in_direction(points, targets, slope_threshold, downward, max_block=1 << 22):
+    """Nearest target to each point, among those steeply below (or above) it.
+
+    A target qualifies if the line from the point to it is steeper than
+    `slope_threshold`, and goes down (y increasing) if `downward` is set,
+    up otherwise. The distances are computed in blocks of points against
+    all the targets, with at most `max_block` pairs per block.
+
+    Returns an array with the index of the nearest target per point (-1 if
+    none qualifies), and an array of the distances.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    targets = np.asarray(targets, dtype=np.float64).reshape(-1, 2)
+    nearest = np.full(len(points), -1, dtype=np.int64)
+    distances = np.full(len(points), np.inf)
+    if len(targets) == 0:
+        return nearest, distances
+
+    rows = max(1, max_block // len(targets))
+    for start in range(0, len(points), rows):
+        block = points[start:start + rows]
+        dx = targets[:, 0] - block[:, 0:1]
+        dy = targets[:, 1] - block[:, 1:2]
+        valid = np.abs(dy) > slope_threshold * np.abs(dx)
+        valid &= (dy > 0) if downward else (dy < 0)
+        dist = np.where(valid, np.sqrt(dx * dx + dy * dy), np.inf)
+
+        best = dist.argmin(axis=1)
+        best_dist = dist[np.arange(len(block)), best]
+        found = np.isfinite(best_dist)
+        nearest[start:start + len(block)][found] = best[found]
+        distances[start:start + len(block)] = best_dist
+    return nearest, distances
+
+# ============================================================================
+
+def box_point_pairs(boxes, points):
+    """All pairs of (box index, point index) with the point inside the box.
+
+    A sweep over x: each box is active from its left to its right edge, and
+    the active boxes are kept sorted on their top edge, so a point only
+    checks those with the top edge at most the tallest box height above it.
+    Takes O((n + k) log n) for n boxes and points and k candidate pairs.
+
+    Returns two index arrays, in order of point, then box.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 2, 2)
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if (len(boxes) == 0) or (len(points) == 0):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    height = (boxes[:, 1, 1] - boxes[:, 0, 1]).max()
+
+    # Events at the same x: boxes open, then points, then boxes close
+    xs = np.concatenate([boxes[:, 0, 0], points[:, 0], boxes[:, 1, 0]])
+    kinds = np.repeat([0, 1, 2], [len(boxes), len(points), len(boxes)])
+    ids = np.concatenate([np.arange(len(boxes)), np.arange(len(points)), np.arange(len(boxes))])
+    order = np.lexsort((kinds, xs))
+
+    tops = boxes[:, 0, 1].tolist()
+    bottoms = boxes[:, 1, 1].tolist()
+    ys = points[:, 1].tolist()
+    active = [] # Sorted (top, box index)
+    box_ids = []
+    point_ids = []
+    for kind, i in zip(kinds[order].tolist(), ids[order].tolist()):
+        if kind == 0:
+            bisect.insort(active, (tops[i], i))
+        elif kind == 2:
+            del active[bisect.bisect_left(active, (tops[i], i))]
+        else:
+            y = ys[i]
+            start = bisect.bisect_left(active, (y - height, -1))
+            end = bisect.bisect_right(active, (y, len(tops)))
+            matches = [b for top, b in active[start:end] if y <= bottoms[b]]
+            if matches:
+                box_ids.extend(matches)
+                point_ids.extend([i] * len(matches))
+
+    box_ids = np.array(box_ids, dtype=np.int64)
+    point_ids = np.array(point_ids, dtype=np.int64)
+    order = np.lexsort((box_ids, point_ids))
+    return box_ids[order], point_ids[order]
+
+# ============================================================================
+
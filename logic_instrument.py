@@ -0,0 +1,68 @@
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# ============================================================================
+
+class Instrumentation(object):
+    """Counters, phase timings and (optionally) trace events of an analysis.
+
+    The analysis code only touches this when an instance is attached to the
+    `DataSet`, so a disabled instrumentation costs a single `is None` check
+    per instrumented step.
+
+    Trace events are dicts with the event kind under "event". They are kept
+    in `events`, or passed to `sink` if one is given.
+    """
+
+    def __init__(self, trace=False, sink=None):
+        self.trace = trace or (sink is not None)
+        self.sink = sink
+        self.events = []
+        self.counters = Counter()
+        self.phases = {} # Phase name -> seconds
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def event(self, kind, **fields):
+        if not self.trace:
+            return
+        fields["event"] = kind
+        if self.sink is not None:
+            self.sink(fields)
+        else:
+            self.events.append(fields)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.time() - start
+
+    def summary(self):
+        return {
+            "counters" : dict(self.counters)
+            , "phases" : dict(self.phases)
+            }
+
+# ----------------------------------------------------------------------------
+
+@contextmanager
+def null_phase():
+    yield
+
+# ----------------------------------------------------------------------------
+
+def format_event(event):
+    fields = ", ".join("%s=%s" % (key, event[key]) for key in sorted(event) if key != "event")
+    return "%s: %s" % (event["event"], fields)
+
+# ----------------------------------------------------------------------------
+
+def print_event(event):
+    print format_event(event)
+
+# ============================================================================
@@ -0,0 +1,133 @@
+import json
+import os
+
+# ============================================================================
+
+def normalize_chart(record):
+    # Chart from JSON has lists where the literal datasets have tuples
+    lines = [[tuple(p) for p in line] for line in record["lines"]]
+    labels = [[label[0]] + [tuple(p) for p in label[1:3]] for label in record["labels"]]
+    return lines, labels
+
+# ----------------------------------------------------------------------------
+
+def load_chart(source):
+    """Load the lines and labels of a single chart.
+
+    The source is either a path to a JSON file with "lines" and "labels",
+    or the name of one of the sample datasets in `logic_data`.
+    """
+    if source.startswith("dataset_") and not source.endswith(".json"):
+        import logic_data
+        record = getattr(logic_data, source, None)
+        if record is None:
+            raise RuntimeError("Unknown sample dataset '%s'" % source)
+        return normalize_chart(record)
+
+    with open(source) as f:
+        return normalize_chart(json.load(f))
+
+# ----------------------------------------------------------------------------
+
+def load_labels(source):
+    """Load the labels of a single chart.
+
+    As `load_chart`, but a JSON file may hold the labels only, as written
+    by `logic_detect.py`.
+    """
+    if source.startswith("dataset_") and not source.endswith(".json"):
+        return load_chart(source)[1]
+
+    with open(source) as f:
+        record = json.load(f)
+    return normalize_chart({"lines" : record.get("lines", []), "labels" : record["labels"]})[1]
+
+# ============================================================================
+
+def iter_chart_sources(path):
+    """Enumerate the charts of a batch, without parsing them.
+
+    The batch is either a directory of JSON chart files (in name order), a
+    chart archive (see `logic_archive`), or a JSONL file with one chart
+    record per line. Yields pairs of (chart id, source), where the source is
+    passed to `read_chart_source`, so the parsing can happen in a worker
+    process.
+    """
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".json"):
+                yield name, ("file", os.path.join(path, name))
+        return
+
+    if is_archive(path):
+        archive = open_archive(path)
+        for i in range(len(archive)):
+            chart_id = archive.chart_id(i)
+            yield (chart_id if chart_id is not None else i), ("archive", (path, i))
+        return
+
+    with open(path) as f:
+        for i, text in enumerate(f):
+            if text.strip():
+                yield i, ("text", text)
+
+# ----------------------------------------------------------------------------
+
+def iter_named_sources(names):
+    """Enumerate the charts of several inputs given on a command line.
+
+    An input is "logic_data" (all the sample datasets), the name of one of
+    them ("dataset_0"), a chart JSON file, or a batch as taken by
+    `iter_chart_sources`. Yields (chart id, source) pairs likewise.
+    """
+    for name in names:
+        if name == "logic_data":
+            import logic_data
+            for dataset in sorted(key for key in dir(logic_data) if key.startswith("dataset_")):
+                yield dataset, ("sample", dataset)
+        elif name.startswith("dataset_") and not name.endswith(".json"):
+            yield name, ("sample", name)
+        elif name.endswith(".json"):
+            yield name, ("file", name)
+        else:
+            for chart_id, source in iter_chart_sources(name):
+                yield chart_id, source
+
+# ----------------------------------------------------------------------------
+
+def read_chart_source(source):
+    # Returns (chart id or None, lines, labels)
+    kind, value = source
+    if kind == "sample":
+        lines, labels = load_chart(value)
+        return None, lines, labels
+    if kind == "archive":
+        path, i = value
+        lines, labels = open_archive(path)[i]
+        return None, lines, labels
+    if kind == "file":
+        with open(value) as f:
+            record = json.load(f)
+    else:
+        record = json.loads(value)
+    lines, labels = normalize_chart(record)
+    return record.get("id"), lines, labels
+
+# ============================================================================
+
+def is_archive(path):
+    from logic_archive import MAGIC
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+# ----------------------------------------------------------------------------
+
+_archives = {} # Path -> `ChartArchive`, opened once per process
+
+def open_archive(path):
+    from logic_archive import ChartArchive
+    if path not in _archives:
+        _archives[path] = ChartArchive(path)
+    return _archives[path]
+
+# ============================================================================
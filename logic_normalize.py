@@ -0,0 +1,371 @@
+"""Clean up detected line segments before tracing.
+
+Line detectors break a wire into collinear fragments, and report some
+stretches twice. `normalize_lines` merges the fragments of each wire and
+drops duplicates: first those on one track, with sorts over the whole
+set, then those of wires drawn or scanned askew, along their fitted line.
+Wires skewed by no more than a few pixels are snapped onto their axis.
+
+    python logic_normalize.py chart.json -o clean.json
+"""
+
+import argparse
+import json
+import sys
+
+import numpy as np
+
+from logic_utils import are_lines_horizontal
+from logic_index import box_point_pairs
+
+# ============================================================================
+
+SNAP_DISTANCE = 4 # Segments skewed by at most this much across are snapped
+TRACK_DISTANCE = 3 # Snapped segments this close across lie on the same wire ...
+GAP_DISTANCE = 10 # ... and are merged if the gap between them is at most this
+TRACK_SLOPE = 0.02 # Across a fitted line, fragments may stray this much more per pixel beyond its ends
+MAX_SKEW = 0.3 # Slope across beyond which a segment is no wire along the axis (about 17 degrees)
+
+# ============================================================================
+
+def _axis_segments(points, ids, axis):
+    # The lines as (along, across) points on the axis, ends in order along
+    segments = points[ids][:, :, [axis, 1 - axis]]
+    swap = segments[:, 0, 0] > segments[:, 1, 0]
+    segments[swap] = segments[swap, ::-1]
+    return segments
+
+# ----------------------------------------------------------------------------
+
+def _merge_tracks(along, across, gap, offset):
+    """Merge segments on one axis, given as their (N, 2) extents along it and position across.
+
+    Returns the index of the merged segment of each input segment, the
+    merged extents and positions, and whether each input segment lay
+    entirely within the ones before it.
+    """
+    count = len(along)
+    if count == 0:
+        return np.zeros(0, dtype=np.int64), along, across, np.zeros(0, dtype=bool)
+
+    # Tracks of segments chained by their position across
+    order = np.argsort(across, kind='mergesort')
+    track = np.zeros(count, dtype=np.int64)
+    track[order[1:]] = np.cumsum(np.diff(across[order]) > offset)
+
+    # Along each track, runs of overlapping or nearly touching segments.
+    # Tracks are laid end to end, far enough apart that no run spans two.
+    low = along.min()
+    span = along.max() - low + gap + 1
+    start = along[:, 0] - low + track * span
+    end = along[:, 1] - low + track * span
+    order = np.lexsort((end, start, track))
+    start = start[order]
+    end = end[order]
+    reach = np.maximum.accumulate(end)
+    is_first = np.ones(count, dtype=bool)
+    is_first[1:] = start[1:] > reach[:-1] + gap
+    contained = np.zeros(count, dtype=bool)
+    contained[order[1:]] = ~is_first[1:] & (end[1:] <= reach[:-1])
+
+    bounds = np.flatnonzero(is_first)
+    run = np.empty(count, dtype=np.int64)
+    run[order] = np.cumsum(is_first) - 1
+
+    # Longer fragments weigh more in the position of the merged wire
+    weight = (along[order, 1] - along[order, 0]) + 1.0
+    merged_along = np.stack([np.minimum.reduceat(along[order, 0], bounds)
+        , np.maximum.reduceat(along[order, 1], bounds)], axis=1)
+    merged_across = np.add.reduceat(across[order] * weight, bounds) / np.add.reduceat(weight, bounds)
+    return run, merged_along, merged_across, contained
+
+# ----------------------------------------------------------------------------
+
+def _wire_pairs(segments, real, offset, gap):
+    """Pairs of segments on one axis that are fragments of the same wire.
+
+    The segments are an (N, 2, 2) array of (along, across) points, ends in
+    order along. As in `WireTopology.build`, each real segment inflated by
+    `gap` along and the track tolerance across is a box for
+    `box_point_pairs` to match against all the segment ends. The candidate
+    pairs are then measured against the line of the longer segment: both
+    ends of the shorter one must lie within `offset` of it across, plus
+    TRACK_SLOPE per pixel beyond its ends, and within `gap` of it along.
+
+    Returns the pairs as two index arrays, the longer segment first.
+    """
+    ids = np.flatnonzero(real)
+    slack = np.array([gap, offset + TRACK_SLOPE * gap])
+    boxes = np.stack([segments[ids].min(axis=1) - slack, segments[ids].max(axis=1) + slack], axis=1)
+    box_ids, point_ids = box_point_pairs(boxes, segments.reshape(-1, 2))
+    first = ids[box_ids]
+    second = point_ids // 2
+    keep = first != second
+    first = first[keep]
+    second = second[keep]
+
+    length = segments[:, 1, 0] - segments[:, 0, 0]
+    swap = (length[second] > length[first]) | ((length[second] == length[first]) & (second < first))
+    longer = np.where(swap, second, first)
+    shorter = np.where(swap, first, second)
+
+    start = segments[longer, 0]
+    end = segments[longer, 1]
+    slope = (end[:, 1] - start[:, 1]) / np.maximum(end[:, 0] - start[:, 0], 1e-9)
+    fits = (segments[shorter, 0, 0] <= end[:, 0] + gap) & (segments[shorter, 1, 0] >= start[:, 0] - gap)
+    for i in [0, 1]:
+        point = segments[shorter, i]
+        beyond = np.maximum(np.maximum(start[:, 0] - point[:, 0], point[:, 0] - end[:, 0]), 0)
+        distance = np.abs(point[:, 1] - start[:, 1] - slope * (point[:, 0] - start[:, 0]))
+        fits &= distance <= offset + TRACK_SLOPE * beyond
+    return longer[fits], shorter[fits]
+
+# ----------------------------------------------------------------------------
+
+def _components(count, first, second):
+    # Component of each of `count` items joined by the pairs, as its lowest
+    # item: minima are passed along the pairs, with pointer jumping, until
+    # nothing changes
+    component = np.arange(count)
+    while True:
+        low = np.minimum(component[first], component[second])
+        update = component.copy()
+        np.minimum.at(update, first, low)
+        np.minimum.at(update, second, low)
+        update = update[update]
+        if (update == component).all():
+            return component
+        component = update
+
+# ----------------------------------------------------------------------------
+
+def _fit_lines(points, bounds):
+    """Line fitted through the ends of each group of segments, given in a row from `bounds`.
+
+    Longer segments weigh more. Returns the weighted mean point, the slope
+    across, and the extent along of each group.
+    """
+    sizes = np.diff(np.append(bounds, len(points)))
+    weight = (points[:, 1, 0] - points[:, 0, 0]) + 1.0
+    total = 2 * np.add.reduceat(weight, bounds)
+    mean = np.add.reduceat(points.sum(axis=1) * weight[:, None], bounds) / total[:, None]
+    centered = points - np.repeat(mean, sizes, axis=0)[:, None, :]
+    spread = np.add.reduceat((centered[:, :, 0] ** 2).sum(axis=1) * weight, bounds)
+    covariance = np.add.reduceat((centered[:, :, 0] * centered[:, :, 1]).sum(axis=1) * weight, bounds)
+    slope = covariance / np.maximum(spread, 1e-9)
+    low = np.minimum.reduceat(points[:, 0, 0], bounds)
+    high = np.maximum.reduceat(points[:, 1, 0], bounds)
+    return mean, slope, low, high
+
+# ----------------------------------------------------------------------------
+
+def _line_segments(mean, slope, low, high):
+    # The fitted lines, from `low` to `high` along
+    segments = np.empty((len(mean), 2, 2), dtype=np.float64)
+    segments[:, 0, 0] = low
+    segments[:, 1, 0] = high
+    segments[:, :, 1] = mean[:, 1:2] + slope[:, None] * (segments[:, :, 0] - mean[:, 0:1])
+    return segments
+
+# ----------------------------------------------------------------------------
+
+def _merge_wires(segments, fragments, snap, offset, gap):
+    """Merge the segments of one axis into wires, along their fitted line.
+
+    The segments are (along, across) as for `_wire_pairs`, with the number
+    of real fragments in each; those without any (specks) only join others.
+    Returns the index of the wire of each segment (-1 for none), then per
+    wire the merged segment, whether it was snapped to its axis (and is
+    left flat), and the number of fragments. Also returns which segments
+    lay entirely within a longer one of their wire.
+    """
+    count = len(segments)
+    real = fragments > 0
+    if count == 0:
+        return np.zeros(0, dtype=np.int64), segments, np.zeros(0, dtype=bool), fragments, real
+    longer, shorter = _wire_pairs(segments, real, offset, gap)
+    contained = np.zeros(count, dtype=bool)
+    contained[shorter[(segments[shorter, 0, 0] >= segments[longer, 0, 0])
+        & (segments[shorter, 1, 0] <= segments[longer, 1, 0])]] = True
+
+    # Wires of at least one real segment, their segments in a row
+    component = _components(count, longer, shorter)
+    kept = np.zeros(count, dtype=bool)
+    kept[component[real]] = True
+    order = np.flatnonzero(kept[component])
+    order = order[np.argsort(component[order], kind='mergesort')]
+    is_first = np.ones(len(order), dtype=bool)
+    is_first[1:] = component[order[1:]] != component[order[:-1]]
+    bounds = np.flatnonzero(is_first)
+    sizes = np.diff(np.append(bounds, len(order)))
+    wire = np.full(count, -1, dtype=np.int64)
+    wire[order] = np.cumsum(is_first) - 1
+
+    mean, slope, low, high = _fit_lines(segments[order], bounds)
+    snapped = np.abs(slope) * (high - low) <= snap
+    slope[snapped] = 0.0
+    merged = _line_segments(mean, slope, low, high)
+
+    # A lone segment comes out as it went in, unless snapped
+    alone = (sizes == 1) & ~snapped
+    merged[alone] = segments[order[bounds[alone]]]
+    return wire, merged, snapped, np.add.reduceat(fragments[order], bounds), contained
+
+# ----------------------------------------------------------------------------
+
+def normalize_lines(lines, snap=SNAP_DISTANCE, offset=TRACK_DISTANCE, gap=GAP_DISTANCE):
+    """Snap, merge and deduplicate line segments.
+
+    A segment whose ends differ by at most `snap` across its main direction
+    is moved onto its axis. Snapped segments within `offset` of each other
+    across, and overlapping or with a gap of at most `gap` along, are merged
+    into one. Specks, segments no longer than `snap` either way, can join
+    wires in both directions but are dropped otherwise.
+
+    Segments skewed more, but within MAX_SKEW of an axis, are wires drawn
+    askew. They are merged with the fragments lying within `offset` across
+    of their line, plus TRACK_SLOPE per pixel beyond their ends, so the
+    tolerance grows with the distance along rather than being fixed to the
+    axis. Wires merged this way come out on the line fitted to their
+    fragments, or on their axis if that is skewed by at most `snap` over
+    its length. Other segments are only deduplicated. The lines keep the
+    order of their first fragment, so a chart without fragments comes out
+    as it went in, up to the snapping.
+
+    Snapped lines come out axis aligned. Integer coordinates are rounded
+    back to integers.
+
+    Returns the (N, 2, 2) array of lines and a summary of what was removed.
+    """
+    lines = np.asarray(lines).reshape(-1, 2, 2)
+    integral = np.issubdtype(lines.dtype, np.integer)
+    points = lines.astype(np.float64)
+    dx = np.abs(points[:, 1, 0] - points[:, 0, 0])
+    dy = np.abs(points[:, 1, 1] - points[:, 0, 1])
+    specks = (dx <= snap) & (dy <= snap)
+    snap_h = (dy <= snap) & (dy <= dx) & ~specks
+    snap_v = (dx <= snap) & (dx < dy) & ~specks
+    skew_h = (dy <= MAX_SKEW * dx) & ~(snap_h | specks)
+    skew_v = (dx <= MAX_SKEW * dy) & ~(snap_v | specks)
+    other = np.flatnonzero(~(snap_h | snap_v | skew_h | skew_v | specks))
+
+    outputs = [] # (first fragment, line) arrays, put back in input order
+    contained = 0
+    snapped_count = 0
+    for snapped, skewed, axis in [(snap_h, skew_h, 0), (snap_v, skew_v, 1)]:
+        # The fragments on each track first, all with sorts
+        ids = np.flatnonzero(snapped | specks)
+        segments = _axis_segments(points, ids, axis)
+        run, merged_along, merged_across, inside = _merge_tracks(segments[:, :, 0]
+            , segments[:, :, 1].mean(axis=1), gap, offset)
+        real = ~specks[ids]
+        contained += int((inside & real).sum())
+        first = np.full(len(merged_along), len(lines), dtype=np.int64)
+        np.minimum.at(first, run[real], ids[real])
+        fragments = np.bincount(run[real], minlength=len(merged_along))
+
+        # Then the wires drawn askew, with each track as a segment on its
+        # fitted line. Fragments no more skewed than `offset` are chained
+        # on their tracks already, so this is only needed for those that are.
+        tracks = np.zeros((0, 2, 2))
+        if len(ids):
+            order = np.argsort(run, kind='mergesort')
+            bounds = np.flatnonzero(np.diff(np.append(-1, run[order])))
+            tracks = _line_segments(*_fit_lines(segments[order], bounds))
+        skewed_ids = np.flatnonzero(skewed)
+        if len(skewed_ids) or (np.abs(tracks[:, 1, 1] - tracks[:, 0, 1]) > offset).any():
+            segments = np.concatenate([tracks, _axis_segments(points, skewed_ids, axis)])
+            first = np.concatenate([first, skewed_ids])
+            fragments = np.concatenate([fragments, np.ones(len(skewed_ids), dtype=np.int64)])
+
+            wire, merged, is_snapped, wire_fragments, inside = _merge_wires(segments, fragments, snap
+                , offset, gap)
+            contained += int(fragments[inside].sum())
+            wire_first = np.full(len(merged), len(lines), dtype=np.int64)
+            np.minimum.at(wire_first, wire[wire >= 0], first[wire >= 0])
+            snapped_count += int(wire_fragments[is_snapped].sum())
+        else:
+            keep = fragments > 0 # Runs of specks only are dropped
+            wire_first = first[keep]
+            merged = np.empty((keep.sum(), 2, 2), dtype=np.float64)
+            merged[:, :, 0] = merged_along[keep]
+            merged[:, :, 1] = merged_across[keep, None]
+            snapped_count += int(fragments.sum())
+
+        if integral:
+            merged = np.round(merged)
+        outputs.append((wire_first, merged[:, :, [axis, 1 - axis]]))
+
+    # The rest, ordered along their direction as the trace expects
+    rest = points[other]
+    horizontal = are_lines_horizontal(rest)
+    swap = np.where(horizontal, rest[:, 0, 0] > rest[:, 1, 0], rest[:, 0, 1] > rest[:, 1, 1])
+    rest[swap] = rest[swap, ::-1]
+    unique, first = _unique_rows(rest.reshape(-1, 4))
+    outputs.append((other[first], unique.reshape(-1, 2, 2)))
+
+    order = np.argsort(np.concatenate([ids for ids, merged in outputs]), kind='mergesort')
+    result = np.concatenate([merged for ids, merged in outputs])[order]
+    if integral:
+        result = result.astype(lines.dtype)
+
+    duplicates = contained + len(other) - len(unique)
+    summary = {
+        "lines_in" : len(lines)
+        , "lines_out" : len(result)
+        , "snapped" : snapped_count
+        , "specks" : int(specks.sum())
+        , "duplicates" : duplicates
+        , "merged" : len(lines) - len(result) - duplicates - int(specks.sum())
+        }
+    return result, summary
+
+# ----------------------------------------------------------------------------
+
+def _unique_rows(rows):
+    # Distinct rows, in order of first occurrence, and the index of that
+    if len(rows) == 0:
+        return rows, np.zeros(0, dtype=np.int64)
+    order = np.lexsort(rows.T[::-1])
+    sorted_rows = rows[order]
+    is_first = np.ones(len(rows), dtype=bool)
+    is_first[1:] = (sorted_rows[1:] != sorted_rows[:-1]).any(axis=1)
+    first = np.sort(order[is_first])
+    return rows[first], first
+
+# ----------------------------------------------------------------------------
+
+def format_summary(summary):
+    removed = summary["lines_in"] - summary["lines_out"]
+    return "%d lines -> %d (%.1f%% fewer): %d snapped, %d merged, %d duplicates, %d specks" % (
+        summary["lines_in"], summary["lines_out"], 100.0 * removed / max(summary["lines_in"], 1)
+        , summary["snapped"], summary["merged"], summary["duplicates"], summary["specks"])
+
+# ============================================================================
+
+def main(argv=None):
+    from logic_io import load_chart
+
+    parser = argparse.ArgumentParser(description="Snap, merge and deduplicate the lines of a chart.")
+    parser.add_argument("chart", help="chart JSON file, or the name of a sample dataset (dataset_N)")
+    parser.add_argument("-o", "--output", help="write the chart with the normalized lines to this JSON file")
+    parser.add_argument("--snap", type=float, default=SNAP_DISTANCE
+        , help="largest skew across a line that is snapped to its axis (default: %(default)s)")
+    parser.add_argument("--offset", type=float, default=TRACK_DISTANCE
+        , help="largest offset across between fragments of a wire (default: %(default)s)")
+    parser.add_argument("--gap", type=float, default=GAP_DISTANCE
+        , help="largest gap along between fragments of a wire (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    lines, labels = load_chart(args.chart)
+    lines, summary = normalize_lines(lines, args.snap, args.offset, args.gap)
+    sys.stderr.write(format_summary(summary) + "\n")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"lines" : lines.tolist(), "labels" : labels}, f)
+    return 0
+
+# ============================================================================
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,201 @@
+import multiprocessing
+
+import numpy as np
+
+from logic_index import box_point_pairs
+
+# ============================================================================
+
+class DisjointSets(object):
+    # Union-find over 0..n-1, with path halving and union by size
+    def __init__(self, n):
+        self.parent = range(n)
+        self.size = [1] * n
+
+    def find(self, i):
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, i, j):
+        i = self.find(i)
+        j = self.find(j)
+        if i == j:
+            return
+        if self.size[i] < self.size[j]:
+            i, j = j, i
+        self.parent[j] = i
+        self.size[i] += self.size[j]
+
+    def roots(self):
+        return [self.find(i) for i in range(len(self.parent))]
+
+# ============================================================================
+
+class Component(object):
+    """Lines and labels of a `DataSet` that only connect among themselves.
+
+    The ids index `lines_h`, `lines_v` and the labels (which are the first
+    vertices of the graph), in increasing order. `input_positions` are the
+    positions in `inputs` of the inputs among the labels.
+    """
+
+    def __init__(self, h_ids, v_ids, label_ids, input_positions):
+        self.h_ids = h_ids
+        self.v_ids = v_ids
+        self.label_ids = label_ids
+        self.input_positions = input_positions
+
+    def __len__(self):
+        return len(self.h_ids) + len(self.v_ids) + len(self.label_ids)
+
+# ----------------------------------------------------------------------------
+
+def find_components(ds):
+    """Split the lines and labels of a `DataSet` into independent components.
+
+    Everything the trace can follow from one item to another joins them:
+    the contacts of the wire topology, line ends inside labels, and node
+    bridges. Tracing one component never looks at the others. Components
+    are in order of their first label, those with only lines last.
+    """
+    count_h = len(ds.lines_h)
+    count_v = len(ds.lines_v)
+    count_labels = len(ds.labels)
+    base = count_h + count_v # Items are the h lines, v lines, then labels
+    sets = DisjointSets(base + count_labels)
+
+    for h, v in zip(ds.topology.h.tolist(), ds.topology.v.tolist()):
+        sets.union(h, count_h + v)
+
+    # Endpoint 2 * i + end belongs to line i, counting v lines after h lines
+    points = np.concatenate([ds.lines_h.endpoints.reshape(-1, 2), ds.lines_v.endpoints.reshape(-1, 2)])
+    box_ids, point_ids = box_point_pairs([ds.graph.bounding_box(i) for i in range(count_labels)], points)
+    for label, line in zip(box_ids.tolist(), (point_ids // 2).tolist()):
+        sets.union(base + label, line)
+
+    for node, (partner, line) in ds.node_links[True].items():
+        sets.union(base + node.index, base + ds.nodes[partner].index)
+
+    # Group the items by root, in order of the first label of each group
+    roots = np.array(sets.roots(), dtype=np.int64)
+    first = np.full(len(roots), len(roots), dtype=np.int64)
+    np.minimum.at(first, roots[base:], np.arange(count_labels))
+    order = np.lexsort((np.arange(len(roots)), roots, first[roots]))
+    bounds = np.flatnonzero(np.diff(roots[order])) + 1
+
+    input_positions = dict((input.index, k) for k, input in enumerate(ds.inputs))
+    components = []
+    for items in np.split(order, bounds):
+        if len(items) == 0:
+            continue
+        labels = items[items >= base] - base
+        components.append(Component(items[items < count_h]
+            , items[(items >= count_h) & (items < base)] - count_h
+            , labels
+            , [input_positions[i] for i in labels.tolist() if i in input_positions]))
+    return components
+
+# ============================================================================
+
+def trace_inputs(ds, input_positions):
+    """Trace from each input of a `DataSet` in turn, as `analyze` does.
+
+    Returns the first error and the position of the input it came from, as
+    given by `input_positions`, or (None, None).
+    """
+    for position, input in zip(input_positions, ds.inputs):
+        try:
+            ds._schedule(ds.process_input, input)
+            ds._run_tasks()
+        except Exception as e:
+            return e, position
+    return None, None
+
+# ----------------------------------------------------------------------------
+
+def trace_component(task):
+    """Trace one component in a `DataSet` of its own, in a worker process.
+
+    Stops at the first error, and reports it with the position of the input
+    being traced, rather than raising.
+    """
+    from logic import DataSet
+    from logic_instrument import Instrumentation
+    from logic_topology import WireTopology
+
+    index, lines, labels, topology, tolerance, slope_threshold, input_positions, counted, trace = task
+    ds = DataSet(lines, labels, tolerance, slope_threshold, topology=WireTopology.from_arrays(topology))
+    if counted:
+        ds.instrumentation = Instrumentation(trace)
+
+    error, position = trace_inputs(ds, input_positions)
+    result = {
+        "index" : index
+        , "error" : error
+        , "position" : position
+        }
+    if error is not None:
+        return result
+
+    result["graph"] = ds.graph
+    result["used_h"] = ds.lines_h.used
+    result["used_v"] = ds.lines_v.used
+    if counted:
+        result["counters"] = dict(ds.instrumentation.counters)
+        result["events"] = ds.instrumentation.events
+    return result
+
+# ----------------------------------------------------------------------------
+
+def trace_components(ds, components, processes=None):
+    """Trace the components of a `DataSet` on a process pool, merging the results into it.
+
+    Gives the same graph as tracing the whole chart, up to the numbering of
+    the wiring vertices. On failure raises the error the whole trace would
+    have hit first, the one of the earliest input, and leaves the
+    `DataSet` untraced.
+    """
+    instr = ds.instrumentation
+    lines_h = ds.lines_h.endpoints
+    lines_v = ds.lines_v.endpoints
+    tasks = [(i
+        , np.concatenate([lines_h[c.h_ids], lines_v[c.v_ids]])
+        , [ds.labels[j] for j in c.label_ids.tolist()]
+        , ds.topology.subset(c.h_ids, c.v_ids).arrays()
+        , ds.tolerance
+        , ds.slope_threshold
+        , c.input_positions
+        , instr is not None
+        , (instr is not None) and instr.trace)
+        for i, c in enumerate(components)]
+    tasks.sort(key=lambda task: -len(task[1])) # Biggest first, to balance the load
+
+    results = [None] * len(components)
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(trace_component, tasks):
+            results[result["index"]] = result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    failed = [result for result in results if result["error"] is not None]
+    if failed:
+        raise min(failed, key=lambda result: result["position"])["error"]
+
+    for c, result in zip(components, results):
+        ds.graph.absorb(result["graph"], c.label_ids.tolist())
+        ds.lines_h.used[c.h_ids] = result["used_h"]
+        ds.lines_v.used[c.v_ids] = result["used_v"]
+        if instr is not None:
+            instr.counters.update(result["counters"])
+            for event in result["events"]:
+                instr.event(event.pop("event"), **event)
+
+# ============================================================================
@@ -0,0 +1,301 @@
+"""Trace charts with ambiguous geometry by searching over the choices.
+
+Where a plain `DataSet` finds several candidates for one connection (two
+gates around a line end, two lines near a corner, two lines leaving a
+gate) it gives up. A `ResolvingDataSet` makes each such lookup a choice
+point instead, and searches for the best consistent graph:
+
+    ds = ResolvingDataSet(lines, labels)
+    ds.analyze()
+    print ds.expressions, ds.resolution.confidence
+
+The candidates of a choice get probabilities from their distances, p ~
+exp(-distance / tolerance), and the confidence of a trace is the product
+of the p of its choices: 1 for a chart without ambiguity, 0.5 for a coin
+toss. Lines can be left over as noise; the search minimizes the -log p of
+the choices plus UNUSED_LINE_COST per line left.
+
+The search is depth first, nearest candidates first, so the first trace
+found is the greedy one; it then goes back over the choices while they
+can still give a cheaper trace (branch and bound). Candidates a vertex
+has no room for (`max_inputs`) are dropped before branching, a choice
+left with one candidate is no choice, and whenever the trace is done
+with an input, every gate and output must still have enough unused lines
+ending in it to get its `min_inputs`. After MAX_BRANCHES choice points
+the search only follows the nearest candidates.
+"""
+
+import math
+from collections import deque
+
+import numpy as np
+
+from logic import DataSet, LINE_CONN_TOLERANCE, SLOPE_THRESHOLD
+from logic_classes import Vertex
+from logic_graph import as_numpy
+from logic_index import box_point_pairs
+
+# ============================================================================
+
+MAX_BRANCHES = 1000 # Choice points searched, beyond which the nearest candidate is taken
+MAX_CANDIDATES = 4 # Candidates tried per choice point, the nearest ones
+UNUSED_LINE_COST = math.log(2) # A line left out costs as much as a coin toss
+
+# ============================================================================
+
+class ChoicePoint(Exception):
+    # Raised by `ResolvingDataSet._choose` before the step changed anything;
+    # the step is retried with one of the candidates after the choices
+    # it made before (`taken`)
+    def __init__(self, error, costs, taken):
+        Exception.__init__(self, error)
+        self.error = error
+        self.costs = costs # Per candidate, in order of trial
+        self.taken = taken
+        self.task = None
+
+# ----------------------------------------------------------------------------
+
+class Resolution(object):
+    """How a `ResolvingDataSet` traced its chart.
+
+    `choices` lists the ambiguous lookups of the trace as (error of a plain
+    trace, number of candidates, probability of the one taken), and
+    `unused_h`/`unused_v` the lines left out. `cost` is what the search
+    minimized, see the module docs. `branches` choice points were
+    searched and `solutions` consistent traces found; `complete` is False
+    if the search ran out of branches, and the trace may not be the best.
+    """
+
+    def __init__(self, cost, choices, unused_h, unused_v, branches, solutions, complete):
+        self.cost = cost
+        self.choices = choices
+        self.unused_h = unused_h
+        self.unused_v = unused_v
+        self.branches = branches
+        self.solutions = solutions
+        self.complete = complete
+
+    @property
+    def confidence(self):
+        return float(np.prod([choice[2] for choice in self.choices]))
+
+    def summary(self):
+        return {
+            "confidence" : self.confidence
+            , "choices" : len(self.choices)
+            , "unused_lines" : len(self.unused_h) + len(self.unused_v)
+            , "cost" : self.cost
+            , "branches" : self.branches
+            , "solutions" : self.solutions
+            , "complete" : self.complete
+            }
+
+# ============================================================================
+
+class ResolvingDataSet(DataSet):
+    """`DataSet` that searches over the ambiguous connections, see above.
+
+    `analyze` traces in-process, and sets `resolution`. Lines left over are
+    not an error in `validate`, they are listed in the resolution.
+    """
+
+    def __init__(self, lines, labels, tolerance=LINE_CONN_TOLERANCE
+            , slope_threshold=SLOPE_THRESHOLD, instrumentation=None, topology=None
+            , max_branches=MAX_BRANCHES, max_candidates=MAX_CANDIDATES):
+        DataSet.__init__(self, lines, labels, tolerance, slope_threshold, instrumentation, topology)
+        self.max_branches = max_branches
+        self.max_candidates = max_candidates
+        self.resolution = None
+
+        self._decisions = deque() # Candidates to take at the coming choice points
+        self._taken = [] # ... taken by the step running
+        self._chosen = [] # (error, candidates, probability) of each choice made
+        self._marks = [] # (used mask, line id) of the lines marked used, in order
+        self._input_lines = None # Found once there is a choice to prune, see `_check_input_lines`
+        self._checked = 0 # Choices made when the input lines were last checked
+
+    def _initialize_input_lines(self):
+        # The h line ends in each gate and output, the only ways in
+        labels = [v for v in self.gates + self.outputs if v.min_inputs > 0]
+        self._label_ids = np.array([v.index for v in labels], dtype=np.int64)
+        self._label_names = [v.name for v in labels]
+        self._min_inputs = np.array([v.min_inputs for v in labels], dtype=np.int64)
+        box_ids, point_ids = box_point_pairs([v.bounding_box for v in labels]
+            , self.lines_h.endpoints.reshape(-1, 2))
+        self._input_lines = (box_ids, point_ids // 2)
+
+    def mark_h_line_used(self, index):
+        DataSet.mark_h_line_used(self, index)
+        self._marks.append((self.lines_h.used, index))
+
+    def mark_v_line_used(self, index):
+        DataSet.mark_v_line_used(self, index)
+        self._marks.append((self.lines_v.used, index))
+
+    def _validate(self):
+        self.graph.validate()
+
+    def find_output_h_lines(self, source, forward):
+        # None past `max_outputs`, the lines left are noise
+        if self.graph.output_counts[source.index] >= source.max_outputs:
+            return []
+        return DataSet.find_output_h_lines(self, source, forward)
+
+# ----------------------------------------------------------------------------
+
+    def _choose(self, candidates, error, distance):
+        counts = self.graph.input_counts
+        candidates = [c for c in candidates if not isinstance(c, Vertex) or counts[c.index] < c.max_inputs]
+        if len(candidates) == 0:
+            raise RuntimeError(error)
+        if len(candidates) == 1:
+            return candidates[0]
+
+        distances = np.array([distance(c) for c in candidates], dtype=np.float64)
+        weights = np.exp((distances.min() - distances) / self.tolerance)
+        costs = -np.log(weights / weights.sum())
+        order = np.argsort(costs, kind='mergesort')[:self.max_candidates]
+        if not self._decisions:
+            raise ChoicePoint(error, costs[order].tolist(), list(self._taken))
+        position = self._decisions.popleft()
+        self._taken.append(position)
+        self._chosen.append((error, len(candidates), math.exp(-costs[order[position]])))
+        return candidates[order[position]]
+
+    def _check_input_lines(self):
+        # Scheduled after each input. The trace is done with every line used
+        # so far, so a gate short of inputs must have enough unused lines in.
+        if self._checked == len(self._chosen):
+            return # Nothing new to prune
+        self._checked = len(self._chosen)
+        if self._input_lines is None:
+            self._initialize_input_lines()
+        box_ids, line_ids = self._input_lines
+        available = np.bincount(box_ids, ~self.lines_h.used[line_ids], len(self._label_ids))
+        counts = as_numpy(self.graph.input_counts, dtype=np.int32)[self._label_ids]
+        short = np.flatnonzero(self._min_inputs - counts > available)
+        if len(short):
+            raise RuntimeError("Too few inputs left for %s" % self._label_names[short[0]])
+
+# ----------------------------------------------------------------------------
+
+    def _snapshot(self):
+        return (len(self.graph), len(self.graph.edge_sources), len(self._marks), len(self._chosen)
+            , list(self.tasks))
+
+    def _rollback(self, snapshot):
+        vertex_count, edge_count, mark_count, choice_count, tasks = snapshot
+        self.graph.rollback(vertex_count, edge_count)
+        for used, index in self._marks[mark_count:]:
+            used[index] = False
+        del self._marks[mark_count:]
+        del self._chosen[choice_count:]
+        self._checked = min(self._checked, choice_count)
+        self._decisions.clear()
+        self.tasks[:] = tasks
+
+    def _advance(self):
+        # Run the trace up to the next choice point, or to the end (None).
+        # A dead end raises RuntimeError.
+        tasks = self.tasks
+        while tasks:
+            task, args = tasks.pop()
+            self._taken = []
+            try:
+                task(*args)
+            except ChoicePoint as point:
+                point.task = (task, args)
+                return point
+        return None
+
+    def _retry(self, point, position):
+        self._decisions.extend(point.taken + [position])
+        self.tasks.append(point.task)
+
+    def _unused_cost(self):
+        return UNUSED_LINE_COST * ((~self.lines_h.used).sum() + (~self.lines_v.used).sum())
+
+# ----------------------------------------------------------------------------
+
+    def analyze(self, processes=1):
+        if self.node_problems:
+            raise RuntimeError("Invalid node bridges: %s" % "; ".join(self.node_problems))
+
+        self._expression_dag = None
+        with self._phase("tracing"):
+            for input in reversed(self.inputs):
+                self._schedule(self._check_input_lines)
+                self._schedule(self.process_input, input)
+            start = self._snapshot()
+            path, cost, complete, branches, solutions, is_current = self._search()
+
+            if not is_current:
+                # Trace the best choices again
+                self._rollback(start)
+                self._decisions.extend(path)
+                self._advance()
+        self.resolution = Resolution(cost, list(self._chosen), np.flatnonzero(~self.lines_h.used)
+            , np.flatnonzero(~self.lines_v.used), branches, solutions, complete)
+
+    def _search(self):
+        # Branch and bound, depth first. Returns the candidate positions
+        # taken at the choice points of the best trace, its cost, whether
+        # the search was complete, the counts, and whether the trace is
+        # still the current state.
+        best_path, best_cost = None, float('inf')
+        is_current = False
+        first_error = None
+        branches = solutions = 0
+        complete = True
+        stack = [] # [snapshot, point, path length, cost, next position] per choice point
+        path = []
+        cost = 0.0
+        while True:
+            try:
+                point = self._advance()
+                if point is None:
+                    self.graph.validate()
+                    solutions += 1
+                    total = cost + self._unused_cost()
+                    if total < best_cost:
+                        best_path, best_cost = list(path), total
+                        is_current = True
+                elif branches < self.max_branches:
+                    branches += 1
+                    stack.append([self._snapshot(), point, len(path), cost, 0])
+                elif cost + point.costs[0] < best_cost:
+                    # Out of branches, follow the nearest candidates
+                    complete = False
+                    path.append(0)
+                    cost += point.costs[0]
+                    self._retry(point, 0)
+                    continue
+            except RuntimeError as e:
+                first_error = first_error or str(e)
+
+            # Next candidate of the last choice point that can still do better
+            while stack:
+                snapshot, point, depth, base, position = stack[-1]
+                if (position == len(point.costs)) or (base + point.costs[position] >= best_cost):
+                    stack.pop()
+                    continue
+                stack[-1][4] += 1
+                self._rollback(snapshot)
+                is_current = False
+                del path[depth:]
+                path.append(position)
+                cost = base + point.costs[position]
+                self._retry(point, position)
+                break
+            else:
+                break
+
+        if self.instrumentation is not None:
+            self.instrumentation.count("resolve.branches", branches)
+            self.instrumentation.count("resolve.solutions", solutions)
+        if best_path is None:
+            raise RuntimeError("No consistent trace found: %s" % first_error)
+        return best_path, best_cost, complete, branches, solutions, is_current
+
+# ============================================================================
@@ -0,0 +1,313 @@
+"""Long running analysis server on localhost HTTP.
+
+Callers that would start Python and trace one chart per process post the
+chart here instead:
+
+    python logic_server.py [--port 8765] [-j 4] [--cache DIR]
+
+    POST /analyze   a chart record {"lines", "labels"}, with the optional
+                    flags "truth_table", "normalize", "resolve" and "stats"; answers
+                    with the result record of `logic_batch.analyze_chart`
+    GET /status     the queue depth and the totals so far
+
+Requests are handled on threads, and wait in a bounded queue. A batcher
+thread takes them a batch at a time onto a process pool, whose workers
+stay up between requests with their imports done. When the queue is full
+the server answers 503 at once, so callers back off rather than pile up.
+A batch lost with its worker, or not done within `--timeout`, is answered
+with a 500 for each of its requests.
+"""
+
+import argparse
+import BaseHTTPServer
+import json
+import multiprocessing
+import Queue
+import signal
+import SocketServer
+import sys
+import threading
+import time
+
+from logic_batch import BatchOptions, analyze_chart, analyze_charts
+
+# ============================================================================
+
+DEFAULT_PORT = 8765
+QUEUE_SIZE = 256 # Requests waiting for a worker, beyond which they are refused
+BATCH_SIZE = 16 # Requests sent to a worker at a time ...
+BATCH_DELAY = 0.005 # ... waiting at most this long (s) for a batch to fill
+BATCHES_PER_WORKER = 2 # Batches handed to the pool at once, per worker
+BATCH_TIMEOUT = 60 # Batches not done this long (s) after they were handed out are failed
+WATCH_INTERVAL = 0.5 # Between checks (s) of the batches in the pool
+MAX_REQUEST_BYTES = 64 << 20
+
+# ============================================================================
+
+def _warm_up():
+    # Pool initializer: the imports, and a first trace, before any request.
+    # A worker replaced later is forked with the server's signal handlers.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    analyze_chart((0, None, ("sample", "dataset_0"), BatchOptions(truth_table=True)))
+
+# ============================================================================
+
+class Pending(object):
+    # A request waiting for its result
+    def __init__(self, task):
+        self.task = task
+        self.result = None
+        self.code = 200
+        self.received = time.time()
+        self.done = threading.Event()
+
+# ----------------------------------------------------------------------------
+
+class AnalysisService(object):
+    """Batches the submitted charts onto a pool of warm worker processes.
+
+    `submit` queues a task of `analyze_chart` and returns the `Pending`
+    request, or None if the queue is full. A single thread collects the
+    queued requests into batches of up to `batch_size`, and keeps at most
+    BATCHES_PER_WORKER batches per worker in the pool; past that, requests
+    stay queued until the queue fills and new ones are refused.
+
+    A worker that dies takes its batch with it, and the pool never answers
+    for that. A second thread watches the batches in the pool, and fails
+    those whose task raised, or that are not done within `timeout`, with
+    a 500 for each request.
+    """
+
+    def __init__(self, processes=None, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE
+            , batch_delay=BATCH_DELAY, timeout=BATCH_TIMEOUT):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.timeout = timeout
+        self.queue = Queue.Queue(queue_size)
+        self.pool = multiprocessing.Pool(self.processes, _warm_up)
+        self.slots = threading.Semaphore(BATCHES_PER_WORKER * self.processes)
+        self.started = time.time()
+
+        self.lock = threading.Lock()
+        self.counts = {"requests" : 0, "refused" : 0, "completed" : 0, "failed" : 0, "batches" : 0
+            , "in_flight" : 0, "lost" : 0}
+        self.running = {} # Batch number: (requests, AsyncResult, deadline)
+
+        self.batcher = threading.Thread(target=self._run_batches, name="batcher")
+        self.batcher.daemon = True
+        self.batcher.start()
+        self.watcher = threading.Thread(target=self._watch_batches, name="watcher")
+        self.watcher.daemon = True
+        self.watcher.start()
+
+    def submit(self, task):
+        pending = Pending(task)
+        try:
+            self.queue.put_nowait(pending)
+        except Queue.Full:
+            self._count("refused")
+            return None
+        self._count("requests")
+        return pending
+
+    def status(self):
+        with self.lock:
+            status = dict(self.counts)
+        status["queued"] = self.queue.qsize()
+        status["processes"] = self.processes
+        status["uptime"] = time.time() - self.started
+        status["mean_batch"] = float(status["completed"]) / max(status["batches"], 1)
+        return status
+
+    def close(self):
+        self.queue.put(None)
+        self.pool.terminate()
+        self.pool.join()
+
+    def _count(self, name, amount=1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def _run_batches(self):
+        while True:
+            pending = self.queue.get()
+            if pending is None:
+                return
+            batch = [pending]
+            deadline = time.time() + self.batch_delay
+            while len(batch) < self.batch_size:
+                try:
+                    pending = self.queue.get(timeout=max(deadline - time.time(), 0.0001))
+                except Queue.Empty:
+                    break
+                if pending is None:
+                    self.queue.put(None) # Stop after this batch
+                    break
+                batch.append(pending)
+
+            self.slots.acquire()
+            with self.lock:
+                self.counts["in_flight"] += len(batch)
+                self.counts["batches"] += 1
+                number = self.counts["batches"]
+                # Under the lock, so that the callback finds the batch registered
+                async_result = self.pool.apply_async(analyze_charts, ([pending.task for pending in batch],)
+                    , callback=lambda results, number=number: self._finish(number, results))
+                self.running[number] = (batch, async_result, time.time() + self.timeout)
+
+    def _watch_batches(self):
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            now = time.time()
+            with self.lock:
+                running = self.running.items()
+            for number, (batch, async_result, deadline) in running:
+                if async_result.ready() and not async_result.successful():
+                    try:
+                        async_result.get(0)
+                    except Exception as e:
+                        error = "%s: %s" % (type(e).__name__, e)
+                elif now > deadline:
+                    error = "Not done within %g s, the worker may have died" % self.timeout
+                else:
+                    continue
+                results = [{"id" : pending.task[1], "expressions" : None, "error" : error, "stage" : None}
+                    for pending in batch]
+                self._finish(number, results, 500)
+
+    def _finish(self, number, results, code=200):
+        # Called on the pool's result thread, or on the watcher for a lost batch
+        with self.lock:
+            if number not in self.running:
+                return # Failed by the watcher already
+            batch = self.running.pop(number)[0]
+        self.slots.release()
+        failed = 0
+        for pending, result in zip(batch, results):
+            result.setdefault("timing", {})["server"] = time.time() - pending.received
+            pending.result = result
+            pending.code = code
+            pending.done.set()
+            failed += result["error"] is not None
+        with self.lock:
+            self.counts["in_flight"] -= len(batch)
+            self.counts["completed"] += len(batch)
+            self.counts["failed"] += failed
+            if code != 200:
+                self.counts["lost"] += len(batch)
+
+# ============================================================================
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive, so that clients needn't reconnect per chart
+    wbufsize = -1 # The reply goes out in one piece, not held back by Nagle's algorithm per header
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/status":
+            return self._reply(404, {"error" : "Not found: %s" % self.path})
+        self._reply(200, self.server.service.status())
+
+    def do_POST(self):
+        if self.path.split("?")[0] != "/analyze":
+            return self._reply(404, {"error" : "Not found: %s" % self.path})
+        length = int(self.headers.getheader("Content-Length") or -1)
+        if not (0 <= length <= MAX_REQUEST_BYTES):
+            self.close_connection = 1
+            return self._reply(413, {"error" : "Request body missing or over %d bytes" % MAX_REQUEST_BYTES})
+        text = self.rfile.read(length)
+        try:
+            record = json.loads(text)
+            if not isinstance(record, dict) or ("lines" not in record) or ("labels" not in record):
+                raise ValueError("Expected a chart record with \"lines\" and \"labels\"")
+        except ValueError as e:
+            return self._reply(400, {"error" : str(e)})
+
+        service = self.server.service
+        options = BatchOptions(bool(record.get("stats")), self.server.cache_dir, self.server.cache_bytes
+            , bool(record.get("normalize")), bool(record.get("truth_table")), bool(record.get("resolve")))
+        task = (0, record.get("id"), ("text", text), options)
+        pending = service.submit(task)
+        if pending is None:
+            return self._reply(503, {"error" : "Server busy, %d requests queued" % service.queue.maxsize}
+                , {"Retry-After" : "1"})
+        # Untimed, as a wait with a timeout polls every 50 ms in Python 2.
+        # `analyze_charts` answers for every chart, failed ones included, and
+        # the watcher for the batches it never answers for.
+        pending.done.wait()
+        self._reply(pending.code, pending.result)
+
+    def _reply(self, code, body, headers=None):
+        text = json.dumps(body, sort_keys=True)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(text)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(text)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+# ----------------------------------------------------------------------------
+
+class AnalysisServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, service, cache_dir=None, cache_bytes=None, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, RequestHandler)
+        self.service = service
+        self.cache_dir = cache_dir
+        self.cache_bytes = cache_bytes
+        self.verbose = verbose
+
+# ============================================================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve chart analyses over localhost HTTP.")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port (default: %(default)s)")
+    parser.add_argument("-j", "--processes", type=int
+        , help="number of worker processes (default: CPU count)")
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE
+        , help="requests waiting at most, beyond which they are refused (default: %(default)s)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE
+        , help="requests sent to a worker at a time (default: %(default)s)")
+    parser.add_argument("--batch-delay", type=float, default=BATCH_DELAY * 1000, metavar="MS"
+        , help="longest wait for a batch to fill (default: %(default)s)")
+    parser.add_argument("--timeout", type=float, default=BATCH_TIMEOUT, metavar="S"
+        , help="longest time a batch may take in the pool before its requests fail (default: %(default)s)")
+    parser.add_argument("--cache", metavar="DIR"
+        , help="reuse the results of charts analyzed before, kept in this directory")
+    parser.add_argument("--cache-size", type=int, default=256, metavar="MB"
+        , help="size cap of the cache (default: %(default)s)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log every request")
+    args = parser.parse_args(argv)
+
+    # The pool forks before any thread starts
+    service = AnalysisService(args.processes, args.queue_size, args.batch_size, args.batch_delay / 1000.0
+        , args.timeout)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    server = None
+    try:
+        server = AnalysisServer((args.host, args.port), service, args.cache, args.cache_size << 20
+            , args.verbose)
+        sys.stderr.write("Serving on http://%s:%d with %d workers\n"
+            % (args.host, server.server_address[1], service.processes))
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server is not None:
+            server.server_close()
+        service.close()
+    return 0
+
+# ============================================================================
+
+if __name__ == '__main__':
+    sys.exit(main())
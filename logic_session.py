@@ -0,0 +1,313 @@
+import numpy as np
+
+from logic import DataSet, LINE_CONN_TOLERANCE, SLOPE_THRESHOLD, LABEL_MARGIN, pair_bridge_nodes
+from logic_partition import find_components, trace_inputs
+from logic_topology import contact_flags
+from logic_utils import are_lines_horizontal, inflate_bbox
+
+# ============================================================================
+
+class Part(object):
+    """One component of a session's chart, traced in a `DataSet` of its own.
+
+    `h_ids` and `v_ids` are the session ids of the lines in the order of
+    `lines_h` and `lines_v`, `label_ids` those of the labels (the first
+    vertices of the graph). If tracing failed, `error` is the error and
+    `position` the label id of the input it came from.
+    """
+
+    def __init__(self, h_ids, v_ids, label_ids):
+        self.h_ids = h_ids
+        self.v_ids = v_ids
+        self.label_ids = label_ids
+        self.dataset = None
+        self.error = None
+        self.position = None
+        self._expressions = None # Output label id -> expression, on demand
+
+    def expression(self, label_id):
+        if self._expressions is None:
+            outputs = [self.label_ids[output.index] for output in self.dataset.outputs]
+            self._expressions = dict(zip(outputs, self.dataset.expressions))
+        return self._expressions[label_id]
+
+    def used_lines(self):
+        return (self.h_ids[self.dataset.lines_h.used].tolist()
+            + self.v_ids[self.dataset.lines_v.used].tolist())
+
+# ============================================================================
+
+class AnalysisSession(object):
+    """Analysis of a chart kept up to date as single lines and labels change.
+
+    The chart is split into independent components (see `find_components`),
+    each traced on its own. An edit only re-traces the components the
+    changed item was part of or now touches, split up afresh, and only the
+    expressions of the outputs in them are recomputed (listed in
+    `updated_outputs`). The results are those of analyzing the edited chart
+    from scratch.
+
+    Lines and labels are referred to by id: their position in the lists
+    given, then increasing numbers for added lines.
+    """
+
+    def __init__(self, lines, labels, tolerance=LINE_CONN_TOLERANCE, slope_threshold=SLOPE_THRESHOLD):
+        self.tolerance = tolerance
+        self.slope_threshold = slope_threshold
+
+        self.lines = {} # Id -> endpoints
+        self.labels = {} # Id -> [name, p1, p2]
+        self._endpoints = np.zeros((max(len(lines), 16), 2, 2)) # Per line id, for the contact scans
+        self._alive = np.zeros(len(self._endpoints), dtype=bool)
+        self._horizontal = np.zeros(len(self._endpoints), dtype=bool)
+        self.next_line_id = 0
+        for line in lines:
+            self._set_line(self._new_line_id(), line)
+
+        self._boxes = np.zeros((len(labels), 2, 2)) # Inflated, as in `DataSet`
+        for i, label in enumerate(labels):
+            self._set_label(i, label[0], label[1], label[2])
+
+        self.parts = set()
+        self.part_of_line = {}
+        self.part_of_label = {}
+        self.node_partners = {} # Node label id -> partner label id
+        self.node_problems = []
+        self._node_ends = {} # Node label id -> vertical line ends in it, 2 * line id + end
+        self._update_nodes(list(self.lines), list(self.labels))
+        self.updated_outputs = set()
+        self._retrace(list(self.lines), list(self.labels))
+
+    # ------------------------------------------------------------------------
+
+    def add_line(self, endpoints):
+        index = self._new_line_id()
+        self._update([index], [], lambda: self._set_line(index, endpoints))
+        return index
+
+    def remove_line(self, index):
+        self._check_line(index)
+        self._update([index], [], lambda: self._set_line(index, None))
+
+    def move_line(self, index, endpoints):
+        self._check_line(index)
+        self._update([index], [], lambda: self._set_line(index, endpoints))
+
+    def move_label(self, index, p1, p2):
+        name = self.labels[index][0]
+        self._update([], [index], lambda: self._set_label(index, name, p1, p2))
+
+    def relabel(self, index, name):
+        label, p1, p2 = self.labels[index]
+        self._update([], [index], lambda: self._set_label(index, name, p1, p2))
+
+    # ------------------------------------------------------------------------
+
+    @property
+    def expressions(self):
+        # Same as `DataSet.expressions` after `analyze` on the whole chart
+        self._check_trace()
+        outputs = [i for i in sorted(self.labels) if self.labels[i][0] == 'OUTPUT']
+        return [self.part_of_label[i].expression(i) for i in outputs]
+
+    def validate(self):
+        # Same checks as `DataSet.validate`, part by part
+        self._check_trace()
+        parts = self._ordered_parts()
+        for part in parts:
+            if not (part.dataset.lines_h.used.all() and part.dataset.lines_v.used.all()):
+                raise RuntimeError("Some lines remain unused.")
+        for part in parts:
+            part.dataset.graph.validate()
+
+    def used_lines(self):
+        return set(i for part in self.parts for i in part.used_lines())
+
+    def _check_trace(self):
+        # Raise the error tracing the whole chart would raise first
+        if self.node_problems:
+            raise RuntimeError("Invalid node bridges: %s" % "; ".join(self.node_problems))
+        failed = [part for part in self.parts if part.error is not None]
+        if failed:
+            raise min(failed, key=lambda part: part.position).error
+
+    def _ordered_parts(self):
+        # In order of first label, as `find_components`, those without last
+        return sorted(self.parts, key=lambda part: (part.label_ids[0] if len(part.label_ids) else len(self.labels)
+            , part.h_ids.tolist() + part.v_ids.tolist()))
+
+    # ------------------------------------------------------------------------
+
+    def _new_line_id(self):
+        index = self.next_line_id
+        self.next_line_id += 1
+        if index >= len(self._endpoints):
+            grow = lambda a: np.concatenate([a, np.zeros_like(a)])
+            self._endpoints = grow(self._endpoints)
+            self._alive = grow(self._alive)
+            self._horizontal = grow(self._horizontal)
+        return index
+
+    def _check_line(self, index):
+        if index not in self.lines:
+            raise KeyError("No line %s" % index)
+
+    def _set_line(self, index, endpoints):
+        if endpoints is None:
+            del self.lines[index]
+            self._alive[index] = False
+            return
+        endpoints = tuple(tuple(p) for p in endpoints)
+        self.lines[index] = endpoints
+        self._endpoints[index] = endpoints
+        self._alive[index] = True
+        self._horizontal[index] = are_lines_horizontal([endpoints])[0]
+
+    def _set_label(self, index, name, p1, p2):
+        self.labels[index] = [name, tuple(p1), tuple(p2)]
+        self._boxes[index] = inflate_bbox((p1, p2), LABEL_MARGIN)
+
+    # ------------------------------------------------------------------------
+
+    def _update(self, line_ids, label_ids, change):
+        # Apply a change to some lines or labels, then re-trace the parts
+        # they were in and those they now touch
+        parts = self._parts_of(line_ids, label_ids)
+        partners = self.node_partners
+        change()
+
+        lines, labels = self._contacts([i for i in line_ids if i in self.lines], label_ids)
+        parts.update(self._parts_of(lines, labels))
+        self._update_nodes(line_ids, label_ids)
+        moved = [i for i in set(partners) | set(self.node_partners)
+            if partners.get(i) != self.node_partners.get(i)]
+        parts.update(self._parts_of([], moved))
+
+        lines = set(i for i in line_ids if i in self.lines)
+        labels = set(label_ids)
+        for part in parts:
+            lines.update(part.h_ids.tolist())
+            lines.update(part.v_ids.tolist())
+            labels.update(part.label_ids.tolist())
+            self.parts.discard(part)
+        for i in lines.difference(self.lines):
+            del self.part_of_line[i]
+        lines.intersection_update(self.lines)
+        self.updated_outputs = set()
+        self._retrace(lines, labels)
+
+    def _parts_of(self, line_ids, label_ids):
+        parts = set(self.part_of_line[i] for i in line_ids if i in self.part_of_line)
+        parts.update(self.part_of_label[i] for i in label_ids if i in self.part_of_label)
+        return parts
+
+    def _contacts(self, line_ids, label_ids):
+        # Ids of the lines and labels the given ones connect to, as
+        # `find_components` would join them
+        count = self.next_line_id
+        alive = self._alive[:count]
+        horizontal = self._horizontal[:count]
+        endpoints = self._endpoints[:count]
+        lines = set()
+        labels = set()
+        for i in line_ids:
+            line = endpoints[i]
+            if horizontal[i]:
+                others = np.flatnonzero(alive & ~horizontal)
+                points = endpoints[others].reshape(-1, 2)
+                segments = np.repeat(line[np.newaxis], len(points), axis=0)
+            else:
+                others = np.flatnonzero(alive & horizontal)
+                points = np.tile(line, (len(others), 1))
+                segments = np.repeat(endpoints[others], 2, axis=0)
+            hits = np.logical_or.reduce(contact_flags(points, segments, self.tolerance))
+            lines.update(others[hits.reshape(-1, 2).any(axis=1)].tolist())
+            for point in line:
+                labels.update(np.flatnonzero(self._contains(self._boxes, point)).tolist())
+
+        points = endpoints.reshape(-1, 2)
+        for j in label_ids:
+            inside = self._contains(self._boxes[j][np.newaxis], points) & np.repeat(alive, 2)
+            lines.update((np.flatnonzero(inside) // 2).tolist())
+        return lines, labels
+
+    def _contains(self, boxes, points):
+        (x0, y0), (x1, y1) = boxes[:, 0].T, boxes[:, 1].T
+        x, y = np.asarray(points, dtype=np.float64).T
+        return (x0 <= x) & (x <= x1) & (y0 <= y) & (y <= y1)
+
+    def _update_nodes(self, line_ids, label_ids):
+        # Keep the line ends in each node up to date, and pair up the
+        # bridges again if they changed
+        nodes = [i for i in sorted(self.labels) if self.labels[i][0] == 'NODE']
+        changed = False
+        for i in list(self._node_ends):
+            if (i not in nodes) or (i in label_ids):
+                del self._node_ends[i]
+                changed = True
+
+        points = self._endpoints[:self.next_line_id].reshape(-1, 2)
+        vertical = np.repeat(self._alive[:self.next_line_id] & ~self._horizontal[:self.next_line_id], 2)
+        for i in nodes:
+            if i not in self._node_ends:
+                self._node_ends[i] = np.flatnonzero(self._contains(self._boxes[i][np.newaxis], points) & vertical).tolist()
+                changed = True
+
+        line_ids = set(line_ids)
+        if line_ids and nodes and (len(line_ids) < len(self.lines)):
+            for i in nodes:
+                ends = [e for e in self._node_ends[i] if (e // 2) not in line_ids]
+                for line in line_ids:
+                    for end in [0, 1]:
+                        point = 2 * line + end
+                        if vertical[point] and self._contains(self._boxes[i][np.newaxis], points[point])[0]:
+                            ends.append(point)
+                if sorted(ends) != self._node_ends[i]:
+                    self._node_ends[i] = sorted(ends)
+                    changed = True
+
+        if not changed:
+            return
+        centers = [tuple((self._boxes[i][0] + self._boxes[i][1]) / 2) for i in nodes]
+        links, self.node_problems = pair_bridge_nodes(centers, [self._node_ends[i] for i in nodes]
+            , self.slope_threshold)
+        self.node_partners = dict((nodes[i], nodes[partner])
+            for down in [True, False] for i, (partner, line) in links[down].items())
+
+    # ------------------------------------------------------------------------
+
+    def _retrace(self, line_ids, label_ids):
+        # Split the given lines and labels into components and trace each
+        line_ids = np.array(sorted(line_ids), dtype=np.int64)
+        label_ids = np.array(sorted(label_ids), dtype=np.int64)
+        if (len(line_ids) == 0) and (len(label_ids) == 0):
+            return
+        horizontal = self._horizontal[line_ids]
+        h_ids = line_ids[horizontal]
+        v_ids = line_ids[~horizontal]
+
+        ds = self._dataset(line_ids, label_ids)
+        for c in find_components(ds):
+            part = Part(h_ids[c.h_ids], v_ids[c.v_ids], label_ids[c.label_ids])
+            part.dataset = self._dataset(np.sort(np.concatenate([part.h_ids, part.v_ids]))
+                , part.label_ids, ds.topology.subset(c.h_ids, c.v_ids))
+            inputs = [part.label_ids[input.index] for input in part.dataset.inputs]
+            if part.dataset.node_problems:
+                part.error = RuntimeError("Invalid node bridges: %s" % "; ".join(part.dataset.node_problems))
+                part.position = inputs[0] if inputs else -1
+            else:
+                part.error, part.position = trace_inputs(part.dataset, inputs)
+
+            self.parts.add(part)
+            for i in part.h_ids.tolist() + part.v_ids.tolist():
+                self.part_of_line[i] = part
+            for i in part.label_ids.tolist():
+                self.part_of_label[i] = part
+                if self.labels[i][0] == 'OUTPUT':
+                    self.updated_outputs.add(i)
+
+    def _dataset(self, line_ids, label_ids, topology=None):
+        return DataSet([self.lines[i] for i in line_ids.tolist()], [self.labels[i] for i in label_ids.tolist()]
+            , self.tolerance, self.slope_threshold, topology=topology)
+
+# ============================================================================
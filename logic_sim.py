@@ -0,0 +1,212 @@
+import argparse
+import csv
+import itertools
+import sys
+
+import numpy as np
+
+# ============================================================================
+
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+# ============================================================================
+
+def pack_column(values):
+    # Pack one value per row into uint64 words, 64 rows per word
+    packed = np.packbits(np.asarray(values, dtype=bool))
+    padding = (-len(packed)) % 8
+    if padding:
+        packed = np.concatenate([packed, np.zeros(padding, dtype=np.uint8)])
+    return packed.view(np.uint64)
+
+# ----------------------------------------------------------------------------
+
+def unpack_column(packed, count):
+    return np.unpackbits(packed.view(np.uint8))[:count]
+
+# ============================================================================
+
+class Simulator(object):
+    """Evaluates input vectors through a `CompiledChart`, chunk by chunk.
+
+    Each chunk is a mapping of input name to a column of 0/1 values. The
+    columns are packed into uint64 words before the evaluation, so each
+    gate costs one bitwise operation per 64 vectors.
+    """
+
+    def __init__(self, compiled):
+        self.compiled = compiled
+
+    def simulate_chunk(self, columns):
+        count = None
+        packed = {}
+        for name in self.compiled.input_names:
+            if name not in columns:
+                raise RuntimeError("Missing input column '%s'" % name)
+            column = columns[name]
+            if count is None:
+                count = len(column)
+            packed[name] = pack_column(column)
+
+        results = self.compiled.evaluate(packed)
+
+        # Rows of output values, one column per output
+        outputs = np.empty((count or 0, len(results)), dtype=np.uint8)
+        for i, result in enumerate(results):
+            outputs[:, i] = unpack_column(result, count)
+        return outputs
+
+    def simulate(self, chunks):
+        for columns in chunks:
+            yield self.simulate_chunk(columns)
+
+# ============================================================================
+
+def read_csv_chunks(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    # CSV with a header row of input names, and rows of 0/1 values
+    with open(path, 'rb') as f:
+        reader = csv.reader(f)
+        names = [name.strip() for name in next(reader)]
+        while True:
+            rows = list(itertools.islice(reader, chunk_size))
+            if not rows:
+                break
+            values = np.array(rows).astype(np.uint8).reshape(-1, len(names))
+            yield dict((name, values[:, i]) for i, name in enumerate(names))
+
+# ----------------------------------------------------------------------------
+
+def read_npy_chunks(path, chunk_size=DEFAULT_CHUNK_SIZE, columns=None):
+    """Read input vectors from a memory-mapped .npy file.
+
+    Either a structured array with one field per input name, or a 2D array
+    of 0/1 values with the input names given in `columns`.
+    """
+    data = np.load(path, mmap_mode='r')
+    names = data.dtype.names
+    if names is None:
+        if columns is None:
+            raise RuntimeError("Column names required for plain array '%s'" % path)
+        if (data.ndim != 2) or (data.shape[1] != len(columns)):
+            raise RuntimeError("Expected %d columns in '%s'" % (len(columns), path))
+        names = columns
+
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start:start + chunk_size]
+        if data.dtype.names is None:
+            yield dict((name, chunk[:, i]) for i, name in enumerate(names))
+        else:
+            yield dict((name, chunk[name]) for name in names)
+
+# ----------------------------------------------------------------------------
+
+def npy_row_count(path):
+    return len(np.load(path, mmap_mode='r'))
+
+# ----------------------------------------------------------------------------
+
+def read_stimulus(path, chunk_size=DEFAULT_CHUNK_SIZE, columns=None):
+    if path.endswith('.npy'):
+        return read_npy_chunks(path, chunk_size, columns)
+    return read_csv_chunks(path, chunk_size)
+
+# ============================================================================
+
+class CsvWriter(object):
+    def __init__(self, path, names):
+        self.file = open(path, 'wb')
+        self.file.write(",".join(names) + "\n")
+
+    def write(self, outputs):
+        np.savetxt(self.file, outputs, fmt='%d', delimiter=',')
+
+    def close(self):
+        self.file.close()
+
+# ----------------------------------------------------------------------------
+
+class NpyWriter(object):
+    # Needs the number of rows up front, so only used for .npy input
+    def __init__(self, path, names, row_count):
+        self.data = np.lib.format.open_memmap(path, mode='w+'
+            , dtype=np.uint8, shape=(row_count, len(names)))
+        self.offset = 0
+
+    def write(self, outputs):
+        self.data[self.offset:self.offset + len(outputs)] = outputs
+        self.offset += len(outputs)
+
+    def close(self):
+        self.data.flush()
+        del self.data
+
+# ----------------------------------------------------------------------------
+
+class RawWriter(object):
+    # Rows of uint8 output values, appended as they are produced
+    def __init__(self, path, names):
+        self.file = open(path, 'wb')
+
+    def write(self, outputs):
+        self.file.write(np.ascontiguousarray(outputs).tobytes())
+
+    def close(self):
+        self.file.close()
+
+# ----------------------------------------------------------------------------
+
+def open_writer(path, names, row_count=None):
+    if path.endswith('.csv'):
+        return CsvWriter(path, names)
+    if path.endswith('.npy'):
+        if row_count is None:
+            raise RuntimeError("Writing .npy output requires .npy input")
+        return NpyWriter(path, names, row_count)
+    return RawWriter(path, names)
+
+# ============================================================================
+
+def simulate_file(compiled, input_path, output_path
+        , chunk_size=DEFAULT_CHUNK_SIZE, columns=None):
+    # Stream the input vectors through the chart, returns the vector count
+    row_count = npy_row_count(input_path) if input_path.endswith('.npy') else None
+    writer = open_writer(output_path, compiled.output_names, row_count)
+    count = 0
+    try:
+        simulator = Simulator(compiled)
+        for outputs in simulator.simulate(read_stimulus(input_path, chunk_size, columns)):
+            writer.write(outputs)
+            count += len(outputs)
+    finally:
+        writer.close()
+    return count
+
+# ============================================================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run input vectors through a traced logic chart.")
+    parser.add_argument("chart", help="chart JSON file, or sample dataset name")
+    parser.add_argument("stimulus", help="input vectors (.csv with header, or .npy)")
+    parser.add_argument("output", help="output values (.csv, .npy, or raw uint8 rows)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE
+        , help="vectors per chunk (default: %(default)s)")
+    parser.add_argument("--columns"
+        , help="comma separated input names, for plain 2D .npy stimulus")
+    args = parser.parse_args(argv)
+
+    from logic import analyze
+    from logic_io import load_chart
+
+    lines, labels = load_chart(args.chart)
+    result = analyze(lines, labels)
+
+    columns = args.columns.split(",") if args.columns else None
+    count = simulate_file(result.compile(), args.stimulus, args.output
+        , args.chunk_size, columns)
+    sys.stderr.write("Simulated %d vectors.\n" % count)
+
+# ============================================================================
+
+if __name__ == '__main__':
+    main()
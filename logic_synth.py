@@ -0,0 +1,432 @@
+import argparse
+import bisect
+import json
+import random
+import sys
+
+# ============================================================================
+
+GATE_TYPES = ['AND', 'NAND', 'OR', 'NOR', 'XOR', 'XNOR', 'NOT']
+MAX_FAN_IN = 8 # Most inputs a `BinaryGate` accepts
+
+# Layout, in pixels. Every horizontal segment gets a track (y coordinate) of
+# its own, and the track pitch is well above twice the connection tolerance,
+# so no line endpoint ever lands near a line of another net.
+TRACK_PITCH = 80
+SLOT_PITCH = 10 # Spacing of the vertical wires within a channel
+JOG_SLOTS = 5 # Slots taken by a wire with a jog
+GATE_WIDTH = 200
+LABEL_MARGIN = 25 # Label box extent above/below its outermost track
+PIN_DEPTH = 20 # How far a wire reaches into a label box
+CHANNEL_MARGIN = 60 # Free space between a column of labels and its channels
+NODE_SIZE = 30
+NODE_OFFSET = 40 # Distance of a bridge node's centre from the wire it crosses
+
+# Broken wires, as line detectors report them: pieces of a wire meet with a
+# gap or an overlap of up to FRAGMENT_GAP, and duplicates lie up to
+# DUPLICATE_OFFSET across. Both within what `normalize_lines` merges.
+MAX_FRAGMENTS = 4
+FRAGMENT_GAP = 8
+DUPLICATE_OFFSET = 2
+
+# ============================================================================
+
+class _Element(object):
+    # An input, gate or output of the netlist, and the net it drives
+    def __init__(self, name, column, sources):
+        self.name = name
+        self.column = column
+        self.sources = sources # Elements driving each input
+        self.jogs = [False] * len(sources) # Which input wires take a detour
+        self.sinks = [] # Pairs of (element, input number) driven by this one
+        self.input_tracks = []
+        self.jog_tracks = []
+        self.output_track = None
+
+# ----------------------------------------------------------------------------
+
+class _Pool(object):
+    # Set of elements with constant time removal and random picks
+    def __init__(self):
+        self.items = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.positions
+
+    def add(self, item):
+        self.positions[item] = len(self.items)
+        self.items.append(item)
+
+    def discard(self, item):
+        i = self.positions.pop(item, None)
+        if i is None:
+            return
+        last = self.items.pop()
+        if last is not item:
+            self.items[i] = last
+            self.positions[last] = i
+
+    def pick(self, rng, count, exclude):
+        # Up to `count` random items, none of them in `exclude`
+        picked = []
+        if len(self.items) <= 4 * (count + len(exclude)):
+            candidates = [e for e in self.items if e not in exclude]
+            rng.shuffle(candidates)
+            return candidates[:count]
+        while len(picked) < count:
+            item = self.items[rng.randrange(len(self.items))]
+            if (item not in exclude) and (item not in picked):
+                picked.append(item)
+        return picked
+
+# ============================================================================
+
+class _Netlist(object):
+    def __init__(self, options, rng):
+        self.options = options
+        self.rng = rng
+        self.columns = [] # Lists of elements, inputs first
+        self.unused = _Pool() # Elements driving nothing yet
+        self.available = _Pool() # Elements that can still take another sink
+        self.fresh = _Pool() # Unused elements of the latest column
+        self.segments = 0 # Expected number of lines once routed
+
+    def add_column(self, names, sources_of):
+        column = []
+        for name in names:
+            sources = sources_of(name)
+            element = _Element(name, len(self.columns), sources)
+            for i, source in enumerate(sources):
+                self._connect(source, element, i)
+            column.append(element)
+
+        # Only available as sources from the next column on
+        self.fresh = _Pool()
+        for element in column:
+            if element.name != 'OUTPUT':
+                self.unused.add(element)
+                self.available.add(element)
+                self.fresh.add(element)
+        self.columns.append(column)
+        return column
+
+    def _connect(self, source, element, i):
+        if not source.sinks:
+            self.unused.discard(source)
+            self.fresh.discard(source)
+            self.segments += 1 # The trunk of the net
+        source.sinks.append((element, i))
+        if len(source.sinks) >= self.options["fan_out"]:
+            self.available.discard(source)
+
+        element.jogs[i] = self.rng.random() < self.options["jogs"]
+        self.segments += 4 if element.jogs[i] else 2
+
+    def pick_sources(self, name):
+        # Distinct sources for a new gate, at least one from the previous
+        # column (so the depth grows), the rest preferably unused signals
+        count = 1
+        if name != 'NOT':
+            count = self.rng.randint(*self.options["fan_in"])
+
+        sources = self.fresh.pick(self.rng, 1, [])
+        for attempt in range(8 if not sources else 0):
+            source = self.rng.choice(self.columns[-1])
+            if source in self.available:
+                sources.append(source)
+                break
+        for pool in [self.unused, self.available]:
+            if len(sources) < count:
+                sources.extend(pool.pick(self.rng, min(count - len(sources), len(pool)), sources))
+
+        # Out of signals, unless more inputs may be added
+        while (len(sources) < count) and (self.options["inputs"] is None):
+            sources.append(self.add_input())
+        if len(sources) < (1 if name == 'NOT' else 2):
+            raise RuntimeError("Not enough signals left to drive a %s gate" % name)
+        return sources
+
+    def add_input(self):
+        element = _Element("I%d" % len(self.columns[0]), 0, [])
+        self.columns[0].append(element)
+        self.unused.add(element)
+        self.available.add(element)
+        return element
+
+# ============================================================================
+
+def _build_netlist(options, rng):
+    netlist = _Netlist(options, rng)
+    gate_types = options["gate_types"]
+
+    # Gates per column, from the expected number of lines per gate
+    fan_in = options["fan_in"]
+    lines_per_input = 2.0 + 2.0 * options["jogs"]
+    lines_per_gate = 1.0 + lines_per_input * (fan_in[0] + fan_in[1]) / 2.0
+    gate_count = max(1, int(options["segments"] / lines_per_gate))
+    width = max(1, int(round(gate_count / float(options["depth"]))))
+
+    netlist.add_column([], None)
+    for i in range(options["inputs"] or max(2, width)):
+        netlist.add_input()
+
+    while True:
+        names = [rng.choice(gate_types) for i in range(width)]
+        netlist.add_column(names, netlist.pick_sources)
+        if netlist.segments + 3 * len(netlist.unused) >= options["segments"]:
+            break
+
+    # Whatever is left unused drives an output
+    netlist.add_column(['OUTPUT'] * len(netlist.unused), lambda name: [netlist.unused.items[-1]])
+    return netlist
+
+# ============================================================================
+
+def _hline(x1, x2, y):
+    return [(x1, y), (x2, y)]
+
+def _vline(x, y1, y2):
+    return [(x, min(y1, y2)), (x, max(y1, y2))]
+
+# ----------------------------------------------------------------------------
+
+def _assign_tracks(netlist):
+    # Interleave the columns row by row, so that wires go up as well as down
+    track = 0
+    height = max(len(column) for column in netlist.columns)
+    for row in range(height):
+        for column in netlist.columns:
+            if row >= len(column):
+                continue
+            element = column[row]
+            count = len(element.sources)
+            tracks = [track + i * TRACK_PITCH for i in range(count + (element.name != 'OUTPUT'))]
+            track += len(tracks) * TRACK_PITCH
+            if element.name != 'OUTPUT':
+                element.output_track = tracks.pop(len(tracks) // 2)
+            element.input_tracks = tracks
+
+            # Detours get their own tracks, just outside the label
+            for jog in element.jogs:
+                element.jog_tracks.append(track if jog else None)
+                if jog:
+                    track += TRACK_PITCH
+
+# ----------------------------------------------------------------------------
+
+def _route(netlist):
+    lines = []
+    labels = []
+
+    # Column positions, each channel sized by the wires entering the column
+    column_x = []
+    channel_x = []
+    x = 0
+    for column in netlist.columns:
+        slots = sum((JOG_SLOTS if jog else 1) for element in column for jog in element.jogs)
+        channel_x.append(x + CHANNEL_MARGIN)
+        x += 2 * CHANNEL_MARGIN + slots * SLOT_PITCH
+        column_x.append(x)
+        x += GATE_WIDTH
+
+    drops = {} # Element -> x of each vertical wire leaving its trunk
+    for c, column in enumerate(netlist.columns):
+        slot_x = channel_x[c]
+        for element in column:
+            left = column_x[c]
+            for i, source in enumerate(element.sources):
+                y = element.input_tracks[i]
+                jog_y = element.jog_tracks[i]
+                drop_y = y if jog_y is None else jog_y
+                lines.append(_vline(slot_x, source.output_track, drop_y))
+                drops.setdefault(source, []).append(slot_x)
+                if jog_y is not None:
+                    jog_x = slot_x + (JOG_SLOTS - 1) * SLOT_PITCH
+                    lines.append(_hline(slot_x, jog_x, jog_y))
+                    lines.append(_vline(jog_x, jog_y, y))
+                    slot_x += JOG_SLOTS * SLOT_PITCH
+                    lines.append(_hline(jog_x, left + PIN_DEPTH, y))
+                else:
+                    slot_x += SLOT_PITCH
+                    lines.append(_hline(slot_x - SLOT_PITCH, left + PIN_DEPTH, y))
+
+            tracks = element.input_tracks + [element.output_track]
+            top = min(t for t in tracks if t is not None) - LABEL_MARGIN
+            bottom = max(t for t in tracks if t is not None) + LABEL_MARGIN
+            labels.append([element.name, (left, top), (left + GATE_WIDTH, bottom)])
+
+    for c, column in enumerate(netlist.columns):
+        for element in column:
+            if element in drops:
+                right = column_x[c] + GATE_WIDTH
+                lines.append(_hline(right - PIN_DEPTH, max(drops[element]), element.output_track))
+    return lines, labels
+
+# ----------------------------------------------------------------------------
+
+def _add_bridges(lines, labels, count, rng):
+    # Split vertical wires where they cross a horizontal one, with a pair of
+    # nodes marking the hop, like the drawn charts do
+    hlines = sorted((line[0][1], line[0][0], line[1][0]) for line in lines
+        if line[0][1] == line[1][1])
+    tracks = [h[0] for h in hlines]
+    vlines = [i for i, line in enumerate(lines) if line[0][0] == line[1][0]]
+    rng.shuffle(vlines)
+
+    clearance = NODE_OFFSET + NODE_SIZE
+    # (track, x) of the bridges placed. The lower node of a bridge may meet
+    # the upper node of one over the next track, so those are kept clear too.
+    placed = []
+    added = 0
+    for i in vlines:
+        if added >= count:
+            break
+        (x, y1), (x2, y2) = lines[i]
+        start = bisect.bisect_left(tracks, y1 + TRACK_PITCH)
+        end = bisect.bisect_right(tracks, y2 - TRACK_PITCH)
+        for y, hx1, hx2 in hlines[start:end]:
+            if not (hx1 + clearance <= x <= hx2 - clearance):
+                continue
+            if any((abs(x - px) < 2 * clearance) and (abs(y - py) < 2 * clearance) for py, px in placed):
+                continue
+            placed.append((y, x))
+
+            half = NODE_SIZE // 2
+            lines[i] = [(x, y1), (x2, y - NODE_OFFSET)]
+            lines.append([(x, y + NODE_OFFSET), (x2, y2)])
+            # Offset the lower node, for a non-vertical slope between the two
+            labels.append(['NODE', (x - half, y - NODE_OFFSET - half), (x + half, y - NODE_OFFSET + half)])
+            labels.append(['NODE', (x + 3 - half, y + NODE_OFFSET - half), (x + 3 + half, y + NODE_OFFSET + half)])
+            added += 1
+            break
+    return added
+
+# ----------------------------------------------------------------------------
+
+def _fragment(lines, probability, rng):
+    # Break wires into collinear pieces, each with the given probability,
+    # and as often add a near duplicate of a stretch of one
+    result = []
+    for (x1, y1), (x2, y2) in lines:
+        axis = 0 if y1 == y2 else 1
+        start, end = (x1, x2) if axis == 0 else (y1, y2)
+        across = y1 if axis == 0 else x1
+        pieces = [(start, end, 0)] # Along, along, offset across
+        count = rng.randint(2, MAX_FRAGMENTS)
+        part = (end - start) // count
+        if (rng.random() < probability) and (part >= 4 * FRAGMENT_GAP):
+            # Cuts about evenly spaced, so each piece is longer than a gap
+            bounds = [start + i * part + rng.randint(-part // 4, part // 4) for i in range(1, count)]
+            bounds = [start] + bounds + [end]
+            pieces = []
+            for i in range(count):
+                # Up to the next piece, with a gap or an overlap
+                high = bounds[i + 1] - (rng.randint(-FRAGMENT_GAP, FRAGMENT_GAP) if i + 1 < count else 0)
+                pieces.append((bounds[i], high, 0))
+        if rng.random() < probability:
+            low, high = sorted(rng.randint(start, end) for i in range(2))
+            if high > low:
+                pieces.append((low, high, rng.randint(-DUPLICATE_OFFSET, DUPLICATE_OFFSET)))
+        for low, high, offset in pieces:
+            if axis == 0:
+                result.append([(low, across + offset), (high, across + offset)])
+            else:
+                result.append([(across + offset, low), (across + offset, high)])
+    return result
+
+# ============================================================================
+
+def generate_chart(segments=100, inputs=None, gate_types=GATE_TYPES, fan_in=(2, 2)
+        , fan_out=4, depth=6, jogs=0.0, bridges=0, fragmentation=0.0, seed=0):
+    """Generate a random, traceable chart with about `segments` lines.
+
+    Returns a record with "lines" and "labels", in the same format as the
+    sample datasets in `logic_data`.
+
+    The gates are laid out in `depth` columns, each one drawing at least one
+    input from the column before it. Gate types are picked from
+    `gate_types`, binary gates taking between `fan_in[0]` and `fan_in[1]`
+    inputs. Every signal drives at most `fan_out` inputs, branching off
+    its wire through junctions; signals left unused drive an OUTPUT. The
+    number of inputs defaults to the number of gates per column, with more
+    added whenever the fan-in and fan-out leave a gate short of signals.
+
+    Each input wire takes a detour through an extra corner with probability
+    `jogs`, and up to `bridges` wire crossings are drawn as node bridges.
+    With `fragmentation`, each line is broken with that probability into
+    collinear pieces with gaps and overlaps, and as often a stretch of it
+    is drawn twice, slightly offset. Such charts only trace after
+    `normalize_lines`; `segments` counts the lines before.
+    """
+    if (fan_in[0] < 2) or (fan_in[1] > MAX_FAN_IN) or (fan_in[0] > fan_in[1]):
+        raise RuntimeError("Fan-in must be within 2 to %d" % MAX_FAN_IN)
+    if fan_out < 1:
+        raise RuntimeError("Fan-out must be at least 1")
+    for name in gate_types:
+        if name not in GATE_TYPES:
+            raise RuntimeError("Unknown gate type '%s'" % name)
+
+    options = {
+        "segments" : segments
+        , "inputs" : inputs
+        , "gate_types" : list(gate_types)
+        , "fan_in" : tuple(fan_in)
+        , "fan_out" : fan_out
+        , "depth" : max(1, depth)
+        , "jogs" : jogs
+        }
+    rng = random.Random(seed)
+    netlist = _build_netlist(options, rng)
+    _assign_tracks(netlist)
+    lines, labels = _route(netlist)
+    if bridges:
+        _add_bridges(lines, labels, bridges, rng)
+    if fragmentation:
+        lines = _fragment(lines, fragmentation, rng)
+    return {"lines" : lines, "labels" : labels}
+
+# ============================================================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate random logic charts.")
+    parser.add_argument("-o", "--output", help="output file (default: stdout)")
+    parser.add_argument("-n", "--count", type=int, default=1
+        , help="number of charts, more than one are written as JSONL")
+    parser.add_argument("--segments", type=int, default=100
+        , help="approximate number of lines per chart (default: %(default)s)")
+    parser.add_argument("--inputs", type=int)
+    parser.add_argument("--gate-types", default=",".join(GATE_TYPES))
+    parser.add_argument("--fan-in", default="2,2", help="min,max inputs of binary gates")
+    parser.add_argument("--fan-out", type=int, default=4)
+    parser.add_argument("--depth", type=int, default=6)
+    parser.add_argument("--jogs", type=float, default=0.0
+        , help="probability of an input wire taking a detour through an extra corner")
+    parser.add_argument("--bridges", type=int, default=0)
+    parser.add_argument("--fragmentation", type=float, default=0.0
+        , help="probability of a line being broken into pieces, and of a stretch of it drawn twice")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for i in range(args.count):
+            record = generate_chart(args.segments, args.inputs, args.gate_types.split(",")
+                , [int(n) for n in args.fan_in.split(",")], args.fan_out, args.depth
+                , args.jogs, args.bridges, args.fragmentation, args.seed + i)
+            if args.count > 1:
+                record["id"] = "synth_%d" % (args.seed + i)
+                out.write(json.dumps(record) + "\n")
+            else:
+                json.dump(record, out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+# ============================================================================
+
+if __name__ == '__main__':
+    main()
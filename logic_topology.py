@@ -0,0 +1,153 @@
+import numpy as np
+
+from logic_utils import pairs_to_line_dist
+from logic_index import box_point_pairs
+
+# ============================================================================
+
+CORNER = 0 # The vertical line ends at an end of the horizontal one
+TEE = 1 # The vertical line ends somewhere along the horizontal one
+
+# ============================================================================
+
+def contact_flags(points, segments, tolerance):
+    """Whether each vertical line end touches its horizontal line, and is near its left and right end."""
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    segments = np.asarray(segments, dtype=np.float64).reshape(-1, 2, 2)
+    d_left = np.sqrt(((points - segments[:, 0]) ** 2).sum(axis=1))
+    d_right = np.sqrt(((points - segments[:, 1]) ** 2).sum(axis=1))
+    touches = pairs_to_line_dist(points, segments) <= tolerance
+    return touches, d_left < tolerance, d_right < tolerance
+
+# ============================================================================
+
+class WireTopology(object):
+    """Table of all the contacts between vertical line ends and horizontal lines.
+
+    One row per vertical line end within the tolerance of a horizontal line
+    (or of one of its ends), with the flags tracing needs:
+
+        h, v         -- line indices
+        v_end        -- 0 for the top end of the vertical line, 1 for the bottom
+        touches      -- the end is within the tolerance of the horizontal line
+        near_left    -- ... and closer than the tolerance to its left end
+        near_right   -- ... to its right end
+
+    The rows are grouped per horizontal line and per vertical line end, so
+    lookups are slices. The table only depends on the line geometry and
+    the tolerance, and converts to and from a dict of arrays (`arrays`,
+    `from_arrays`) to be stored on its own.
+    """
+    COLUMNS = ["h", "v", "v_end", "touches", "near_left", "near_right"]
+
+    def __init__(self, tolerance, count_h, count_v, h, v, v_end, touches, near_left, near_right):
+        self.tolerance = tolerance
+        self.count_h = count_h
+        self.count_v = count_v
+        self.h = np.asarray(h, dtype=np.int64)
+        self.v = np.asarray(v, dtype=np.int64)
+        self.v_end = np.asarray(v_end, dtype=np.int8)
+        self.touches = np.asarray(touches, dtype=bool)
+        self.near_left = np.asarray(near_left, dtype=bool)
+        self.near_right = np.asarray(near_right, dtype=bool)
+
+        # Rows per horizontal line, in order of vertical line
+        order = np.lexsort((self.v_end, self.v, self.h))
+        offsets = np.zeros(count_h + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.h, minlength=count_h), out=offsets[1:])
+        self._by_h = self._rows(order, offsets, self.touches)
+
+        # Rows per vertical line end, in order of horizontal line
+        keys = 2 * self.v + self.v_end
+        order = np.lexsort((self.h, keys))
+        offsets = np.zeros(2 * count_v + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys, minlength=2 * count_v), out=offsets[1:])
+        self._by_v = self._rows(order, offsets, self.near_left | self.near_right)
+
+    def _rows(self, order, offsets, keep):
+        # Python lists of the row tuples, for fast lookups while tracing
+        rows = zip(self.h[order].tolist(), self.v[order].tolist(), self.v_end[order].tolist()
+            , self.near_left[order].tolist(), self.near_right[order].tolist(), keep[order].tolist())
+        return offsets.tolist(), rows
+
+    def __len__(self):
+        return len(self.h)
+
+    @classmethod
+    def build(cls, lines_h, lines_v, tolerance):
+        """Find all the contacts in one sweep over the lines.
+
+        Each horizontal line, inflated by the tolerance, is a box for
+        `box_point_pairs` to match against all the vertical line ends. The
+        candidate pairs are then measured exactly, all at once.
+        """
+        lines_h = np.asarray(lines_h, dtype=np.float64).reshape(-1, 2, 2)
+        lines_v = np.asarray(lines_v, dtype=np.float64).reshape(-1, 2, 2)
+        boxes = np.stack([lines_h.min(axis=1) - tolerance, lines_h.max(axis=1) + tolerance], axis=1)
+        h, point = box_point_pairs(boxes, lines_v.reshape(-1, 2))
+        v, v_end = point // 2, point % 2
+
+        touches, near_left, near_right = contact_flags(lines_v.reshape(-1, 2)[point], lines_h[h], tolerance)
+        keep = touches | near_left | near_right
+        return cls(tolerance, len(lines_h), len(lines_v), h[keep], v[keep], v_end[keep]
+            , touches[keep], near_left[keep], near_right[keep])
+
+    # ------------------------------------------------------------------------
+
+    def h_line_contacts(self, index):
+        """(v, top, bottom) for each vertical line with an end touching the horizontal line."""
+        offsets, rows = self._by_h
+        contacts = []
+        for h, v, v_end, near_left, near_right, touches in rows[offsets[index]:offsets[index + 1]]:
+            if not touches:
+                continue
+            if contacts and (contacts[-1][0] == v):
+                contacts[-1] = (v, True, True) # Both ends, rows are in end order
+            else:
+                contacts.append((v, v_end == 0, v_end == 1))
+        return contacts
+
+    def v_end_contacts(self, index, bottom):
+        """(h, near_left, near_right) for each horizontal line with an end near the vertical line end."""
+        offsets, rows = self._by_v
+        key = 2 * index + (1 if bottom else 0)
+        return [(h, near_left, near_right) for h, v, v_end, near_left, near_right, near
+            in rows[offsets[key]:offsets[key + 1]] if near]
+
+    def kinds(self):
+        # CORNER or TEE per row
+        return np.where(self.near_left | self.near_right, CORNER, TEE)
+
+    def summary(self):
+        kinds = self.kinds()[self.touches]
+        return {
+            "contacts" : len(self)
+            , "corners" : int((kinds == CORNER).sum())
+            , "tees" : int((kinds == TEE).sum())
+            }
+
+    def subset(self, h_ids, v_ids):
+        """Table of the contacts among some of the lines, renumbered in the given order."""
+        h_map = np.full(self.count_h, -1, dtype=np.int64)
+        v_map = np.full(self.count_v, -1, dtype=np.int64)
+        h_map[h_ids] = np.arange(len(h_ids))
+        v_map[v_ids] = np.arange(len(v_ids))
+        rows = (h_map[self.h] >= 0) & (v_map[self.v] >= 0)
+        return WireTopology(self.tolerance, len(h_ids), len(v_ids), h_map[self.h[rows]], v_map[self.v[rows]]
+            , self.v_end[rows], self.touches[rows], self.near_left[rows], self.near_right[rows])
+
+    # ------------------------------------------------------------------------
+
+    def arrays(self):
+        result = dict((name, getattr(self, name)) for name in self.COLUMNS)
+        result["shape"] = np.array([self.count_h, self.count_v])
+        result["tolerance"] = np.array(self.tolerance, dtype=np.float64)
+        return result
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        count_h, count_v = [int(n) for n in arrays["shape"]]
+        return cls(float(arrays["tolerance"]), count_h, count_v
+            , *[arrays[name] for name in cls.COLUMNS])
+
+# ============================================================================
@@ -57,6 +57,45 @@ def point_to_line_dist(point, line):
 
 # ----------------------------------------------------------------------------
 
+def pairs_to_line_dist(points, lines):
+    """Distance of each point to its own line segment.
+
+    Same steps as `point_to_line_dist`, for arrays of N points and N
+    segments of shape (N, 2, 2).
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    lines = np.asarray(lines, dtype=np.float64).reshape(-1, 2, 2)
+    p1 = lines[:, 0]
+    p2 = lines[:, 1]
+
+    unit_line = p2 - p1
+    line_len = np.sqrt(unit_line[:, 0] * unit_line[:, 0] + unit_line[:, 1] * unit_line[:, 1])
+    norm_unit_line = unit_line / line_len[:, np.newaxis]
+
+    rel = p1 - points
+    segment_dist = np.abs(unit_line[:, 0] * rel[:, 1] - unit_line[:, 1] * rel[:, 0]) / line_len
+
+    diff = (
+        (norm_unit_line[:, 0] * (points[:, 0] - p1[:, 0])) +
+        (norm_unit_line[:, 1] * (points[:, 1] - p1[:, 1]))
+    )
+
+    x_seg = (norm_unit_line[:, 0] * diff) + p1[:, 0]
+    y_seg = (norm_unit_line[:, 1] * diff) + p1[:, 1]
+
+    d1 = points - p1
+    d2 = points - p2
+    endpoint_dist = np.minimum(
+        np.sqrt(d1[:, 0] * d1[:, 0] + d1[:, 1] * d1[:, 1]),
+        np.sqrt(d2[:, 0] * d2[:, 0] + d2[:, 1] * d2[:, 1])
+    )
+
+    is_betw_x = ((p1[:, 0] <= x_seg) & (x_seg <= p2[:, 0])) | ((p2[:, 0] <= x_seg) & (x_seg <= p1[:, 0]))
+    is_betw_y = ((p1[:, 1] <= y_seg) & (y_seg <= p2[:, 1])) | ((p2[:, 1] <= y_seg) & (y_seg <= p1[:, 1]))
+    return np.where(is_betw_x & is_betw_y, segment_dist, endpoint_dist)
+
+# ----------------------------------------------------------------------------
+
 def make_point_bbox(p, margin):
     tl = ((p[0] - margin), (p[1] - margin))
     br = ((p[0] + margin), (p[1] + margin))
@@ -85,6 +124,15 @@ def bbox_center(b1):
     return ((tl[0] + br[0]) / 2, (tl[1] + br[1]) / 2)
 
 # ----------------------------------------------------------------------------
+
+def point_bbox_distance(p, box):
+    # Zero inside the box
+    (x0, y0), (x1, y1) = box
+    dx = max(x0 - p[0], 0, p[0] - x1)
+    dy = max(y0 - p[1], 0, p[1] - y1)
+    return np.sqrt(dx*dx + dy*dy)
+
+# ----------------------------------------------------------------------------
     
 def line_slope(p1, p2):
     dx, dy = (p2[0]-p1[0]),(p2[1]-p1[1])
@@ -102,8 +150,18 @@ def bbox_distance_slope(b1, b2):
 # ----------------------------------------------------------------------------
         
 def is_line_horizontal(line):
-    p1, p2 = line
-    slope = line_slope(p1, p2)
-    return (slope >= -1) and (slope <= 1)
+    # At most 45 degrees off the x axis. Not through `line_slope`, which
+    # takes dx == 0 as slope 0 and dy == 0 as infinite
+    (x1, y1), (x2, y2) = line
+    return abs(y2 - y1) <= abs(x2 - x1)
+
+# ----------------------------------------------------------------------------
+
+def are_lines_horizontal(lines):
+    # Same classification as `is_line_horizontal`, for an (N, 2, 2) array
+    lines = np.asarray(lines)
+    dx = np.abs(lines[:, 1, 0] - lines[:, 0, 0])
+    dy = np.abs(lines[:, 1, 1] - lines[:, 0, 1])
+    return dy <= dx
 
 # ============================================================================
@@ -1,36 +1,345 @@
+"""Draw charts, optionally with the traced result, to PNG files.
+
+The canvas covers the lines and labels of the chart (and the source image,
+if one is given), at any scale. Big charts are drawn one fixed-size tile
+at a time, so memory stays bounded by the tile size.
+
+    python render_chart.py dataset_1 --background logic_chart_1.jpg
+    python render_chart.py charts.lca -o renders --scale 0.25 --overlay components
+    python render_chart.py scan.json --tile 2048
+"""
+
+import argparse
+import colorsys
+import os
+import re
+import sys
+
 import numpy as np
 import cv2
 
-from logic_data import *
+from logic_classes import InputTerm, OutputTerm, UnaryGate, BinaryGate, Node
+
+# ============================================================================
+
+MARGIN = 50 # Chart units around the lines and labels
+THICKNESS = 2
+SHIFT = 4 # Fractional bits of the drawing coordinates
+MAX_SIZE = 8192 # Largest side of an untiled image, the scale is reduced to fit
+
+LINE_COLOR = (0, 255, 0)
+UNUSED_LINE_COLOR = (0, 0, 255)
+NODE_COLOR = (255, 127, 127)
+OUTPUT_COLOR = (0, 255, 255)
+GATE_COLOR = (127, 127, 255)
+INPUT_COLOR = (255, 127, 255)
+
+VERTEX_COLORS = {
+    InputTerm : INPUT_COLOR
+    , OutputTerm : OUTPUT_COLOR
+    , UnaryGate : GATE_COLOR
+    , BinaryGate : GATE_COLOR
+    , Node : NODE_COLOR
+    }
+
+OVERLAYS = ["none", "types", "components"]
 
 # ============================================================================
 
-labels = dataset_2["labels"]
-lines = dataset_2["lines"]
+def label_color(name):
+    if name == 'NODE':
+        return NODE_COLOR
+    elif name == 'OUTPUT':
+        return OUTPUT_COLOR
+    elif name in ['AND', 'OR', 'XOR', 'NAND', 'NOR', 'XNOR', 'NOT']:
+        return GATE_COLOR
+    return INPUT_COLOR
+
+# ----------------------------------------------------------------------------
+
+def palette(count):
+    # Distinct colors, hues spread by the golden ratio
+    colors = []
+    for i in range(count):
+        r, g, b = colorsys.hsv_to_rgb((i * 0.618033988749895) % 1.0, 0.8, 1.0)
+        colors.append((int(255 * b), int(255 * g), int(255 * r)))
+    return colors
+
+# ----------------------------------------------------------------------------
+
+def chart_extent(lines, boxes, margin=MARGIN):
+    # (x0, y0, x1, y1) around all the lines and label boxes
+    points = np.concatenate([np.asarray(lines, dtype=np.float64).reshape(-1, 2)
+        , np.asarray(boxes, dtype=np.float64).reshape(-1, 2)])
+    if len(points) == 0:
+        return (0, 0, 2 * margin, 2 * margin)
+    low = np.floor(points.min(axis=0)) - margin
+    high = np.ceil(points.max(axis=0)) + margin
+    return (int(low[0]), int(low[1]), int(high[0]), int(high[1]))
 
 # ============================================================================
 
-out_img = np.zeros((2000, 3200, 3), np.uint8)
-#out_img = cv2.imread('logic_chart_1.jpg')
+class ChartRenderer(object):
+    """Draws a chart's lines and labels into windows of the output image.
+
+    Lines are (N, 2, 2) chart coordinates, labels (name, box) pairs, and each
+    line and label has its own BGR color. The output image covers `extent`
+    in chart units, at `scale` pixels per unit. `background`, if given, is
+    an image in chart coordinates, decoded at `background_factor` times
+    less resolution.
+    """
+
+    def __init__(self, lines, labels, line_colors, label_colors, scale=1.0, extent=None
+            , background=None, background_factor=1, thickness=THICKNESS):
+        self.lines = np.asarray(lines, dtype=np.float64).reshape(-1, 2, 2)
+        self.names = [label[0] for label in labels]
+        self.boxes = np.array([label[1:3] for label in labels], dtype=np.float64).reshape(-1, 2, 2)
+        self.line_colors = np.array(line_colors, dtype=np.uint8).reshape(-1, 3)
+        self.label_colors = np.array(label_colors, dtype=np.uint8).reshape(-1, 3)
+        self.scale = float(scale)
+        self.background = background
+        self.background_factor = background_factor
+        self.thickness = thickness
+
+        if extent is None:
+            extent = chart_extent(self.lines, self.boxes)
+        self.origin = np.array(extent[:2], dtype=np.float64)
+        self.width = max(1, int(np.ceil((extent[2] - extent[0]) * self.scale)))
+        self.height = max(1, int(np.ceil((extent[3] - extent[1]) * self.scale)))
+
+        # Output pixel bounds of each line and label, to pick those in a window
+        self._line_px = (self.lines - self.origin) * self.scale
+        self._box_px = (self.boxes - self.origin) * self.scale
+        self._line_bounds = np.concatenate([self._line_px.min(axis=1), self._line_px.max(axis=1)], axis=1)
+        self._box_bounds = np.concatenate([self._box_px.min(axis=1), self._box_px.max(axis=1)], axis=1)
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    # ------------------------------------------------------------------------
+
+    def render(self, x, y, width, height):
+        """Image of the output window at (x, y), (height, width, 3) BGR."""
+        image = self._background(x, y, width, height)
+        pad = self.thickness + 1
+        window = np.array([x - pad, y - pad, x + width + pad, y + height + pad], dtype=np.float64)
+        offset = np.array([x, y], dtype=np.float64)
+
+        lines = _in_window(self._line_bounds, window)
+        self._draw(image, self._line_px[lines] - offset, self.line_colors[lines], False)
+
+        labels = _in_window(self._box_bounds, window)
+        corners = self._box_px[labels] - offset
+        (x0, y0), (x1, y1) = corners[:, 0].T, corners[:, 1].T
+        rectangles = np.stack([np.stack([x0, y0], axis=1), np.stack([x1, y0], axis=1)
+            , np.stack([x1, y1], axis=1), np.stack([x0, y1], axis=1)], axis=1)
+        colors = self.label_colors[labels]
+        self._draw(image, rectangles, colors, True)
+
+        font_scale = self.scale
+        text_offset = np.array([10, 30]) * self.scale
+        for i, corner, color in zip(np.flatnonzero(labels).tolist(), corners[:, 0], colors.tolist()):
+            px, py = (corner + text_offset).astype(int).tolist()
+            cv2.putText(image, self.names[i], (px, py), cv2.FONT_HERSHEY_DUPLEX, font_scale, tuple(color))
+        return image
+
+    def tiles(self, tile_size):
+        # (row, column, image) of each tile, row by row
+        for row, y in enumerate(range(0, self.height, tile_size)):
+            for column, x in enumerate(range(0, self.width, tile_size)):
+                yield row, column, self.render(x, y, min(tile_size, self.width - x)
+                    , min(tile_size, self.height - y))
+
+    # ------------------------------------------------------------------------
+
+    def _background(self, x, y, width, height):
+        if self.background is None:
+            return np.zeros((height, width, 3), np.uint8)
+        # Background pixel b is at chart coordinates b * factor
+        factor = self.background_factor * self.scale
+        matrix = np.array([[factor, 0, -self.origin[0] * self.scale - x]
+            , [0, factor, -self.origin[1] * self.scale - y]], dtype=np.float64)
+        return cv2.warpAffine(self.background, matrix, (width, height), flags=cv2.INTER_LINEAR
+            , borderMode=cv2.BORDER_CONSTANT)
 
-for line in lines:
-    cv2.line(out_img, line[0], line[1], (0, 255, 0), 2)
+    def _draw(self, image, polylines, colors, closed):
+        # One polylines call per color, in fixed point
+        if len(polylines) == 0:
+            return
+        points = np.round(polylines * (1 << SHIFT)).astype(np.int32)
+        unique, groups = np.unique(colors, axis=0, return_inverse=True)
+        for k, color in enumerate(unique.tolist()):
+            cv2.polylines(image, points[groups == k], closed, tuple(color), self.thickness, cv2.LINE_8, SHIFT)
 
-for label in labels:
-    if label[0] == 'NODE':
-        color = (255, 127, 127)
-    elif label[0] == 'OUTPUT':
-        color = (0, 255, 255)
-    elif label[0] in ['AND', 'OR', 'XOR', 'NAND', 'NOR', 'NOT']:
-        color = (127, 127, 255)
+# ----------------------------------------------------------------------------
+
+def _in_window(bounds, window):
+    # Which of the (x0, y0, x1, y1) bounds overlap the window
+    return ((bounds[:, 0] <= window[2]) & (bounds[:, 2] >= window[0])
+        & (bounds[:, 1] <= window[3]) & (bounds[:, 3] >= window[1]))
+
+# ============================================================================
+
+def overlay_colors(lines, labels, overlay):
+    """Lines in drawing order, and the colors of the lines and labels.
+
+    "none" draws the chart as given. "types" traces the chart and colors
+    the labels by vertex type, and the lines the trace didn't reach in red.
+    "components" colors the independent parts of the chart (see
+    `find_components`) each their own way. Returns the trace error too, if
+    there was one; the overlay then shows how far the trace got, or if the
+    chart can't be traced at all, the chart as given.
+    """
+    plain = (lines, [LINE_COLOR] * len(lines), [label_color(label[0]) for label in labels])
+    if overlay == "none":
+        return plain + (None,)
+
+    from logic import DataSet
+    from logic_partition import find_components
+
+    try:
+        ds = DataSet(lines, labels)
+    except RuntimeError as e:
+        return plain + (str(e),)
+    lines = np.concatenate([ds.lines_h.endpoints, ds.lines_v.endpoints])
+    if overlay == "components":
+        components = find_components(ds)
+        colors = palette(len(components))
+        line_colors = np.zeros((len(lines), 3), dtype=np.uint8)
+        label_colors = np.zeros((len(labels), 3), dtype=np.uint8)
+        for c, color in zip(components, colors):
+            line_colors[c.h_ids] = color
+            line_colors[len(ds.lines_h) + c.v_ids] = color
+            label_colors[c.label_ids] = color
+        return lines, line_colors, label_colors, None
+
+    error = None
+    try:
+        ds.analyze()
+    except RuntimeError as e:
+        error = str(e)
+    used = np.concatenate([ds.lines_h.used, ds.lines_v.used])
+    line_colors = np.where(used[:, np.newaxis], LINE_COLOR, UNUSED_LINE_COLOR)
+    label_colors = [VERTEX_COLORS[type(ds.graph.vertex(i))] for i in range(len(labels))]
+    return lines, line_colors, label_colors, error
+
+# ----------------------------------------------------------------------------
+
+def load_background(path, scale):
+    """Decode an image at the least resolution that still covers the scale.
+
+    Returns the image and how many times it was reduced (1, 2, 4 or 8).
+    """
+    for factor, flag in [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4)
+            , (2, cv2.IMREAD_REDUCED_COLOR_2), (1, cv2.IMREAD_COLOR)]:
+        if scale * factor <= 1:
+            break
+    image = cv2.imread(path, flag)
+    if image is None:
+        raise RuntimeError("Can't read image '%s'" % path)
+    return image, factor
+
+# ----------------------------------------------------------------------------
+
+def render_chart(name, lines, labels, scale=1.0, tile_size=None, overlay="none", background=None
+        , max_size=MAX_SIZE):
+    """Draw one chart into PNG files, returning their paths and the trace error.
+
+    Without `tile_size`, the chart is the one image `<name>.png`, scaled
+    down if needed to fit `max_size` pixels a side. Otherwise it is cut
+    into tiles of `tile_size` pixels square, `<name>_r<row>_c<column>.png`.
+    """
+    lines, line_colors, label_colors, error = overlay_colors(lines, labels, overlay)
+    extent = chart_extent(lines, [label[1:3] for label in labels])
+    image, factor = None, 1
+    if background is not None:
+        image, factor = load_background(background, scale)
+        height, width = image.shape[:2]
+        extent = (min(extent[0], 0), min(extent[1], 0)
+            , max(extent[2], width * factor), max(extent[3], height * factor))
+    if tile_size is None:
+        fit = float(max_size) / max(extent[2] - extent[0], extent[3] - extent[1])
+        if fit < scale:
+            scale = fit
+            if background is not None:
+                image, factor = load_background(background, scale)
+    renderer = ChartRenderer(lines, labels, line_colors, label_colors, scale, extent, image, factor)
+
+    paths = []
+    if tile_size is None:
+        paths.append(name + ".png")
+        cv2.imwrite(paths[-1], renderer.render(0, 0, renderer.width, renderer.height))
     else:
-        color = (255, 127, 255)
-
-    p1 = int(label[1][0]), int(label[1][1])
-    p2 = int(label[2][0]), int(label[2][1])
-    cv2.rectangle(out_img, p1, p2, color, 2)
-    
-    pt = p1[0] + 10, p1[1] + 30
-    cv2.putText(out_img, label[0], pt, cv2.FONT_HERSHEY_DUPLEX, 1, color)
-    
-cv2.imwrite('logic_output.png', out_img)
+        for row, column, tile in renderer.tiles(tile_size):
+            paths.append("%s_r%d_c%d.png" % (name, row, column))
+            cv2.imwrite(paths[-1], tile)
+    return paths, error
+
+# ----------------------------------------------------------------------------
+
+def image_name(chart_id):
+    # File name for the images of a chart, from its id
+    if isinstance(chart_id, (int, long)):
+        return "chart_%d" % chart_id
+    name = os.path.basename(chart_id)
+    if name.endswith(".json"):
+        name = name[:-len(".json")]
+    return re.sub(r"[^\w.-]", "_", name)
+
+# ============================================================================
+
+def main(argv=None):
+    from logic_io import iter_named_sources, read_chart_source
+
+    parser = argparse.ArgumentParser(description="Draw charts, optionally with the traced result, to PNG files.")
+    parser.add_argument("sources", nargs="+"
+        , help="logic_data, dataset_N, chart JSON files, directories of them, JSONL files or archives")
+    parser.add_argument("-o", "--output-dir", default="."
+        , help="directory for the images (default: current directory)")
+    parser.add_argument("--scale", type=float, default=1.0
+        , help="output pixels per chart unit (default: %(default)s)")
+    parser.add_argument("--tile", type=int, metavar="PIXELS"
+        , help="cut the output into square tiles of this size")
+    parser.add_argument("--max-size", type=int, default=MAX_SIZE, metavar="PIXELS"
+        , help="without --tile, scale down to fit this many pixels a side (default: %(default)s)")
+    parser.add_argument("--overlay", choices=OVERLAYS, default="none"
+        , help="color by vertex type and reach of the trace, or by independent component")
+    parser.add_argument("--background", metavar="IMAGE"
+        , help="draw over this image, in chart coordinates (the source scan of a single chart)")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    names = set()
+    rendered = failed = 0
+    for chart_id, source in iter_named_sources(args.sources):
+        try:
+            record_id, lines, labels = read_chart_source(source)
+        except Exception as e:
+            sys.stderr.write("%s: can't read chart: %s: %s\n" % (chart_id, type(e).__name__, e))
+            failed += 1
+            continue
+        if record_id is not None:
+            chart_id = record_id
+        name = image_name(chart_id)
+        if name in names:
+            name = "%s_%d" % (name, len(names))
+        names.add(name)
+        try:
+            paths, error = render_chart(os.path.join(args.output_dir, name), lines, labels, args.scale, args.tile
+                , args.overlay, args.background, args.max_size)
+        except Exception as e:
+            sys.stderr.write("%s: can't render chart: %s: %s\n" % (chart_id, type(e).__name__, e))
+            failed += 1
+            continue
+        sys.stderr.write("%s: %d image(s)%s\n" % (chart_id, len(paths), ", trace failed: %s" % error if error else ""))
+        rendered += 1
+
+    sys.stderr.write("%d charts rendered, %d failed.\n" % (rendered, failed))
+    return 0
+
+# ============================================================================
+
+if __name__ == '__main__':
+    sys.exit(main())